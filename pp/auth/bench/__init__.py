@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for pp.auth.
+
+Each module can be run directly, e.g.::
+
+    python -m pp.auth.bench.plain_store --users 100000
+
+They print their results and are not run as part of the tests. The end to
+end WSGI benchmark is also installed as pp-auth-bench (see bench.wsgi).
+
+"""
+import sys
+import time
+import random
+import string
+import contextlib
+
+
+def deep_sizeof(obj):
+    """Return the bytes used by obj and everything it references.
+
+    Objects referenced more than once (e.g. interned strings) are only
+    counted once.
+
+    """
+    seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        item = pending.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            pending.extend(item)
+        elif hasattr(item, '__slots__'):
+            pending.extend(
+                getattr(item, s) for s in item.__slots__ if hasattr(item, s)
+            )
+        elif hasattr(item, '__dict__'):
+            pending.append(item.__dict__)
+
+    return size
+
+
+@contextlib.contextmanager
+def timed(results, name):
+    """Store the seconds the with block took in results[name]."""
+    started = time.time()
+    yield
+    results[name] = time.time() - started
+
+
+FIRSTNAMES = [
+    'Bob', 'Janet', 'Andrés', 'Alice', 'Oisin', 'Edward', 'Mary', 'John',
+    'Aoife', 'Fred', 'Siobhan', 'Paul', 'Sarah', 'Tom', 'Niamh', 'Liam',
+]
+
+LASTNAMES = [
+    'Sprocket', 'Ganet', 'Bolívar', 'Smith', 'Murphy', 'Kelly', 'Byrne',
+    'Walsh', 'Ryan', "O'Brien", 'Wellington', 'Jones', 'Doyle', 'Easton',
+]
+
+
+def generate_users(count, password_hash="$6$rounds=5000$salt$hash", seed=1):
+    """Yield count (username, password_hash, firstname, lastname, email)
+    tuples of made up users.
+    """
+    r = random.Random(seed)
+    for i in xrange(count):
+        firstname = r.choice(FIRSTNAMES)
+        lastname = r.choice(LASTNAMES)
+        username = "%s.%s%d" % (
+            firstname.lower(), lastname.lower().replace("'", ""), i
+        )
+        yield (
+            username,
+            password_hash,
+            firstname,
+            lastname,
+            "%s@example.com" % username,
+        )
+
+
+def generate_passwd_csv(count, **kwargs):
+    """Return the plain plugin passwd.csv contents for count users."""
+    return "".join(
+        "%s, %s, %s, %s, %s\n" % row for row in generate_users(count, **kwargs)
+    )
+
+
+def random_string(length=8, seed=None):
+    r = random.Random(seed)
+    return "".join(r.choice(string.ascii_lowercase) for i in range(length))
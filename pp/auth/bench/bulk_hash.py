@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the password hashing throughput of the bulk creation path for
+increasing numbers of worker processes.
+
+    python -m pp.auth.bench.bulk_hash --passwords 200 --workers 1,2,4
+
+"""
+import argparse
+import multiprocessing
+
+from pp.auth import bench
+from pp.auth import pwtools
+
+
+def run(passwords, workers):
+    """Hash the passwords once in the caller and once per pool size.
+
+    :returns: a dict of results keyed on the number of workers (0 being the
+        calling process).
+
+    """
+    plain = [bench.random_string(12, seed=i) for i in range(passwords)]
+
+    results = {}
+    timings = {}
+    with bench.timed(timings, 0):
+        [pwtools.hash_password(p) for p in plain]
+
+    for count in workers:
+        with pwtools.hashing_pool(count) as executor:
+            # Don't time the workers starting up:
+            pwtools.hash_many(plain[:count], executor)
+            with bench.timed(timings, count):
+                pwtools.hash_many(plain, executor)
+
+    for count, seconds in timings.items():
+        rate = passwords / seconds
+        results[count] = dict(
+            hashes_per_second=rate,
+            hashes_per_second_per_core=rate / (count or 1),
+        )
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--passwords", type=int, default=200)
+    parser.add_argument(
+        "--workers", default=str(multiprocessing.cpu_count()),
+        help="A comma separated list of pool sizes to try.",
+    )
+    args = parser.parse_args(argv)
+
+    workers = [int(i) for i in args.workers.split(',')]
+    results = run(args.passwords, workers)
+    for count in sorted(results):
+        r = results[count]
+        print "workers=%-3s hashes/sec=%.1f hashes/sec/core=%.1f" % (
+            count or 'no', r['hashes_per_second'],
+            r['hashes_per_second_per_core'],
+        )
+
+
+if __name__ == "__main__":
+    main()
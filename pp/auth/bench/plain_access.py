@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Compare resolving users' groups and permissions with the repoze.what INI
+adapters against the plain plugin's precomputed index.
+
+    python -m pp.auth.bench.plain_access --users 10000 --groups 1000 \\
+        --permissions 5000
+
+"""
+import os
+import random
+import shutil
+import argparse
+import tempfile
+
+from repoze.what.plugins.ini import INIGroupAdapter
+from repoze.what.plugins.ini import INIPermissionsAdapter
+
+from pp.auth import bench
+from pp.auth.plugins import plain
+
+
+def write_ini(filename, info):
+    with open(filename, 'w') as fd:
+        for section, items in info.iteritems():
+            fd.write("[%s]\n%s\n\n" % (section, "\n".join(items)))
+
+
+def generate(users, groups, permissions, per_user=3, per_permission=3):
+    """Return made up (groups_info, permissions_info) where each user is in
+    per_user groups and each permission is granted to per_permission groups.
+    """
+    r = random.Random(1)
+    group_names = ["group%d" % i for i in range(groups)]
+
+    groups_info = dict((g, []) for g in group_names)
+    for i in range(users):
+        for g in r.sample(group_names, per_user):
+            groups_info[g].append("user%d" % i)
+
+    permissions_info = dict(
+        ("permission%d" % i, r.sample(group_names, per_permission))
+        for i in range(permissions)
+    )
+    return groups_info, permissions_info
+
+
+def resolve(group_adapter, permission_adapter, userid):
+    """Find the user's groups and permissions as repoze.what does."""
+    groups = set(group_adapter.find_sections({'repoze.who.userid': userid}))
+    permissions = set()
+    for group in groups:
+        permissions |= set(permission_adapter.find_sections(group))
+    return groups, permissions
+
+
+def run(users, groups, permissions, lookups):
+    """Resolve random users with each pair of adapters.
+
+    :returns: a dict of results for each approach.
+
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        groups_file = os.path.join(tmpdir, 'groups.ini')
+        permissions_file = os.path.join(tmpdir, 'permissions.ini')
+        groups_info, permissions_info = generate(users, groups, permissions)
+        write_ini(groups_file, groups_info)
+        write_ini(permissions_file, permissions_info)
+
+        settings = {
+            'pp.auth.plain.groups_file': groups_file,
+            'pp.auth.plain.permissions_file': permissions_file,
+        }
+
+        results = {}
+        for name, build in [
+            ('ini', lambda: (
+                INIGroupAdapter(groups_file),
+                INIPermissionsAdapter(permissions_file),
+            )),
+            ('index', lambda: (
+                plain.get_groups_from_config(settings),
+                plain.get_permissions_from_config(settings),
+            )),
+        ]:
+            timings = {}
+            with bench.timed(timings, 'load'):
+                group_adapter, permission_adapter = build()
+
+            r = random.Random(2)
+            with bench.timed(timings, 'lookups'):
+                for i in range(lookups):
+                    userid = "user%d" % r.randint(0, users - 1)
+                    resolve(group_adapter, permission_adapter, userid)
+
+            results[name] = dict(
+                load_seconds=timings['load'],
+                us_per_lookup=timings['lookups'] * 1e6 / lookups,
+            )
+
+        return results
+
+    finally:
+        plain._access_files.clear()
+        shutil.rmtree(tmpdir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--permissions", type=int, default=5000)
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    results = run(args.users, args.groups, args.permissions, args.lookups)
+    for name in ('ini', 'index'):
+        r = results[name]
+        print "%-5s load=%.2fs lookup=%.1fus" % (
+            name, r['load_seconds'], r['us_per_lookup'],
+        )
+
+
+if __name__ == "__main__":
+    main()
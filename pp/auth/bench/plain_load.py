@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Time the cold start load of a large plain plugin password CSV: the old read
+everything then parse approach, the streaming loader and the streaming
+loader with parallel parsing.
+
+    python -m pp.auth.bench.plain_load --users 1000000 --workers 4
+
+"""
+import os
+import argparse
+import tempfile
+
+from pp.auth import bench
+from pp.auth.bench import plain_store
+from pp.auth.plugins import plain
+
+
+def run(users, workers):
+    """Write a password CSV for the users then load it each way.
+
+    :returns: a dict of the timings for each approach.
+
+    """
+    fd, filename = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            for row in bench.generate_users(users):
+                fp.write("%s, %s, %s, %s, %s\n" % row)
+
+        results = {}
+
+        timings = {}
+        with bench.timed(timings, 'total'):
+            with open(filename, 'r') as fp:
+                plain_store.legacy_load(fp.read())
+        results['legacy'] = timings
+
+        store = plain.PlainUserStore()
+        results['streaming'] = store.load_file(filename)['timings']
+        assert len(store) == users
+
+        store = plain.PlainUserStore()
+        results['parallel'] = store.load_file(filename, workers)['timings']
+        assert len(store) == users
+
+    finally:
+        os.remove(filename)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    results = run(args.users, args.workers)
+    for name in ('legacy', 'streaming', 'parallel'):
+        print "%-10s %s" % (name, " ".join(
+            "%s=%.2fs" % (phase, taken)
+            for phase, taken in sorted(results[name].items())
+        ))
+
+
+if __name__ == "__main__":
+    main()
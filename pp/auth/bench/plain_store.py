@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the memory used per user by the plain plugin's user store against
+the dict-of-dicts it used to build.
+
+    python -m pp.auth.bench.plain_store --users 100000
+
+"""
+import csv
+import argparse
+import StringIO
+
+from pp.auth import bench
+from pp.auth.plugins import plain
+
+
+def legacy_load(user_details):
+    """How PlainAuthenticatorMetadataProvider used to hold the users."""
+    user_details_by_name = {}
+    s = StringIO.StringIO(user_details)
+    reader = csv.DictReader(s, fieldnames=[
+        'username', 'password', 'firstname', 'lastname', 'email'
+    ])
+    for row in reader:
+        username = row['username'].strip()
+        password = row['password'].strip()
+        firstname = row['firstname'].strip()
+        lastname = row['lastname'].strip()
+        email = row['email'].strip()
+        name = "%s %s" % (firstname, lastname)
+        user_details_by_name[username] = dict(
+            username=username,
+            password=password,
+            firstname=firstname,
+            lastname=lastname,
+            email=email,
+            name=name,
+        )
+    return user_details_by_name
+
+
+def run(users):
+    """Load the generated users both ways.
+
+    :returns: a dict of results for each approach.
+
+    """
+    user_details = bench.generate_passwd_csv(users)
+
+    results = {}
+    for name, loader in [
+        ('legacy', legacy_load),
+        ('store', plain.PlainUserStore),
+    ]:
+        timings = {}
+        with bench.timed(timings, 'load'):
+            loaded = loader(user_details)
+        size = bench.deep_sizeof(loaded)
+        results[name] = dict(
+            users=users,
+            load_seconds=timings['load'],
+            bytes=size,
+            bytes_per_user=float(size) / users,
+        )
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--users", type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    results = run(args.users)
+    for name in ('legacy', 'store'):
+        r = results[name]
+        print "%-7s users=%d load=%.2fs total=%.1fMB bytes/user=%.0f" % (
+            name, r['users'], r['load_seconds'], r['bytes'] / 1048576.0,
+            r['bytes_per_user'],
+        )
+    print "saving: %.0f%%" % (
+        100 - 100.0 * results['store']['bytes'] / results['legacy']['bytes']
+    )
+
+
+if __name__ == "__main__":
+    main()
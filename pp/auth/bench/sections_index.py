@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Compare finding a user's groups by scanning every group (as the latchpony
+and INI adapters did) with the inverted sections.SectionIndex look up.
+
+    python -m pp.auth.bench.sections_index --groups 20000 --users 50000
+
+"""
+import random
+import argparse
+
+from pp.auth import bench
+from pp.auth import sections
+
+
+def linear_find_sections(info, userid):
+    """The O(groups x members) scan the adapters used to do."""
+    answer = set()
+    for section in info.keys():
+        if userid in info[section]:
+            answer.add(section)
+    return answer
+
+
+def generate_groups(groups, users, members, seed=1):
+    """Return a dict of group name to a list of member userids."""
+    r = random.Random(seed)
+    userids = ["user%d" % i for i in xrange(users)]
+    return dict(
+        ("group%d" % i, r.sample(userids, members)) for i in xrange(groups)
+    )
+
+
+def run(groups, users, members, lookups):
+    info = generate_groups(groups, users, members)
+    r = random.Random(2)
+    wanted = ["user%d" % r.randrange(users) for i in xrange(lookups)]
+
+    results = {}
+    timings = {}
+    with bench.timed(timings, 'index'):
+        index = sections.SectionIndex(info)
+    results['index_build_seconds'] = timings['index']
+
+    for name, find in [
+        ('linear', lambda u: linear_find_sections(info, u)),
+        ('indexed', lambda u: set(index.sections_for(u))),
+    ]:
+        with bench.timed(timings, name):
+            for userid in wanted:
+                find(userid)
+        results[name] = timings[name] / lookups
+
+    # Both must give the same answers:
+    for userid in wanted[:10]:
+        assert linear_find_sections(info, userid) == set(
+            index.sections_for(userid)
+        )
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--groups", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    results = run(args.groups, args.users, args.members, args.lookups)
+    print "index build: %.3fs" % results['index_build_seconds']
+    print "linear:  %.3fms per look up" % (results['linear'] * 1000)
+    print "indexed: %.4fms per look up" % (results['indexed'] * 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Count the queries and time taken per login by the SQL plugin, against the
+two user.find() calls it used to make.
+
+    python -m pp.auth.bench.sql_login --users 1000 --logins 500
+
+This needs pp.db and uses an in memory sqlite database.
+
+"""
+import random
+import argparse
+
+from sqlalchemy import event
+
+from pp.db import session, dbsetup
+
+from pp.auth import bench
+from pp.auth import pwtools
+from pp.auth.plugins import sql
+from pp.auth.plugins.sql import user
+
+
+def legacy_login(environ, identity):
+    """How SQLAuthenticatorMetadataProvider used to handle a login."""
+    u = user.find(username=identity['login'])
+    if u and u[0].validate_password(identity['password']):
+        identity['repoze.who.userid'] = u[0].username
+        u = user.find(username=identity['repoze.who.userid'])
+        if u[0]:
+            identity.update(u[0].to_dict())
+
+
+def provider_login(environ, identity):
+    """A login through the current SQLAuthenticatorMetadataProvider."""
+    provider = sql.SQLAuthenticatorMetadataProvider()
+    userid = provider.authenticate(environ, identity)
+    if userid:
+        identity['repoze.who.userid'] = userid
+        provider.add_metadata(environ, identity)
+
+
+def run(users, logins):
+    """Log in random users both ways.
+
+    :returns: a dict of results for each approach.
+
+    """
+    dbsetup.init("sqlite:///:memory:", use_transaction=False)
+    dbsetup.create()
+
+    # Hash the one password up front, the benchmark is about the queries:
+    password = "password"
+    password_hash = pwtools.hash_password(password)
+    usernames = []
+    generated = bench.generate_users(users, password_hash)
+    for username, password_hash, firstname, lastname, email in generated:
+        user.add(
+            username=username,
+            password_hash=password_hash,
+            display_name="%s %s" % (firstname, lastname),
+            email=email,
+        )
+        usernames.append(username)
+    session().commit()
+
+    queries = []
+    engine = session().get_bind()
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+
+    results = {}
+    try:
+        for name, login in [
+            ('legacy', legacy_login),
+            ('provider', provider_login),
+        ]:
+            del queries[:]
+            timings = {}
+            with bench.timed(timings, 'logins'):
+                for i in range(logins):
+                    identity = dict(
+                        login=random.choice(usernames), password=password
+                    )
+                    login({}, identity)
+                    assert 'username' in identity
+
+            results[name] = dict(
+                logins=logins,
+                queries_per_login=float(len(queries)) / logins,
+                ms_per_login=timings['logins'] * 1000.0 / logins,
+            )
+
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--logins", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    results = run(args.users, args.logins)
+    for name in ('legacy', 'provider'):
+        r = results[name]
+        print "%-8s logins=%d queries/login=%.1f ms/login=%.2f" % (
+            name, r['logins'], r['queries_per_login'], r['ms_per_login'],
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,661 @@
+# -*- coding: utf-8 -*-
+"""
+Measure what pp.auth costs per request, end to end through the WSGI stack
+add_auth_from_config() builds for each plugin.
+
+    pp-auth-bench --plugins plain,sql --requests 2000 --output results.json
+
+    # Compare with an earlier run, failing if any p99 is 20% worse:
+    pp-auth-bench --compare results.json --tolerance 0.2
+
+Each stack serves a mix of form logins, cookie authenticated page views,
+permission checks and anonymous requests for generated users. The plain
+stack uses generated passwd/groups/permissions files, the sql stack a
+SQLite database (this needs pp.db), the userservice and latchpony stacks
+local stand-in HTTP servers. Stacks whose plugin can't be imported are
+reported as skipped.
+
+The stand-in servers don't speak the pp.user / pp.latchpony REST
+protocols: the plugins' REST clients are replaced by StandInUserService and
+StandInLatchPony, which make one HTTP request per call as the real clients
+do.
+
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import urllib
+import argparse
+import tempfile
+import threading
+import traceback
+import contextlib
+import SocketServer
+import BaseHTTPServer
+from StringIO import StringIO
+
+import mock
+import requests
+import pkg_resources
+from repoze.what.predicates import has_permission
+from repoze.who.plugins.auth_tkt import AuthTktCookiePlugin
+
+from pp.auth import bench
+from pp.auth import pwtools
+from pp.auth import middleware
+
+
+PLUGINS = ('plain', 'sql', 'userservice', 'latchpony')
+
+SCENARIOS = ('login', 'page', 'permission', 'anonymous')
+
+# The default share of each scenario in the traffic:
+DEFAULT_MIX = 'login=1,page=6,permission=2,anonymous=1'
+
+PASSWORD = 'password'
+
+COOKIE_NAME = 'auth_cookie'
+
+COOKIE_SECRET = '07cafeee-ef19-4a1c-aab2-61fefbad85f4'
+
+ORGANISATION = 'bench'
+
+
+def app(environ, start_response):
+    """The application behind pp.auth."""
+    status = '200 OK'
+    if environ['PATH_INFO'] == '/admin':
+        if not has_permission('view').is_met(environ):
+            status = '403 Forbidden'
+    start_response(status, [('Content-Type', 'text/plain')])
+    return ['ok']
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local HTTP server answering as the user service and latchpony
+    would, from the generated users, groups and permissions.
+    """
+    daemon_threads = True
+
+    def __init__(self, users, groups_info, permissions_info):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), StandInHandler
+        )
+        self.users = users
+        self.groups_info = groups_info
+        self.permissions_info = permissions_info
+
+    @property
+    def uri(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def answer(self, method, path, body):
+        """Return the (status, JSON encodable result) for a request."""
+        parts = [urllib.unquote(p) for p in path.strip('/').split('/')]
+        if method == 'POST' and parts == ['authenticate']:
+            details = json.loads(body)
+            user = self.users.get(details['username'])
+            return 200, bool(user and details['password'] == PASSWORD)
+
+        if method == 'GET' and len(parts) == 2:
+            kind, name = parts
+            if kind == 'users' and name in self.users:
+                return 200, self.users[name]
+            if kind == 'groups' and name == ORGANISATION:
+                return 200, self.groups_info
+            if kind == 'permissions' and name == ORGANISATION:
+                return 200, self.permissions_info
+
+        return 404, None
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _answer(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        status, result = self.server.answer(self.command, self.path, body)
+        content = json.dumps(result)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _answer
+    do_POST = _answer
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInUserServiceAPI(object):
+    """The api object of a StandInUserService, which makes the requests
+    through its own session as the real client's does.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri.rstrip('/')
+        self.session = requests.Session()
+
+    def authenticate(self, username, password):
+        response = self.session.post(
+            self.uri + '/authenticate',
+            data=json.dumps(dict(username=username, password=password)),
+        )
+        return response.json()
+
+    def get(self, username):
+        response = self.session.get(
+            self.uri + '/users/' + urllib.quote(username, safe='')
+        )
+        return response.json() if response.status_code == 200 else None
+
+
+class StandInUserService(object):
+    """Takes the place of pp.user.client.rest.UserService."""
+
+    def __init__(self, uri):
+        self.uri = uri.rstrip('/')
+        self.session = requests.Session()
+        self.api = StandInUserServiceAPI(uri)
+
+
+class StandInLatchPony(object):
+    """Takes the place of pp.latchpony.client.rest.LatchPonyService."""
+
+    def __init__(self, uri):
+        self.uri = uri.rstrip('/')
+        self.session = requests.Session()
+
+    def _get(self, kind, organisation):
+        response = self.session.get('%s/%s/%s' % (
+            self.uri, kind, urllib.quote(organisation, safe='')
+        ))
+        response.raise_for_status()
+        return response.json()
+
+    def groups_for(self, organisation):
+        return self._get('groups', organisation)
+
+    def perms_for(self, organisation):
+        return self._get('permissions', organisation)
+
+
+def generate(users, groups):
+    """Return made up (users, groups_info, permissions_info).
+
+    Every user is in the 'staff' group, which has the 'view' permission the
+    permission scenario checks, and one of the other groups.
+
+    """
+    generated = bench.generate_users(users)
+    users = {}
+    for username, _, firstname, lastname, email in generated:
+        # repoze.who 1.0's auth_tkt can't identify non-ASCII userids and
+        # the INI files can't list names with a '.':
+        username = username.decode('UTF-8').encode('ascii', 'ignore')
+        username = username.replace('.', '_')
+        users[username] = dict(
+            username=username,
+            display_name="%s %s" % (firstname, lastname),
+            email=email,
+        )
+
+    names = sorted(users)
+    groups_info = dict(
+        ('group%d' % g, names[g::groups]) for g in range(groups)
+    )
+    groups_info['staff'] = names
+    permissions_info = dict(
+        ('edit%d' % g, ['group%d' % g]) for g in range(groups)
+    )
+    permissions_info['view'] = ['staff']
+
+    return users, groups_info, permissions_info
+
+
+def write_files(tmpdir, users, password_hash, groups_info, permissions_info):
+    """Write the plain plugin's files, returning their settings."""
+    files = dict(
+        password_file=os.path.join(tmpdir, 'passwd.csv'),
+        groups_file=os.path.join(tmpdir, 'groups.ini'),
+        permissions_file=os.path.join(tmpdir, 'permissions.ini'),
+    )
+
+    with open(files['password_file'], 'w') as fd:
+        for username, details in sorted(users.items()):
+            firstname, lastname = details['display_name'].split(' ', 1)
+            fd.write("%s, %s, %s, %s, %s\n" % (
+                username, password_hash, firstname, lastname,
+                details['email'],
+            ))
+
+    for name, info in [('groups_file', groups_info),
+                       ('permissions_file', permissions_info)]:
+        with open(files[name], 'w') as fd:
+            for section, members in sorted(info.items()):
+                fd.write("[%s]\n%s\n\n" % (section, "\n".join(members)))
+
+    return dict(
+        ('pp.auth.plain.%s' % name, filename)
+        for name, filename in files.items()
+    )
+
+
+def settings_for(plugins, authenticator, access):
+    """Return the add_auth_from_config() settings for the plugins."""
+    return {
+        'pp.auth.cookie_name': COOKIE_NAME,
+        'pp.auth.cookie_secret': COOKIE_SECRET,
+        'pp.auth.login_url': '/login',
+        'pp.auth.login_handler_url': '/login_handler',
+        'pp.auth.plugins': '\n'.join(
+            'pp.auth.plugins.%s' % p for p in plugins
+        ),
+        'pp.auth.authenticators': authenticator,
+        'pp.auth.mdproviders': authenticator,
+        'pp.auth.groups': access,
+        'pp.auth.permissions': access,
+    }
+
+
+@contextlib.contextmanager
+def stack(plugin, tmpdir, users, groups_info, permissions_info, settings=()):
+    """Build the WSGI stack for a plugin, yielding the wrapped app.
+
+    :param settings: Extra settings, e.g. to turn on caches.
+
+    """
+    # Hash the one password up front with the configured scheme:
+    password_hash = str(pwtools.hash_password(PASSWORD))
+    files = write_files(
+        tmpdir, users, password_hash, groups_info, permissions_info
+    )
+    server = None
+    patches = []
+
+    if plugin == 'plain':
+        config = settings_for(['plain'], 'plain', 'plain')
+
+    elif plugin == 'sql':
+        from pp.db import dbsetup
+        from pp.auth.plugins.sql import user
+
+        dbsetup.init(
+            "sqlite:///%s" % os.path.join(tmpdir, 'users.db'),
+            use_transaction=False,
+        )
+        dbsetup.create()
+        user.bulk_add(
+            dict(
+                ((k, v.decode('UTF-8')) for k, v in details.items()),
+                password_hash=password_hash,
+            )
+            for details in users.values()
+        )
+        config = settings_for(['sql'], 'sql', 'sql')
+
+    elif plugin == 'userservice':
+        from pp.auth.plugins import userservice
+
+        server = StandInServer(users, groups_info, permissions_info)
+        patches.append(mock.patch.object(
+            userservice.rest, 'UserService', StandInUserService
+        ))
+        config = settings_for(['userservice', 'plain'], 'userservice', 'plain')
+        config['pp.auth.userservice.uri'] = server.uri
+
+    elif plugin == 'latchpony':
+        from pp.auth.plugins import latchpony
+
+        server = StandInServer(users, groups_info, permissions_info)
+        patches.append(mock.patch.object(
+            latchpony.rest, 'LatchPonyService', StandInLatchPony
+        ))
+        config = settings_for(['plain', 'latchpony'], 'plain', 'latchpony')
+        config['pp.auth.latchpony.uri'] = server.uri
+        config['pp.auth.latchpony.organisation'] = ORGANISATION
+
+    else:
+        raise ValueError("Unknown plugin: %r" % plugin)
+
+    config.update(files)
+    config.update(settings)
+
+    if server is not None:
+        worker = threading.Thread(target=server.serve_forever)
+        worker.daemon = True
+        worker.start()
+
+    try:
+        for patch in patches:
+            patch.start()
+        yield middleware.add_auth_from_config(app, config)
+
+    finally:
+        for patch in patches:
+            patch.stop()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+        from pp.auth.plugins import plain
+        plain._files.clear()
+        plain._access_files.clear()
+
+
+def make_environ(method='GET', path='/', cookie=None, form=None):
+    """Return a WSGI environ for a request."""
+    body = urllib.urlencode(form) if form else ''
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'HTTP_HOST': 'localhost',
+        'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    if form:
+        environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+        environ['CONTENT_LENGTH'] = str(len(body))
+    if cookie:
+        environ['HTTP_COOKIE'] = cookie
+    return environ
+
+
+def make_request(scenario, username, cookies):
+    """Return (environ, check) for a scenario's request, check being called
+    with the status and headers to decide if it succeeded.
+    """
+    if scenario == 'login':
+        environ = make_environ('POST', '/login_handler', form=dict(
+            login=username, password=PASSWORD, came_from='/',
+        ))
+
+        def check(status, headers):
+            return any(
+                name == 'Set-Cookie' and value.startswith(COOKIE_NAME + '=')
+                for name, value in headers
+            )
+
+    elif scenario == 'page':
+        environ = make_environ('GET', '/page', cookie=cookies[username])
+
+        def check(status, headers):
+            return status.startswith('200')
+
+    elif scenario == 'permission':
+        environ = make_environ('GET', '/admin', cookie=cookies[username])
+
+        def check(status, headers):
+            return status.startswith('200')
+
+    elif scenario == 'anonymous':
+        environ = make_environ('GET', '/public')
+
+        def check(status, headers):
+            return status.startswith('200')
+
+    else:
+        raise ValueError("Unknown scenario: %r" % scenario)
+
+    return environ, check
+
+
+def call(wsgi_app, environ):
+    """Make the request, returning (status, headers)."""
+    response = []
+
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+
+    body = wsgi_app(environ, start_response)
+    try:
+        for chunk in body:
+            pass
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return response[0], response[1]
+
+
+def percentile(ordered, fraction):
+    """The nearest rank percentile of a sorted list."""
+    if not ordered:
+        return 0.0
+    index = int(round(fraction * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(index, len(ordered) - 1))]
+
+
+def summarise(latencies, errors):
+    """Return the throughput and latency of a list of request seconds."""
+    ordered = sorted(latencies)
+    seconds = sum(ordered)
+    return dict(
+        requests=len(ordered),
+        errors=errors,
+        requests_per_second=len(ordered) / seconds if seconds else 0.0,
+        mean_ms=seconds * 1000 / len(ordered) if ordered else 0.0,
+        p50_ms=percentile(ordered, 0.50) * 1000,
+        p99_ms=percentile(ordered, 0.99) * 1000,
+    )
+
+
+def parse_mix(mix):
+    """Turn 'login=1,page=6' into {'login': 1, 'page': 6}."""
+    weights = {}
+    for item in mix.split(','):
+        scenario, weight = item.split('=')
+        scenario = scenario.strip()
+        if scenario not in SCENARIOS:
+            raise ValueError("Unknown scenario: %r" % scenario)
+        weights[scenario] = int(weight)
+    return weights
+
+
+def schedule(weights, requests, seed=1):
+    """Return a shuffled list of scenarios in proportion to their weights."""
+    scenarios = []
+    for scenario, weight in sorted(weights.items()):
+        scenarios.extend([scenario] * weight)
+    r = random.Random(seed)
+    return [r.choice(scenarios) for i in xrange(requests)]
+
+
+def replay(wsgi_app, usernames, weights, requests, warmup=50, seed=1):
+    """Send the traffic mix to the app.
+
+    :returns: The summarise() results for each scenario and in 'total'.
+
+    """
+    rememberer = AuthTktCookiePlugin(COOKIE_SECRET, COOKIE_NAME)
+    cookies = {}
+    for username in usernames:
+        # As the plugins give it, so the cookie isn't reissued each time:
+        headers = rememberer.remember(
+            make_environ(), {'repoze.who.userid': username.decode('UTF-8')}
+        )
+        cookies[username] = headers[0][1].split(';')[0]
+
+    r = random.Random(seed)
+    latencies = dict((s, []) for s in weights)
+    errors = dict((s, 0) for s in weights)
+
+    started = None
+    for i, scenario in enumerate(schedule(weights, warmup + requests, seed)):
+        if i == warmup:
+            started = time.time()
+
+        environ, check = make_request(scenario, r.choice(usernames), cookies)
+        start = time.time()
+        status, headers = call(wsgi_app, environ)
+        took = time.time() - start
+
+        if i >= warmup:
+            latencies[scenario].append(took)
+            if not check(status, headers):
+                errors[scenario] += 1
+
+    elapsed = time.time() - (started or time.time())
+    results = dict(
+        (s, summarise(latencies[s], errors[s])) for s in latencies
+    )
+    results['total'] = summarise(
+        sum(latencies.values(), []), sum(errors.values())
+    )
+    results['total']['requests_per_second'] = (
+        requests / elapsed if elapsed else 0.0
+    )
+    return results
+
+
+def run(plugins, users=1000, groups=50, requests=2000, warmup=50,
+        mix=DEFAULT_MIX, settings=()):
+    """Benchmark the stack for each plugin.
+
+    :returns: A dict of the replay() results (or why it was skipped) for
+        each plugin.
+
+    """
+    generated = generate(users, groups)
+    usernames = sorted(generated[0])
+    weights = parse_mix(mix)
+
+    results = {}
+    for plugin in plugins:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with stack(plugin, tmpdir, *generated, settings=settings) as wsgi:
+                results[plugin] = replay(
+                    wsgi, usernames, weights, requests, warmup
+                )
+
+        except ImportError, e:
+            results[plugin] = dict(skipped=str(e))
+
+        except Exception, e:
+            traceback.print_exc()
+            results[plugin] = dict(skipped="%s: %s" % (type(e).__name__, e))
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+    return results
+
+
+def version():
+    try:
+        return pkg_resources.get_distribution('pp-auth').version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def compare(previous, current, tolerance):
+    """Return a description of each p99 which got worse by more than the
+    tolerance (a fraction) between two runs.
+    """
+    regressions = []
+    for plugin, scenarios in sorted(current['results'].items()):
+        before = previous['results'].get(plugin, {})
+        for scenario, result in sorted(scenarios.items()):
+            if scenario not in before or 'p99_ms' not in result:
+                continue
+            old, new = before[scenario]['p99_ms'], result['p99_ms']
+            if old and new > old * (1 + tolerance):
+                regressions.append("%s %s p99 %.2fms -> %.2fms" % (
+                    plugin, scenario, old, new
+                ))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--plugins", default=",".join(PLUGINS))
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument(
+        "--mix", default=DEFAULT_MIX,
+        help="The weight of each scenario (default %(default)s).",
+    )
+    parser.add_argument(
+        "--set", action='append', default=[], metavar="KEY=VALUE",
+        help="An extra add_auth_from_config() setting, e.g. "
+        "pp.auth.metadata_cache=true. May be repeated.",
+    )
+    parser.add_argument("--output", help="Write the results here as JSON.")
+    parser.add_argument(
+        "--compare", help="The JSON results of an earlier run."
+    )
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    settings = dict(item.split('=', 1) for item in args.set)
+    previous = None
+    if args.compare:
+        with open(args.compare) as fd:
+            previous = json.load(fd)
+
+    report = dict(
+        version=version(),
+        python=sys.version.split()[0],
+        created=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        options=dict(
+            users=args.users, groups=args.groups, requests=args.requests,
+            warmup=args.warmup, mix=args.mix, settings=settings,
+        ),
+        results=run(
+            [p.strip() for p in args.plugins.split(',')],
+            args.users, args.groups, args.requests, args.warmup, args.mix,
+            settings,
+        ),
+    )
+
+    for plugin, scenarios in sorted(report['results'].items()):
+        if 'skipped' in scenarios:
+            print "%-12s skipped: %s" % (plugin, scenarios['skipped'])
+            continue
+        for scenario in SCENARIOS + ('total',):
+            if scenario not in scenarios:
+                continue
+            r = scenarios[scenario]
+            print (
+                "%-12s %-10s requests=%-6d errors=%-4d req/sec=%-8.1f "
+                "p50=%.2fms p99=%.2fms" % (
+                    plugin, scenario, r['requests'], r['errors'],
+                    r['requests_per_second'], r['p50_ms'], r['p99_ms'],
+                )
+            )
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+
+    if previous is not None:
+        regressions = compare(previous, report, args.tolerance)
+        for regression in regressions:
+            print "REGRESSION: %s" % regression
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
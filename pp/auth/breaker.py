@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Stop calling a remote service that keeps failing, for a while.
+
+A CircuitBreaker wraps the calls to one service. While it is closed calls
+go through. After failures consecutive errors it opens and every call
+fails straight away with CircuitOpenError, rather than waiting on a
+service that is down. Once reset_timeout seconds have passed it is
+half-open: one trial call goes through, closing the breaker if it works
+and opening it again if not.
+
+The plugins take their breaker settings from their own prefix, e.g.::
+
+    pp.auth.userservice.breaker = true
+    pp.auth.userservice.breaker_failures = 5
+    pp.auth.userservice.breaker_reset_timeout = 30
+
+Every state change is logged and counted, see CircuitBreaker.stats().
+
+"""
+import time
+import logging
+import threading
+
+from pp.auth import config
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# The stats() count of the times each state was entered:
+ENTERED = {CLOSED: 'closed', OPEN: 'opened', HALF_OPEN: 'half_opened'}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose breaker is open."""
+
+
+class CircuitBreaker(object):
+    """Fail fast while a remote service is failing."""
+
+    def __init__(
+        self, name, failures=5, reset_timeout=30, errors=(Exception,),
+        clock=time.time,
+    ):
+        """
+        :param name: The service, used in logging.
+
+        :param failures: The consecutive errors which open the breaker.
+
+        :param reset_timeout: The seconds the breaker stays open before a
+            trial call is allowed.
+
+        :param errors: The exceptions which count as the service failing.
+            Any other exception is raised without affecting the breaker,
+            which stays half-open if it was a trial call.
+
+        :param clock: Returns the current time in seconds (for testing).
+
+        """
+        self.log = get_log("CircuitBreaker")
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.errors = errors
+        self.clock = clock
+        self.state = CLOSED
+        self._failed = 0
+        self._opened = 0
+        self._trial = False
+        self._lock = threading.Lock()
+        self._counts = dict(
+            calls=0, errors=0, rejected=0, opened=0, half_opened=0, closed=0,
+        )
+
+    def _change(self, state):
+        """Move to the new state, holding the lock."""
+        self.log.warn("%s: circuit %s -> %s" % (self.name, self.state, state))
+        self.state = state
+        self._counts[ENTERED[state]] += 1
+        if state == OPEN:
+            self._opened = self.clock()
+
+    def _before(self):
+        """Check a call may be made, holding the lock.
+
+        :returns: True if the call is the half-open trial.
+
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if self.clock() - self._opened < self.reset_timeout:
+                    self._counts['rejected'] += 1
+                    raise CircuitOpenError("%s is unavailable." % self.name)
+                self._change(HALF_OPEN)
+
+            if self.state == HALF_OPEN:
+                if self._trial:
+                    # Only the one trial call while half-open:
+                    self._counts['rejected'] += 1
+                    raise CircuitOpenError("%s is unavailable." % self.name)
+                self._trial = True
+                self._counts['calls'] += 1
+                return True
+
+            self._counts['calls'] += 1
+            return False
+
+    def _after(self, failed, trial):
+        """Record a call's outcome, holding the lock.
+
+        :param failed: True if the service failed, False if it worked or
+            None if it can't tell (the breaker's state is left as it is).
+
+        :param trial: True if this was the half-open trial call, as returned
+            by _before(). A call started before the breaker opened has no
+            say over the trial in progress.
+
+        """
+        with self._lock:
+            if trial:
+                self._trial = False
+            if failed is None:
+                # A half-open breaker allows another trial call:
+                return
+            if failed:
+                self._counts['errors'] += 1
+                self._failed += 1
+                if trial or (
+                    self.state == CLOSED and self._failed >= self.failures
+                ):
+                    self._change(OPEN)
+            else:
+                self._failed = 0
+                if trial:
+                    self._change(CLOSED)
+
+    def call(self, fn, *args, **kwargs):
+        """Call fn unless the breaker is open.
+
+        :raises: CircuitOpenError if the breaker is open.
+
+        """
+        trial = self._before()
+        try:
+            result = fn(*args, **kwargs)
+        except self.errors:
+            self._after(True, trial)
+            raise
+        except:
+            self._after(None, trial)
+            raise
+        self._after(False, trial)
+        return result
+
+    def stats(self):
+        """Return the 'state' and the counts of 'calls' made, 'errors',
+        calls 'rejected' and the times it 'opened', 'half_opened' and
+        'closed'.
+        """
+        with self._lock:
+            counts = dict(self._counts)
+            counts['state'] = self.state
+        return counts
+
+
+# The breakers the plugins share, by name, so the plugins built for each
+# service (authenticator, mdprovider, adapters) trip together:
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker_from_config(settings, prefix, name, errors=(Exception,)):
+    """Return the CircuitBreaker for a service if enabled in the settings.
+
+    The settings recognised, with the plugin's prefix e.g.
+    pp.auth.userservice.::
+
+        # Optional, these are the defaults:
+        pp.auth.userservice.breaker = true
+        pp.auth.userservice.breaker_failures = 5
+        pp.auth.userservice.breaker_reset_timeout = 30
+
+    :param name: The service, e.g. its URI. Plugins asking for the same name
+        share the one breaker, made with the settings of the first to ask.
+        A warning is logged if a later plugin's settings differ.
+
+    :param errors: See CircuitBreaker.
+
+    :returns: None if it was turned off.
+
+    """
+    if not config.get_bool(settings, '%sbreaker' % prefix, True):
+        return None
+
+    failures = config.get_int(settings, '%sbreaker_failures' % prefix, 5)
+    reset_timeout = config.get_float(
+        settings, '%sbreaker_reset_timeout' % prefix, 30
+    )
+
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(
+                name, failures, reset_timeout, errors
+            )
+        elif (
+            (breaker.failures, breaker.reset_timeout, tuple(breaker.errors))
+            != (failures, reset_timeout, tuple(errors))
+        ):
+            get_log("get_breaker_from_config").warn(
+                "%s: ignoring %sbreaker settings failures<%s> "
+                "reset_timeout<%s> errors<%s>, the shared breaker has "
+                "failures<%s> reset_timeout<%s> errors<%s>." % (
+                    name, prefix, failures, reset_timeout, errors,
+                    breaker.failures, breaker.reset_timeout, breaker.errors,
+                )
+            )
+    return breaker
@@ -0,0 +1,586 @@
+# -*- coding: utf-8 -*-
+"""
+Small in-process caches used by the plugins to avoid repeating expensive
+work (password hashing, remote look ups) on every request.
+
+"""
+import os
+import hmac
+import math
+import time
+import hashlib
+import logging
+import weakref
+import threading
+from collections import OrderedDict
+
+from pp.auth import config
+from pp.auth import pwtools
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+class TTLCache(object):
+    """A thread safe, size bounded cache whose entries expire.
+
+    When the cache is full the least recently used entry is evicted to make
+    room for the new one. Expired entries are removed when they are next
+    looked up.
+
+    """
+    def __init__(self, max_size=1000, ttl=300, clock=time.time):
+        """
+        :param max_size: The maximum number of entries to hold.
+
+        :param ttl: The default seconds an entry lives for.
+
+        :param clock: Returns the current time in seconds (for testing).
+
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1!")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """Return the live value for key or default if absent/expired."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires, value = entry
+            if expires <= self.clock():
+                self.misses += 1
+                return default
+
+            # Re-insert to mark it as most recently used:
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store value for key, evicting the least recently used if full.
+
+        :param ttl: Override the default ttl for this entry.
+
+        """
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            self._data[key] = (self.clock() + ttl, value)
+
+    def pop(self, key, default=None):
+        """Remove key returning its value (expired or not) or default."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Return a dict of the hits, misses, evictions and current size."""
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                size=len(self._data),
+            )
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > self.clock()
+
+
+class CredentialCache(object):
+    """Remember the credentials which recently passed validation so repeat
+    logins can skip the expensive password hash verification.
+
+    The plain text password is never stored. Entries are keyed on the
+    username and hold the stored password hash together with a keyed HMAC
+    of the plain text password. The HMAC key is random per process and never
+    leaves memory.
+
+    If the stored password hash changes (e.g. the password was updated) the
+    cached entry no longer matches and a full verification is done, which
+    replaces the stale entry.
+
+    """
+    def __init__(self, max_size=10000, ttl=300, secret=None):
+        """
+        :param max_size: The maximum number of verified users to remember.
+
+        :param ttl: The seconds a verified credential is remembered for.
+
+        :param secret: The HMAC key. A random one is generated by default.
+
+        """
+        self.secret = secret or os.urandom(32)
+        self._cache = TTLCache(max_size, ttl)
+
+    def _digest(self, plaintext_password):
+        if isinstance(plaintext_password, unicode):
+            plaintext_password = plaintext_password.encode('UTF-8')
+        return hmac.new(
+            self.secret, plaintext_password, hashlib.sha256
+        ).digest()
+
+    def validate(self, username, plaintext_password, password_hash):
+        """Check the password, only using pwtools.validate_password if this
+        credential hasn't been verified recently.
+
+        :param username: The user the password_hash belongs to.
+
+        :param plaintext_password: The password the user gave.
+
+        :param password_hash: The stored password hash for the user.
+
+        :return: Whether the password is valid.
+
+        """
+        digest = self._digest(plaintext_password)
+
+        entry = self._cache.get(username)
+        if entry is not None:
+            cached_hash, cached_digest = entry
+            if cached_hash == password_hash and hmac.compare_digest(
+                cached_digest, digest
+            ):
+                return True
+
+        is_valid = pwtools.validate_password(plaintext_password, password_hash)
+        if is_valid:
+            self._cache.set(username, (password_hash, digest))
+
+        return is_valid
+
+    def invalidate(self, username):
+        """Forget any verified credential for the given username."""
+        self._cache.pop(username)
+
+    def clear(self):
+        """Forget all verified credentials."""
+        self._cache.clear()
+
+    def stats(self):
+        """Return the hit/miss counters of the underlying cache."""
+        return self._cache.stats()
+
+
+def get_credential_cache_from_config(settings, prefix):
+    """Return a CredentialCache if it has been enabled in the settings.
+
+    The settings recognised are (for prefix 'pp.auth.plain.')::
+
+        pp.auth.plain.credential_cache = true
+        pp.auth.plain.credential_cache_size = 10000
+        pp.auth.plain.credential_cache_ttl = 300
+
+    :returns: None if the cache was not enabled.
+
+    """
+    if not config.get_bool(settings, '%scredential_cache' % prefix):
+        return None
+
+    max_size = config.get_int(
+        settings, '%scredential_cache_size' % prefix, 10000
+    )
+    ttl = config.get_float(settings, '%scredential_cache_ttl' % prefix, 300)
+    get_log("get_credential_cache_from_config").info(
+        "%scredential_cache enabled: max_size<%s> ttl<%s>" % (
+            prefix, max_size, ttl
+        )
+    )
+
+    return CredentialCache(max_size, ttl)
+
+
+class _PendingLoad(object):
+    """The outcome of a RefreshingCache loader call others are waiting on."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class RefreshingCache(object):
+    """Cache the values a loader recovers (e.g. from a remote service).
+
+    Values are served from the cache for ttl seconds. In the last
+    refresh_ahead seconds before they expire a background thread reloads
+    them, so busy keys are refreshed without a request having to wait.
+
+    An expired value no more than stale_ttl seconds past its expiry is
+    served at once while it is reloaded in the background
+    (stale-while-revalidate). A request only waits for the loader when there
+    is no usable value, and then concurrent requests for the same key share
+    the one loader call.
+
+    """
+    def __init__(
+        self, loader, ttl=30, refresh_ahead=5, stale_ttl=300,
+        errors=(Exception,), clock=time.time
+    ):
+        """
+        :param loader: Called with the key to recover a fresh value.
+
+        :param ttl: The seconds a loaded value is fresh for.
+
+        :param refresh_ahead: The seconds before expiry to start reloading in
+            the background.
+
+        :param stale_ttl: The seconds after expiry a value is still served
+            while it is reloaded in the background.
+
+        :param errors: The loader exceptions counted as failures. A
+            background refresh which fails with one of these is logged and
+            the current value kept. Any other exception is raised.
+
+        :param clock: Returns the current time in seconds (for testing).
+
+        """
+        self.loader = loader
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.stale_ttl = stale_ttl
+        self.errors = errors
+        self.clock = clock
+        self.log = get_log("RefreshingCache")
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+        self.stale = 0
+        # key: (time loaded, value)
+        self._entries = {}
+        self._refreshing = set()
+        # key: _PendingLoad shared by the requests waiting for the loader
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        """Return the cached value for key, loading it if needed.
+
+        :raises: the loader's exception if there is no usable value and it
+            could not be loaded.
+
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = self.clock() - entry[0]
+            if age < self.ttl:
+                self._count('hits')
+                if age >= self.ttl - self.refresh_ahead:
+                    self.refresh_in_background(key)
+                return entry[1]
+
+            if age < self.ttl + self.stale_ttl:
+                self._count('stale')
+                self.refresh_in_background(key)
+                return entry[1]
+
+        self._count('misses')
+        try:
+            return self._load(key)
+
+        except self.errors:
+            self._count('failures')
+            raise
+
+    def _load(self, key):
+        """Call the loader and cache its value. Only one call is made at a
+        time per key, any other caller waits for it and shares its result.
+        """
+        with self._lock:
+            pending = self._loading.get(key)
+            loading = pending is None
+            if loading:
+                pending = self._loading[key] = _PendingLoad()
+
+        if not loading:
+            return pending.result()
+
+        try:
+            value = self.loader(key)
+            with self._lock:
+                self._entries[key] = (self.clock(), value)
+            pending.value = value
+            return value
+
+        except BaseException as e:
+            pending.error = e
+            raise
+
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            pending.done.set()
+
+    def refresh_in_background(self, key):
+        """Reload the key in a background thread.
+
+        :returns: The thread or None if the key is already being refreshed.
+
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return None
+            self._refreshing.add(key)
+
+        thread = threading.Thread(
+            target=self._refresh, args=(key,),
+            name="RefreshingCache(%s)" % (key,)
+        )
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _refresh(self, key):
+        try:
+            self._load(key)
+            self._count('refreshes')
+
+        except self.errors:
+            # The current value is served until it goes stale:
+            self._count('failures')
+            self.log.exception("background refresh failed for <%s>" % (key,))
+
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def invalidate(self, key):
+        """Forget the value for key so the next get() loads it."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget all values."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dict of the hit, miss, refresh, failure and stale
+        counters and the current size.
+        """
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                refreshes=self.refreshes,
+                failures=self.failures,
+                stale=self.stale,
+                size=len(self._entries),
+            )
+
+
+class MemcacheBackend(object):
+    """Share cached values between processes (and machines) via memcached.
+
+    This needs the python-memcached package.
+
+    """
+    def __init__(self, servers, prefix='pp.auth.'):
+        """
+        :param servers: A list of 'host:port' memcached servers.
+
+        :param prefix: Prepended to every key stored.
+
+        """
+        import memcache
+
+        self.prefix = prefix
+        self.client = memcache.Client(servers)
+
+    def _key(self, key):
+        # memcached keys can't have spaces or control characters:
+        return self.prefix + hashlib.sha1(repr(key)).hexdigest()
+
+    def get(self, key):
+        return self.client.get(self._key(key))
+
+    def set(self, key, value, ttl):
+        self.client.set(self._key(key), value, time=int(math.ceil(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+
+# Every MetadataCache, so invalidate_metadata() can reach them all:
+_metadata_caches = weakref.WeakSet()
+
+# The namespaces the plugins cache metadata under. These are invalidated
+# even by a process which hasn't cached anything itself (e.g. an admin
+# tool), as other processes may have cached them in the shared backend:
+METADATA_NAMESPACES = ('sql', 'userservice', 'usmb')
+
+# Never cached, as the backend may be shared with other services:
+UNCACHED_FIELDS = ('password_hash',)
+
+
+class MetadataCache(object):
+    """Cache the metadata the mdproviders add to the identity, to save
+    recovering it from the database / remote service on every request.
+
+    Each plugin stores its metadata under its own namespace. Entries live for
+    ttl seconds or until invalidate_metadata() is called for the user, which
+    the SQL user API does when a user is updated or removed.
+
+    An optional backend (e.g. MemcacheBackend) shares entries between
+    processes. Invalidation then reaches every process via the backend,
+    and this process's copy is only trusted for local_ttl seconds. The
+    UNCACHED_FIELDS (the password hash) are left out of what is stored.
+
+    """
+    def __init__(self, max_size=10000, ttl=60, backend=None, local_ttl=5):
+        """
+        :param max_size: The maximum users held in this process.
+
+        :param ttl: The seconds metadata is cached for.
+
+        :param backend: An optional shared store with get(key),
+            set(key, value, ttl) and delete(key) methods.
+
+        :param local_ttl: The seconds metadata is held in this process when
+            there is a backend.
+
+        """
+        self.ttl = ttl
+        self.backend = backend
+        if backend is not None:
+            local_ttl = min(ttl, local_ttl)
+        else:
+            local_ttl = ttl
+        self._local = TTLCache(max_size, local_ttl)
+        self._namespaces = set()
+        _metadata_caches.add(self)
+
+    def get(self, namespace, userid):
+        """Return the cached metadata dict or None."""
+        key = (namespace, userid)
+        metadata = self._local.get(key)
+        if metadata is None and self.backend is not None:
+            metadata = self.backend.get(key)
+            if metadata is not None:
+                self._local.set(key, metadata)
+        return metadata
+
+    def set(self, namespace, userid, metadata):
+        """Cache the metadata dict for the user."""
+        key = (namespace, userid)
+        self._namespaces.add(namespace)
+        if any(name in metadata for name in UNCACHED_FIELDS):
+            metadata = dict(
+                (name, value) for name, value in metadata.items()
+                if name not in UNCACHED_FIELDS
+            )
+        self._local.set(key, metadata)
+        if self.backend is not None:
+            self.backend.set(key, metadata, self.ttl)
+
+    def invalidate(self, userid):
+        """Forget the metadata for the user in every namespace."""
+        namespaces = set(METADATA_NAMESPACES) | self._namespaces
+        for namespace in namespaces:
+            key = (namespace, userid)
+            self._local.pop(key)
+            if self.backend is not None:
+                self.backend.delete(key)
+
+    def clear(self):
+        """Forget everything held in this process."""
+        self._local.clear()
+
+    def stats(self):
+        """Return the hit/miss counters of this process's cache."""
+        return self._local.stats()
+
+
+def invalidate_metadata(userid):
+    """Forget the cached metadata for the user in every MetadataCache.
+
+    Call this whenever a user's details change or the user is removed. A
+    process which changes users must have the shared metadata cache
+    configured (see get_metadata_cache_from_config) for this to reach the
+    other processes through memcached.
+
+    """
+    for metadata_cache in list(_metadata_caches):
+        metadata_cache.invalidate(userid)
+
+
+# The MetadataCache the plugins share keyed on its configuration:
+_shared_metadata_cache = {}
+
+
+def get_metadata_cache_from_config(settings, prefix="pp.auth."):
+    """Return the MetadataCache all plugins share, if enabled in the settings.
+
+    The settings recognised are::
+
+        pp.auth.metadata_cache = true
+        pp.auth.metadata_cache_size = 10000
+        pp.auth.metadata_cache_ttl = 60
+
+        # Optional sharing between processes:
+        pp.auth.metadata_cache_memcache = 127.0.0.1:11211
+        pp.auth.metadata_cache_local_ttl = 5
+
+    :returns: None if the cache was not enabled.
+
+    """
+    if not config.get_bool(settings, '%smetadata_cache' % prefix):
+        return None
+
+    cache_config = (
+        config.get_int(settings, '%smetadata_cache_size' % prefix, 10000),
+        config.get_float(settings, '%smetadata_cache_ttl' % prefix, 60),
+        tuple(config.get_list(settings, '%smetadata_cache_memcache' % prefix)),
+        config.get_float(settings, '%smetadata_cache_local_ttl' % prefix, 5),
+    )
+
+    # Plugins built from the same settings share the one cache:
+    metadata_cache = _shared_metadata_cache.get(cache_config)
+    if metadata_cache is None:
+        max_size, ttl, servers, local_ttl = cache_config
+        backend = MemcacheBackend(list(servers), prefix) if servers else None
+        metadata_cache = MetadataCache(max_size, ttl, backend, local_ttl)
+        _shared_metadata_cache[cache_config] = metadata_cache
+        get_log("get_metadata_cache_from_config").info(
+            "metadata cache enabled: max_size<%s> ttl<%s> memcache<%s>" % (
+                max_size, ttl, servers
+            )
+        )
+
+    return metadata_cache
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+The pp-auth-calibrate command.
+
+This measures how long a password verification takes on this machine and
+suggests the rounds to configure so logins hit a target latency. E.g.::
+
+    $ pp-auth-calibrate --scheme sha512_crypt --target-ms 100
+    # sha512_crypt: 85000 rounds takes 99.6ms per verify on this host.
+    pp.auth.pwtools.sha512_crypt__default_rounds = 85000
+
+Run it on the hardware the web application is deployed to.
+
+"""
+import sys
+import logging
+import argparse
+
+from pp.auth import pwtools
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+def main(argv=None):
+    """Entry point for the pp-auth-calibrate console script."""
+    parser = argparse.ArgumentParser(
+        description="Pick password hash rounds for a target verify latency."
+    )
+    parser.add_argument(
+        "--scheme", default=pwtools.DEFAULT_SCHEMES[0],
+        help="The passlib scheme to calibrate (default: %(default)s)."
+    )
+    parser.add_argument(
+        "--target-ms", type=float, default=250.0,
+        help="Milliseconds a single verify should take (default: %(default)s)."
+    )
+    parser.add_argument(
+        "--samples", type=int, default=5,
+        help="Verifications to average per measurement (default: %(default)s)."
+    )
+    parser.add_argument(
+        "--prefix", default="pp.auth.pwtools.",
+        help="The settings prefix to print (default: %(default)s)."
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARN)
+
+    try:
+        rounds, taken = pwtools.calibrate(
+            args.scheme, args.target_ms, args.samples
+        )
+
+    except ValueError, e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+
+    print "# %s: %d rounds takes %.1fms per verify on this host." % (
+        args.scheme, rounds, taken
+    )
+    print "%s%s__default_rounds = %d" % (args.prefix, args.scheme, rounds)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to recover typed values from the settings dict given to
+add_auth_from_config() and the plugin get_*_from_config() functions.
+
+Settings usually come from an ini file so every value is a string. These
+helpers convert them, falling back to the given default if the setting is
+not present.
+
+"""
+
+TRUTHY = frozenset(('true', 'yes', 'on', 'y', 't', '1'))
+
+
+def asbool(value):
+    """Convert a settings value into a bool.
+
+    :param value: a bool, None or a string like 'true', 'yes', 'on', '1'.
+
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower() in TRUTHY
+    return bool(value)
+
+
+def get_bool(settings, key, default=False):
+    """Return the bool value of settings[key] or default if not present."""
+    if key not in settings:
+        return default
+    return asbool(settings[key])
+
+
+def get_int(settings, key, default=None):
+    """Return the int value of settings[key] or default if not present."""
+    value = settings.get(key)
+    if value is None or (isinstance(value, basestring) and not value.strip()):
+        return default
+    return int(value)
+
+
+def get_float(settings, key, default=None):
+    """Return the float value of settings[key] or default if not present."""
+    value = settings.get(key)
+    if value is None or (isinstance(value, basestring) and not value.strip()):
+        return default
+    return float(value)
+
+
+def get_list(settings, key, default=()):
+    """Return settings[key] split on commas and/or new lines.
+
+    Empty entries are ignored. If the key is not present then default is
+    returned as a list.
+
+    """
+    value = settings.get(key)
+    if value is None:
+        return list(default)
+    if not isinstance(value, basestring):
+        return list(value)
+    items = value.replace('\n', ',').split(',')
+    return [i.strip() for i in items if i.strip()]
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Time every call pp.auth makes to its plugins and count the outcomes.
+
+build_plugins() wraps each authenticator, mdprovider, group and permission
+adapter when this is enabled in the add_auth_from_config() settings::
+
+    pp.auth.instrument = true
+
+    # Optional: serve the metrics in the Prometheus text format, ahead of
+    # (and without) authentication. Restrict access to it elsewhere:
+    pp.auth.metrics_path = /metrics
+
+For each plugin call a latency histogram and the number of calls with each
+outcome are kept:
+
+- success: authenticate() returned a userid, find_sections() found
+  sections or add_metadata() returned.
+- failure: authenticate() or find_sections() found nothing.
+- error: the call raised an exception.
+
+The metrics are available from snapshot() and render(). Nothing is wrapped
+(or measured) when it is disabled.
+
+"""
+import bisect
+import logging
+import threading
+from timeit import default_timer
+
+from zope.interface import implements
+from repoze.who.interfaces import IAuthenticator
+from repoze.who.interfaces import IMetadataProvider
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# The histogram bucket upper bounds in seconds:
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0,
+)
+
+OUTCOMES = ('success', 'failure', 'error')
+
+
+class CallMetrics(object):
+    """The latency histogram and outcome counts of one plugin method."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.outcomes = dict((o, 0) for o in OUTCOMES)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, outcome):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += seconds
+            self.outcomes[outcome] += 1
+
+    def snapshot(self):
+        """Return the 'buckets' as cumulative (upper bound, count) pairs,
+        the 'sum' of seconds, the 'count' of calls and the 'outcomes'.
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total = self.total
+            outcomes = dict(self.outcomes)
+
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            running += count
+            cumulative.append((bound, running))
+
+        return dict(
+            buckets=cumulative, sum=total, count=running, outcomes=outcomes,
+        )
+
+
+class MetricsRegistry(object):
+    """The CallMetrics of every instrumented plugin method."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def metrics_for(self, plugin_type, plugin_id, method):
+        """Return the CallMetrics for the plugin method, creating it."""
+        key = (plugin_type, plugin_id, method)
+        with self._lock:
+            metrics = self._metrics.get(key)
+            if metrics is None:
+                metrics = self._metrics[key] = CallMetrics(self.buckets)
+        return metrics
+
+    def snapshot(self):
+        """Return {(plugin_type, plugin_id, method): snapshot} where each
+        snapshot is a CallMetrics.snapshot().
+        """
+        with self._lock:
+            items = self._metrics.items()
+        return dict((key, metrics.snapshot()) for key, metrics in items)
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        snapshot = sorted(self.snapshot().items())
+        lines = [
+            "# HELP pp_auth_plugin_call_seconds Time taken by pp.auth "
+            "plugin calls.",
+            "# TYPE pp_auth_plugin_call_seconds histogram",
+        ]
+        for key, metrics in snapshot:
+            labels = _labels(key)
+            for bound, count in metrics['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('pp_auth_plugin_call_seconds_bucket{%s,le="%s"} '
+                             '%d' % (labels, le, count))
+            lines.append('pp_auth_plugin_call_seconds_sum{%s} %r' % (
+                labels, metrics['sum']
+            ))
+            lines.append('pp_auth_plugin_call_seconds_count{%s} %d' % (
+                labels, metrics['count']
+            ))
+
+        lines.extend([
+            "# HELP pp_auth_plugin_calls_total pp.auth plugin calls by "
+            "outcome.",
+            "# TYPE pp_auth_plugin_calls_total counter",
+        ])
+        for key, metrics in snapshot:
+            labels = _labels(key)
+            for outcome in OUTCOMES:
+                lines.append('pp_auth_plugin_calls_total{%s,outcome="%s"} '
+                             '%d' % (labels, outcome,
+                                     metrics['outcomes'][outcome]))
+
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'
+    )
+
+
+def _labels(key):
+    plugin_type, plugin_id, method = key
+    return 'type="%s",plugin="%s",method="%s"' % (
+        _escape(plugin_type), _escape(plugin_id), _escape(method)
+    )
+
+
+# The registry build_plugins() records into:
+REGISTRY = MetricsRegistry()
+
+
+def snapshot():
+    """Return the metrics of every instrumented plugin, see
+    MetricsRegistry.snapshot().
+    """
+    return REGISTRY.snapshot()
+
+
+def render():
+    """Return the metrics in the Prometheus text format."""
+    return REGISTRY.render()
+
+
+def _timed(metrics, call, args, truthy):
+    """Call and record how long it took and its outcome.
+
+    :param truthy: If True a falsy result is a failure.
+
+    """
+    start = default_timer()
+    try:
+        result = call(*args)
+    except:
+        metrics.observe(default_timer() - start, 'error')
+        raise
+    outcome = 'success' if result or not truthy else 'failure'
+    metrics.observe(default_timer() - start, outcome)
+    return result
+
+
+class InstrumentedPlugin(object):
+    """Passes everything through to the plugin."""
+
+    def __init__(self, plugin, metrics):
+        self.plugin = plugin
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.plugin, name)
+
+
+class InstrumentedAuthenticator(InstrumentedPlugin):
+    implements(IAuthenticator)
+
+    # IAuthenticator
+    def authenticate(self, environ, identity):
+        return _timed(
+            self.metrics, self.plugin.authenticate, (environ, identity), True
+        )
+
+
+class InstrumentedMetadataProvider(InstrumentedPlugin):
+    implements(IMetadataProvider)
+
+    # IMetadataProvider
+    def add_metadata(self, environ, identity):
+        return _timed(
+            self.metrics, self.plugin.add_metadata, (environ, identity), False
+        )
+
+
+class InstrumentedAdapter(InstrumentedPlugin):
+    """A repoze.what group or permission adapter."""
+
+    def find_sections(self, hint):
+        return _timed(self.metrics, self.plugin.find_sections, (hint,), True)
+
+
+INSTRUMENTED = {
+    'authenticators': (InstrumentedAuthenticator, 'authenticate'),
+    'mdproviders': (InstrumentedMetadataProvider, 'add_metadata'),
+    'groups': (InstrumentedAdapter, 'find_sections'),
+    'permissions': (InstrumentedAdapter, 'find_sections'),
+}
+
+
+def wrap(plugin_type, plugin_id, plugin, registry=None):
+    """Return the plugin wrapped to record its calls in the registry
+    (REGISTRY by default).
+    """
+    registry = REGISTRY if registry is None else registry
+    cls, method = INSTRUMENTED[plugin_type]
+    return cls(plugin, registry.metrics_for(plugin_type, plugin_id, method))
+
+
+class MetricsMiddleware(object):
+    """Serve the metrics at a path, passing other requests to the app."""
+
+    def __init__(self, app, path='/metrics', registry=None):
+        self.app = app
+        self.path = path
+        self.registry = REGISTRY if registry is None else registry
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != self.path:
+            return self.app(environ, start_response)
+
+        body = self.registry.render()
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
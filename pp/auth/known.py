@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+Reject logins for usernames that don't exist without asking the database
+or remote user service.
+
+KnownUsers holds a Bloom filter of every username, loaded from the plugin's
+user store, and a short lived cache of usernames recently found not to
+exist. A username the filter has never seen is certainly unknown; one it
+has seen is probably known (see error_rate) and is looked up as usual.
+
+The filter is loaded in a background thread on first use and reloaded
+every rebuild_interval seconds, which also drops removed users. Until it
+has loaded every login is looked up as usual. The SQL user API keeps it up
+to date in between through user_added() and user_removed().
+
+Only the process adding a user hears of it straight away. Other processes
+(and other machines) would reject the new user's logins until their next
+reload. To avoid this a KnownUsers is given a version: a cheap marker of
+the user store's contents, checked at most every version_ttl seconds. A
+login is only rejected while the marker is the one the filter was loaded
+with. Once it changes logins are looked up as usual, the negative cache is
+dropped and the filter is reloaded.
+
+"""
+import os
+import math
+import time
+import struct
+import hashlib
+import logging
+import weakref
+import threading
+
+from pp.auth import cache
+from pp.auth import config
+from pp.auth import pwtools
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+class BloomFilter(object):
+    """A set of strings which can answer "definitely not present" or
+    "probably present" in little memory.
+    """
+    def __init__(self, capacity=100000, error_rate=0.01):
+        """
+        :param capacity: The number of items expected.
+
+        :param error_rate: The chance a missing item is reported present
+            once capacity items have been added.
+
+        """
+        capacity = max(1, capacity)
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        ))
+        self.hashes = max(1, int(round(
+            float(self.size) / capacity * math.log(2)
+        )))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('UTF-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.size for i in xrange(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+# Every KnownUsers, so user_added() and user_removed() can reach them:
+_known_users = weakref.WeakSet()
+
+
+class KnownUsers(object):
+    """Decide whether a login's username certainly doesn't exist."""
+
+    def __init__(
+        self, loader, source, capacity=100000, error_rate=0.01,
+        negative_ttl=30, negative_size=10000, rebuild_interval=300,
+        dummy_verify=True, version=None, version_ttl=5,
+    ):
+        """
+        :param loader: Called with no arguments to return an iterable of
+            every username.
+
+        :param source: The user store the usernames come from, e.g. 'sql',
+            see user_added().
+
+        :param capacity: The usernames the filter is sized for. It grows to
+            twice the number loaded if there are more.
+
+        :param error_rate: The chance an unknown username is looked up.
+
+        :param negative_ttl: The seconds a username found not to exist is
+            remembered.
+
+        :param negative_size: The most such usernames remembered.
+
+        :param rebuild_interval: The seconds between reloads of the filter.
+
+        :param dummy_verify: If True reject() takes as long as verifying a
+            password (see pwtools.dummy_validate). If False it takes as long
+            as the lookups given to observe() do on average.
+
+        :param version: Called with no arguments to return a marker which
+            changes when the user store does. None means the store can't be
+            trusted, so nothing is rejected. If no version is given only the
+            changes made through user_added() are noticed.
+
+        :param version_ttl: The seconds a version is reused for.
+
+        """
+        self.log = get_log("KnownUsers")
+        self.loader = loader
+        self.source = source
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.dummy_verify = dummy_verify
+        self.version = version
+        self.version_ttl = version_ttl
+        self.negative = cache.TTLCache(negative_size, negative_ttl)
+        self.filter = None
+        self.built = 0
+        self.built_version = None
+        # The latest (version, when it was recovered):
+        self._version = None
+        # The average seconds a lookup takes, see observe():
+        self.latency = None
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        # The usernames added while a rebuild is loading:
+        self._added = None
+        self._counts = dict(
+            filtered=0, negative=0, passed=0, stale=0, rebuilds=0,
+        )
+        _known_users.add(self)
+
+    def _count(self, counter):
+        with self._lock:
+            self._counts[counter] += 1
+
+    def rebuild(self):
+        """Load every username into a new filter and replace the current
+        one with it.
+        """
+        start = time.time()
+        with self._lock:
+            self._added = []
+
+        try:
+            # Recovered first so changes made while loading are noticed:
+            version = self.version() if self.version is not None else None
+            usernames = list(self.loader())
+            bloom = BloomFilter(
+                max(self.capacity, len(usernames) * 2), self.error_rate
+            )
+            for username in usernames:
+                bloom.add(username)
+
+        except:
+            with self._lock:
+                self._added = None
+            raise
+
+        with self._lock:
+            # The loader may have missed these:
+            for username in self._added:
+                bloom.add(username)
+            self._added = None
+            self.filter = bloom
+            self.built = time.time()
+            self.built_version = version
+            self._version = (version, self.built)
+            self._counts['rebuilds'] += 1
+
+        self.log.info("rebuild: %d %s usernames loaded in %.2fs" % (
+            len(usernames), self.source, time.time() - start
+        ))
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild()
+        except:
+            self.log.exception("rebuild: failed for %s" % self.source)
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def ensure_current(self, force=False):
+        """Reload the filter in a background thread if it hasn't been
+        loaded, is older than rebuild_interval or force is True.
+        """
+        with self._lock:
+            if self._rebuilding:
+                return
+            if not force and self.filter is not None and (
+                time.time() - self.built < self.rebuild_interval
+            ):
+                return
+            self._rebuilding = True
+
+        worker = threading.Thread(target=self._rebuild_in_background)
+        worker.daemon = True
+        worker.start()
+
+    def current(self):
+        """Return True if the user store hasn't changed since the filter
+        was loaded, as far as its version shows.
+        """
+        if self.version is None:
+            return True
+
+        now = time.time()
+        latest = self._version
+        if latest is None or now - latest[1] >= self.version_ttl:
+            try:
+                latest = (self.version(), now)
+            except:
+                self.log.exception("current: no version for %s" % self.source)
+                latest = (None, now)
+            self._version = latest
+
+        return latest[0] is not None and latest[0] == self.built_version
+
+    def unknown(self, username):
+        """Return True if the username certainly doesn't exist."""
+        self.ensure_current()
+
+        if self.negative.get(username) is not None:
+            counter = 'negative'
+        else:
+            bloom = self.filter
+            if bloom is None or username in bloom:
+                self._count('passed')
+                return False
+            counter = 'filtered'
+
+        if not self.current():
+            # Another process may have added the user:
+            self._count('stale')
+            self.negative.clear()
+            if self._version[0] is not None:
+                self.ensure_current(force=True)
+            return False
+
+        self._count(counter)
+        return True
+
+    def not_found(self, username):
+        """Remember a username the user store didn't have."""
+        self.negative.set(username, True)
+
+    def observe(self, seconds):
+        """Record how long a lookup of a known user took, which reject()
+        takes when dummy_verify is False.
+        """
+        with self._lock:
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency += (seconds - self.latency) * 0.1
+
+    def reject(self, password):
+        """Called instead of verifying the password of an unknown user.
+
+        :returns: False
+
+        """
+        if self.dummy_verify:
+            pwtools.dummy_validate(password)
+        elif self.latency:
+            time.sleep(self.latency)
+        return False
+
+    def add(self, username):
+        """A user was added to the store."""
+        self.negative.pop(username)
+        with self._lock:
+            if self.filter is not None:
+                self.filter.add(username)
+            if self._added is not None:
+                self._added.append(username)
+
+    def remove(self, username):
+        """A user was removed from the store.
+
+        A Bloom filter can't forget an item, so the username is looked up as
+        usual until the next rebuild.
+
+        """
+
+    def stats(self):
+        """Return the logins rejected by the 'filtered' or the 'negative'
+        cache, those 'passed' on to be looked up, those looked up because
+        the user store had changed ('stale') and the 'rebuilds'.
+        """
+        with self._lock:
+            counts = dict(self._counts)
+        bloom = self.filter
+        counts['usernames'] = bloom.count if bloom is not None else 0
+        return counts
+
+
+def user_added(username, source):
+    """Tell every KnownUsers for the source about a new user."""
+    for known_users in list(_known_users):
+        if known_users.source == source:
+            known_users.add(username)
+
+
+def user_removed(username, source):
+    """Tell every KnownUsers for the source that a user was removed."""
+    for known_users in list(_known_users):
+        if known_users.source == source:
+            known_users.remove(username)
+
+
+def usernames_from_file(filename):
+    """Return a loader reading the usernames from the first column of a
+    CSV file, e.g. a plain plugin password file or a listing with one
+    username per line.
+    """
+    def loader():
+        with open(filename) as fd:
+            for line in fd:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line.split(',')[0].strip()
+    return loader
+
+
+def file_version(filename, max_age=None):
+    """Return a KnownUsers version for a file of usernames, which changes
+    when the file is rewritten.
+
+    :param max_age: If given a file not rewritten for this many seconds is
+        out of date, so nothing is rejected until it is.
+
+    """
+    def version():
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        if max_age is not None and time.time() - stat.st_mtime > max_age:
+            return None
+        return (stat.st_mtime, stat.st_size)
+    return version
+
+
+def get_known_users_from_config(
+    settings, prefix, loader, source, dummy_verify=True, version=None,
+):
+    """Return a KnownUsers for a plugin if enabled in the settings.
+
+    The settings recognised, with the plugin's prefix e.g. pp.auth.sql.::
+
+        pp.auth.sql.known_users = true
+
+        # Optional, these are the defaults:
+        pp.auth.sql.known_users_capacity = 100000
+        pp.auth.sql.known_users_error_rate = 0.01
+        pp.auth.sql.known_users_negative_ttl = 30
+        pp.auth.sql.known_users_rebuild_interval = 300
+        pp.auth.sql.known_users_dummy_verify = true
+        pp.auth.sql.known_users_version_ttl = 5
+
+    :param loader: See KnownUsers.
+
+    :param source: See KnownUsers.
+
+    :param dummy_verify: The known_users_dummy_verify default.
+
+    :param version: See KnownUsers.
+
+    :returns: None if it was not enabled.
+
+    """
+    if not config.get_bool(settings, '%sknown_users' % prefix):
+        return None
+
+    def get(name, convert, default):
+        return convert(settings, '%sknown_users_%s' % (prefix, name), default)
+
+    return KnownUsers(
+        loader,
+        source,
+        capacity=get('capacity', config.get_int, 100000),
+        error_rate=get('error_rate', config.get_float, 0.01),
+        negative_ttl=get('negative_ttl', config.get_float, 30),
+        rebuild_interval=get('rebuild_interval', config.get_float, 300),
+        dummy_verify=get('dummy_verify', config.get_bool, dummy_verify),
+        version=version,
+        version_ttl=get('version_ttl', config.get_float, 5),
+    )
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Import plugin modules and construct plugins on first use rather than at
+application startup.
+
+Plugin modules can pull in large dependencies (SQLAlchemy, the REST
+clients, ...). With lazy plugins the registry only records the module
+names, each module is imported the first time one of its plugins is built
+and each plugin is built the first time it is used. Turn it on in the
+add_auth_from_config() settings::
+
+    pp.auth.lazy_plugins = true
+
+Configuration errors in a plugin then show up on the first request that
+needs it rather than at startup.
+
+Plugins can also be named by setuptools entry point in pp.auth.plugins,
+instead of by module. The entry point names the module providing
+register()::
+
+    [pp.auth.plugins]
+    plain = pp.auth.plugins.plain
+
+The time taken to import each plugin module is logged and available from
+import_times().
+
+"""
+import time
+import logging
+import pkgutil
+import importlib
+import threading
+
+import pkg_resources
+from zope.interface import implements
+from repoze.who.interfaces import IAuthenticator
+from repoze.who.interfaces import IMetadataProvider
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# The setuptools entry point group plugins are registered under:
+ENTRY_POINT_GROUP = 'pp.auth.plugins'
+
+_lock = threading.RLock()
+
+# The seconds taken to import each plugin module, by module name:
+_import_times = {}
+
+
+def import_times():
+    """Return the seconds taken to import each plugin module by name."""
+    with _lock:
+        return dict(_import_times)
+
+
+def resolve(name):
+    """Return the module name for a pp.auth.plugins entry.
+
+    :param name: A module name (e.g. pp.auth.plugins.plain) or the name of
+        an entry point in the pp.auth.plugins group (e.g. plain). A name
+        without a dot which isn't an entry point is taken to be a top level
+        module, if there is one.
+
+    :returns: (plugin_id, module_name)
+
+    """
+    name = name.strip()
+    if '.' in name:
+        # Use the last part of the plugin's module name as its ID.
+        return name.split('.')[-1], name
+
+    for entry_point in pkg_resources.iter_entry_points(
+        ENTRY_POINT_GROUP, name
+    ):
+        return name, entry_point.module_name
+
+    # Found without importing it:
+    if pkgutil.find_loader(name) is not None:
+        return name, name
+
+    raise ValueError("Unknown plugin entry point or module: %r" % name)
+
+
+def import_plugin(module_name):
+    """Import a plugin module, logging the time it took the first time."""
+    with _lock:
+        start = time.time()
+        mod = importlib.import_module(module_name)
+        if module_name not in _import_times:
+            _import_times[module_name] = time.time() - start
+            get_log("import_plugin").info("imported %r in %.3fs" % (
+                module_name, _import_times[module_name]
+            ))
+    return mod
+
+
+class LazyFactory(object):
+    """Stands in for a plugin's get_*_from_config() in the plugin registry,
+    importing the plugin module when it is first called.
+    """
+    def __init__(self, plugin_type, plugin_id, module_name):
+        self.plugin_type = plugin_type
+        self.plugin_id = plugin_id
+        self.module_name = module_name
+
+    def __call__(self, settings):
+        factory = import_plugin(self.module_name).register()[self.plugin_type]
+        if factory is None:
+            raise ValueError("Unknown %s: %r" % (
+                self.plugin_type, self.plugin_id
+            ))
+        return factory(settings)
+
+    def __repr__(self):
+        return "<LazyFactory %s %s from %s>" % (
+            self.plugin_type, self.plugin_id, self.module_name
+        )
+
+
+class LazyPlugin(object):
+    """Builds the plugin the first time it is used and then passes
+    everything through to it.
+    """
+    def __init__(self, plugin_type, plugin_id, factory, settings):
+        """
+        :param factory: The plugin's get_*_from_config() or LazyFactory.
+
+        :param settings: The settings to build the plugin with.
+
+        """
+        self.plugin_type = plugin_type
+        self.plugin_id = plugin_id
+        self._factory = factory
+        self._settings = settings
+        self._plugin = None
+
+    @property
+    def plugin(self):
+        if self._plugin is None:
+            with _lock:
+                if self._plugin is None:
+                    start = time.time()
+                    self._plugin = self._factory(self._settings)
+                    get_log("LazyPlugin").info(
+                        "built %s plugin %r in %.3fs" % (
+                            self.plugin_type, self.plugin_id,
+                            time.time() - start,
+                        )
+                    )
+        return self._plugin
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.plugin, name)
+
+
+class LazyAuthenticator(LazyPlugin):
+    implements(IAuthenticator)
+
+    # IAuthenticator
+    def authenticate(self, environ, identity):
+        return self.plugin.authenticate(environ, identity)
+
+
+class LazyMetadataProvider(LazyPlugin):
+    implements(IMetadataProvider)
+
+    # IMetadataProvider
+    def add_metadata(self, environ, identity):
+        return self.plugin.add_metadata(environ, identity)
+
+
+class LazyAdapter(LazyPlugin):
+    """A repoze.what group or permission adapter."""
+
+    def find_sections(self, hint):
+        return self.plugin.find_sections(hint)
+
+
+LAZY_PLUGINS = {
+    'authenticators': LazyAuthenticator,
+    'mdproviders': LazyMetadataProvider,
+    'groups': LazyAdapter,
+    'permissions': LazyAdapter,
+}
+
+
+def lazy_plugin(plugin_type, plugin_id, factory, settings):
+    """Return a LazyPlugin of the right kind for the plugin_type."""
+    return LAZY_PLUGINS[plugin_type](plugin_type, plugin_id, factory, settings)
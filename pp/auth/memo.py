@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Remember the group and permission adapter answers for the length of a
+request.
+
+repoze.what may ask the same adapter the same question several times while
+handling a request. RequestMemoMiddleware puts a dict in the WSGI environ
+(and makes it available to the current thread) for each request, and each
+MemoAdapter answers repeat questions from it instead of asking its adapter
+again. Nothing is remembered between requests.
+
+repoze.what 1.0.9 itself asks each group adapter once per request and each
+permission adapter once per group, so this only saves lookups for
+applications (or other middleware) calling the adapters themselves. It is
+off by default: see add_auth(request_memo=True).
+
+"""
+import logging
+import threading
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# The environ key holding the current request's memo dict:
+ENVIRON_KEY = 'pp.auth.memo'
+
+_local = threading.local()
+
+
+def current():
+    """Return the memo dict of the request being handled by this thread or
+    None outside of a request.
+    """
+    return getattr(_local, 'memo', None)
+
+
+class RequestMemoMiddleware(object):
+    """Give each request a fresh memo dict, see MemoAdapter."""
+
+    def __init__(self, app, adapters=()):
+        """
+        :param app: The WSGI application, usually the repoze.who middleware.
+
+        :param adapters: The (plugin_id, MemoAdapter) the app uses, for
+            stats().
+
+        """
+        self.app = app
+        self.adapters = list(adapters)
+
+    def stats(self):
+        """Return the lookups made and avoided by each adapter, see
+        MemoAdapter.memo_stats().
+        """
+        return stats(self.adapters)
+
+    def __call__(self, environ, start_response):
+        memo = environ.setdefault(ENVIRON_KEY, {})
+        previous = current()
+        _local.memo = memo
+        try:
+            return self.app(environ, start_response)
+        finally:
+            _local.memo = previous
+
+
+def _hint_key(hint):
+    """The part of an adapter's hint which decides the answer.
+
+    Group adapters are given the credentials dict, of which only the userid
+    matters. Permission adapters are given the group name.
+
+    """
+    if isinstance(hint, dict):
+        return hint.get('repoze.what.userid', hint.get('repoze.who.userid'))
+    return hint
+
+
+class MemoAdapter(object):
+    """Wrap a repoze.what group or permission adapter so find_sections()
+    is only asked once per request for each hint.
+
+    Everything else is passed through to the adapter.
+
+    """
+    def __init__(self, name, adapter):
+        """
+        :param name: The adapter's plugin id, to keep its answers apart from
+            those of the other adapters.
+
+        :param adapter: The source adapter to wrap.
+
+        """
+        self.name = name
+        self.adapter = adapter
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.adapter, name)
+
+    def find_sections(self, hint):
+        memo = current()
+        if memo is None:
+            return self.adapter.find_sections(hint)
+
+        key = (id(self), _hint_key(hint))
+        if key in memo:
+            with self._lock:
+                self._hits += 1
+            return memo[key]
+
+        with self._lock:
+            self._misses += 1
+        sections = self.adapter.find_sections(hint)
+        memo[key] = sections
+        return sections
+
+    def memo_stats(self):
+        """Return the 'avoided' lookups and the 'lookups' made in requests."""
+        with self._lock:
+            return dict(avoided=self._hits, lookups=self._misses)
+
+
+def wrap(adapters):
+    """Wrap a list of (plugin_id, adapter) in MemoAdapters."""
+    return [(name, MemoAdapter(name, adapter)) for name, adapter in adapters]
+
+
+def stats(adapters):
+    """Return the memo_stats() of each (plugin_id, MemoAdapter) by id."""
+    return dict(
+        (name, adapter.memo_stats()) for name, adapter in adapters
+        if isinstance(adapter, MemoAdapter)
+    )
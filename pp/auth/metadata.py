@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers the mdprovider plugins use to limit the user details they add to
+the identity to the fields the application needs.
+
+The fields are listed in the settings, for all plugins or per plugin::
+
+    pp.auth.metadata_fields = username, display_name, email
+
+    # This plugin adds different fields:
+    pp.auth.plain.metadata_fields = username, name, email
+
+If neither is set every field the plugin recovers is added, as before.
+
+"""
+from pp.auth import config
+
+
+def fields_from_config(settings, prefix, default_prefix="pp.auth."):
+    """Recover the metadata fields configured for a plugin.
+
+    :param prefix: The plugin's settings prefix e.g. 'pp.auth.sql.'. Its
+        metadata_fields is used in preference to the global one.
+
+    :returns: A frozenset of field names or None for all fields.
+
+    """
+    for key in ('%smetadata_fields' % prefix,
+                '%smetadata_fields' % default_prefix):
+        fields = config.get_list(settings, key)
+        if fields:
+            return frozenset(fields)
+
+    return None
+
+
+def project(metadata, fields):
+    """Return only the wanted fields from a user's metadata dict.
+
+    :param fields: The field names to keep or None to keep them all.
+
+    """
+    if fields is None:
+        return metadata
+
+    return dict((k, v) for k, v in metadata.items() if k in fields)
@@ -1,13 +1,21 @@
+import re
 import logging
 from collections import defaultdict
 
-import importlib
 from repoze.what.middleware import setup_auth
 from repoze.who.plugins.form import RedirectingFormPlugin
 from repoze.who.plugins.auth_tkt import AuthTktCookiePlugin
 #from repoze.who.plugins.basicauth import BasicAuthPlugin
 #from repoze.who.plugins.friendlyform import FriendlyFormPlugin
 
+from pp.auth import memo
+from pp.auth import lazy
+from pp.auth import instrument
+from pp.auth import config
+from pp.auth import tokens
+from pp.auth import pwtools
+from pp.auth import throttle
+
 
 def get_log(extra=None):
     return logging.getLogger(
@@ -18,7 +26,67 @@ def get_log(extra=None):
 PLUGIN_TYPES = ('authenticators', 'mdproviders', 'groups', 'permissions')
 
 
-def get_plugin_registry(settings, prefix="pp.auth."):
+class ExcludePathsMiddleware(object):
+    """Send requests for the excluded paths straight to the application,
+    skipping authentication and authorization entirely.
+
+    Each path excludes itself and everything below it, e.g. '/static'
+    excludes '/static' and '/static/css/site.css' but not '/staticfoo'.
+
+    """
+    def __init__(self, app, app_with_auth, paths):
+        """
+        :param app: The WSGI application without auth.
+
+        :param app_with_auth: The same application wrapped by the auth
+            middleware.
+
+        :param paths: A list of the path prefixes to exclude.
+
+        :raises: ValueError for an empty or root ('/') prefix, which would
+            exclude every path.
+
+        """
+        self.app = app
+        self.app_with_auth = app_with_auth
+        self.paths = list(paths)
+        for path in self.paths:
+            if not path.strip().rstrip('/'):
+                raise ValueError(
+                    "Excluding the path %r would turn off auth for every "
+                    "path." % path
+                )
+        self.excluded = re.compile("^(?:%s)(?:/|$)" % "|".join(
+            re.escape(p.rstrip('/')) for p in self.paths
+        ))
+
+    def __call__(self, environ, start_response):
+        if self.excluded.match(environ.get('PATH_INFO', '')):
+            return self.app(environ, start_response)
+        return self.app_with_auth(environ, start_response)
+
+
+def get_log_level(settings, prefix="pp.auth.", default=logging.DEBUG):
+    """Recover the repoze.who log level from the settings.
+
+    :returns: The logging level for a name (e.g. WARNING) or number given
+        in pp.auth.log_level, or the default if there is none.
+
+    :raises: ValueError for an unknown level name.
+
+    """
+    level = settings.get('%slog_level' % prefix)
+    if not level:
+        return default
+    if str(level).isdigit():
+        return int(level)
+    number = logging.getLevelName(level.strip().upper())
+    if not isinstance(number, int):
+        raise ValueError("Unknown %slog_level %r" % (prefix, level))
+    return number
+
+
+def get_plugin_registry(settings, prefix="pp.auth.", lazy_plugins=None):
     """Get a registry of all the things that the configured plugins provide,
     mapping the plugin type to a method tha builds the plugin from the
     settings dict.
@@ -39,9 +107,19 @@ def get_plugin_registry(settings, prefix="pp.auth."):
                 'plain' : plain.get_permissions_from_config,
             },
         }
+
+    Plugins are listed by module or by pp.auth.plugins entry point name.
+
+    :param lazy_plugins: If True the modules are not imported, each plugin
+        type maps to a lazy.LazyFactory instead. The default comes from
+        pp.auth.lazy_plugins (False).
+
     """
     log = get_log("get_plugin_registry")
 
+    if lazy_plugins is None:
+        lazy_plugins = config.get_bool(settings, '%slazy_plugins' % prefix)
+
     res = dict(list((i, {}) for i in PLUGIN_TYPES))
 
     # Find plugins we've been asked to configure:
@@ -61,9 +139,18 @@ def get_plugin_registry(settings, prefix="pp.auth."):
     plugin_mods = [p for p in lines if check(p)]
     log.debug("plugin_mods (newline separated): <%s>" % plugin_mods)
 
-    for mod in [importlib.import_module(i.strip()) for i in plugin_mods]:
-        # Use the last part of the plugin's module name as its ID.
-        plugin_id = mod.__name__.split('.')[-1]
+    for plugin_id, module_name in [lazy.resolve(i) for i in plugin_mods]:
+        if lazy_plugins:
+            log.info("found plugin %r: %r (not imported)" % (
+                plugin_id, module_name
+            ))
+            for plugin_type in PLUGIN_TYPES:
+                res[plugin_type][plugin_id] = lazy.LazyFactory(
+                    plugin_type, plugin_id, module_name
+                )
+            continue
+
+        mod = lazy.import_plugin(module_name)
         log.info("found plugin %r: %r" % (
             plugin_id, mod
         ))
@@ -74,13 +161,28 @@ def get_plugin_registry(settings, prefix="pp.auth."):
     return res
 
 
-def build_plugins(settings, plugin_registry, prefix="pp.auth."):
+def build_plugins(settings, plugin_registry, prefix="pp.auth.",
+                  lazy_plugins=None, instrumented=None):
     """
     Builds all the plugins we've been asked to configure in the settings
+
+    :param lazy_plugins: If True each plugin is built the first time it is
+        used, see lazy.LazyPlugin. The default comes from
+        pp.auth.lazy_plugins (False).
+
+    :param instrumented: If True the calls to each plugin are timed and
+        counted, see instrument. The default comes from pp.auth.instrument
+        (False).
+
     """
     ids = []
     log = get_log("build_plugins")
 
+    if lazy_plugins is None:
+        lazy_plugins = config.get_bool(settings, '%slazy_plugins' % prefix)
+    if instrumented is None:
+        instrumented = config.get_bool(settings, '%sinstrument' % prefix)
+
     res = defaultdict(list)
 
     for plugin_type in PLUGIN_TYPES:
@@ -96,9 +198,18 @@ def build_plugins(settings, plugin_registry, prefix="pp.auth."):
                 plugin_type, plugin_id
             ))
 
-            res[plugin_type].append((
-                plugin_id, plugin_registry[plugin_type][plugin_id](settings)
-            ))
+            factory = plugin_registry[plugin_type][plugin_id]
+            if lazy_plugins:
+                plugin = lazy.lazy_plugin(
+                    plugin_type, plugin_id, factory, settings
+                )
+            else:
+                plugin = factory(settings)
+
+            if instrumented:
+                plugin = instrument.wrap(plugin_type, plugin_id, plugin)
+
+            res[plugin_type].append((plugin_id, plugin))
 
     return res
 
@@ -129,6 +240,39 @@ def add_auth_from_config(app, settings, prefix="pp.auth."):
         pp.auth.login_url = /login
         pp.auth.login_handler_url = /login_handler
 
+        # Optional: hash/validate passwords in a pool of worker processes
+        pp.auth.pwtools.executor = true
+        pp.auth.pwtools.workers = 4
+
+        # Optional: keep the user's details in a signed token cookie,
+        # skipping the metadata and group look ups until it expires (see the
+        # tokens module for its settings):
+        pp.auth.identifier = token
+
+        # Optional: remember group/permission answers for the length of
+        # each request (off by default, see the memo module):
+        pp.auth.request_memo = true
+
+        # Optional: paths (and everything below them) served without auth:
+        pp.auth.exclude_paths = /static, /health
+
+        # Optional: the repoze.who log level when AUTH_LOG=1 is set (DEBUG
+        # by default):
+        pp.auth.log_level = WARNING
+
+        # Optional: import plugin modules and build plugins on first use
+        # (see lazy):
+        pp.auth.lazy_plugins = true
+
+        # Optional: limit login attempts per user and address (see
+        # throttle for the other settings):
+        pp.auth.throttle = true
+
+        # Optional: time and count the calls to each plugin, serving the
+        # metrics at pp.auth.metrics_path (see instrument):
+        pp.auth.instrument = true
+        pp.auth.metrics_path = /metrics
+
     """
     log = get_log("add_auth_from_config")
 
@@ -143,11 +287,19 @@ def add_auth_from_config(app, settings, prefix="pp.auth."):
         '%slogin_handler_url' % prefix, '/login_handler'
     )
 
+    # Set up password hashing before any plugin needs it:
+    pwtools.init_from_config(settings, "%spwtools." % prefix)
+
     # This is a registry of all the things that the configured plugins provide
     plugin_registry = get_plugin_registry(settings, prefix)
 
     # These are all the built plugins that we'e been configured to use
     plugins = build_plugins(settings, plugin_registry, prefix)
+    import_times = lazy.import_times()
+    if import_times:
+        log.info("plugin import times: %s" % ", ".join(
+            "%s=%.3fs" % i for i in sorted(import_times.items())
+        ))
     if plugins:
         returned = add_auth(
             app,
@@ -156,6 +308,15 @@ def add_auth_from_config(app, settings, prefix="pp.auth."):
             cookie_secret,
             login_url,
             login_handler_url,
+            token_options=tokens.token_options_from_config(settings, prefix),
+            request_memo=config.get_bool(
+                settings, '%srequest_memo' % prefix, False
+            ),
+            exclude_paths=config.get_list(
+                settings, '%sexclude_paths' % prefix
+            ),
+            log_level=get_log_level(settings, prefix),
+            login_throttle=throttle.get_throttle_from_config(settings, prefix),
             **plugins
         )
 
@@ -164,12 +325,18 @@ def add_auth_from_config(app, settings, prefix="pp.auth."):
         log.warn("No auth configuration was found! Returning app unmodified.")
         returned = app
 
+    metrics_path = settings.get('%smetrics_path' % prefix)
+    if metrics_path:
+        log.info("serving plugin metrics at %s" % metrics_path)
+        returned = instrument.MetricsMiddleware(returned, metrics_path)
+
     return returned
 
 
 def add_auth(app, site_name, cookie_name, cookie_secret, login_url,
              login_handler_url, authenticators, mdproviders, groups,
-             permissions):
+             permissions, token_options=None, request_memo=False,
+             exclude_paths=(), log_level=logging.DEBUG, login_throttle=None):
     """
     Add authentication and authorization middleware to the ``app``.
 
@@ -183,6 +350,16 @@ def add_auth(app, site_name, cookie_name, cookie_secret, login_url,
     :param mdproviders: list of mdprovider plugins
     :param groups: list of groups plugins
     :param permissions: list of permissions plugins
+    :param token_options: If given the tokens.TokenIdentifierPlugin options
+        used to identify users from a signed token, before the cookie.
+    :param request_memo: If True each group and permission adapter is asked
+        about a user or group at most once per request (see memo).
+    :param exclude_paths: requests for these paths (and the paths below
+        them) skip the auth middleware entirely, see ExcludePathsMiddleware.
+    :param log_level: the repoze.who log level, used when its logging is
+        turned on by the AUTH_LOG=1 environment variable.
+    :param login_throttle: an optional throttle.Throttle, consulted before
+        any authenticator verifies a password.
     :return: The same WSGI application, with authentication and
         authorization middleware.
 
@@ -210,6 +387,20 @@ def add_auth(app, site_name, cookie_name, cookie_secret, login_url,
     )
 
     cookie = AuthTktCookiePlugin(cookie_secret, cookie_name)
+    if request_memo:
+        groups = memo.wrap(groups)
+        permissions = memo.wrap(permissions)
+
+    if login_throttle is not None:
+        authenticators = login_throttle.wrap(authenticators)
+
+    if token_options is not None:
+        # The token plugin takes the cookie's place, falling back to it:
+        cookie = tokens.TokenIdentifierPlugin(fallback=cookie, **token_options)
+        mdproviders = [
+            (name, tokens.TokenSkippingMetadataProvider(mdprovider))
+            for name, mdprovider in mdproviders
+        ]
 
     #identifiers = [('main_identifier', form), ('basicauth', basicauth),\
     #   ('cookie', cookie)]
@@ -235,9 +426,30 @@ def add_auth(app, site_name, cookie_name, cookie_secret, login_url,
         authenticators=authenticators,
         challengers=challengers,
         mdproviders=mdproviders,
-        log_level=logging.DEBUG
+        log_level=log_level
     )
 
+    if token_options is not None:
+        tokens.install(app_with_auth)
+
+    if login_throttle is not None:
+        app_with_auth = throttle.ThrottleMiddleware(
+            app_with_auth, login_throttle
+        )
+
+    if request_memo:
+        app_with_auth = memo.RequestMemoMiddleware(
+            app_with_auth,
+            [('groups.%s' % name, a) for name, a in groups] +
+            [('permissions.%s' % name, a) for name, a in permissions]
+        )
+
+    if exclude_paths:
+        get_log().info("add_auth: excluding paths %s" % (exclude_paths,))
+        app_with_auth = ExcludePathsMiddleware(
+            app, app_with_auth, exclude_paths
+        )
+
     get_log().info("add_auth: user/group/permission setup OK.")
 
     return app_with_auth
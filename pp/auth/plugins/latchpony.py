@@ -3,8 +3,13 @@
 """
 import logging
 
+from requests import RequestException
 from repoze.what.adapters import BaseSourceAdapter, SourceError
 
+from pp.auth import cache
+from pp.auth import config
+from pp.auth import breaker
+from pp.auth import sections
 from pp.latchpony.client import rest
 
 
@@ -24,24 +29,93 @@ def register():
     }
 
 
+# Used when latchpony can't be reached and there is nothing cached:
+_NO_SECTIONS = sections.SectionIndex({})
+
+
 class LatchPonyAdapter(BaseSourceAdapter):
-    """Base class for LatchPony Group/Perm adapters."""
+    """Base class for LatchPony Group/Perm adapters.
+
+    The groups / permissions recovered from latchpony are indexed by member
+    and cached per organisation for cache_ttl seconds. They are refreshed in
+    the background cache_refresh_ahead seconds before they expire. Expired
+    data is used for up to cache_stale_ttl seconds more while it is reloaded
+    in the background, e.g. when latchpony can't be reached.
+
+    With a circuit breaker latchpony isn't asked again for a while once it
+    keeps failing. The cached (or no) data is used in the meantime.
 
-    def __init__(self, organisation, latchpony_service_uri):
+    """
+
+    def __init__(
+        self, organisation, latchpony_service_uri, cache_ttl=30,
+        cache_refresh_ahead=5, cache_stale_ttl=300, circuit_breaker=None
+    ):
         """
         :param org: An organisation identifier.
 
         :param latchpony_service_uri: http://<host>:<port>
 
+        :param cache_ttl: Seconds the data is used for before reloading. 0
+            recovers it from latchpony on every access.
+
+        :param cache_refresh_ahead: Seconds before expiry to reload in the
+            background.
+
+        :param cache_stale_ttl: Seconds after expiry the data is still used
+            while it is reloaded in the background.
+
+        :param circuit_breaker: An optional breaker.CircuitBreaker the calls
+            to latchpony are made through.
+
         """
         super(LatchPonyAdapter, self).__init__()
 
         # for now, the adapter is read-only
         self.is_writable = False
-        self._info = {}
         self.organisation = organisation
         self.uri = latchpony_service_uri
         self.lps = rest.LatchPonyService(self.uri)
+        self.circuit_breaker = circuit_breaker
+        self.cache = cache.RefreshingCache(
+            self._load,
+            ttl=cache_ttl,
+            refresh_ahead=cache_refresh_ahead,
+            stale_ttl=cache_stale_ttl,
+            errors=(RequestException, breaker.CircuitOpenError),
+        )
+
+    def _fetch(self, organisation):
+        """Recover the data for the organisation from latchpony."""
+        raise NotImplementedError("Implemented by the group/perms adapters.")
+
+    def _load(self, organisation):
+        """Recover and index the data each time the cache is refreshed."""
+        if self.circuit_breaker is None:
+            return sections.SectionIndex(self._fetch(organisation))
+        return sections.SectionIndex(
+            self.circuit_breaker.call(self._fetch, organisation)
+        )
+
+    def _index(self):
+        """Return the current SectionIndex of the groups / permissions."""
+        try:
+            return self.cache.get(self.organisation)
+
+        except RequestException:
+            # Nothing cached that can be used:
+            self.log.exception(
+                "Cannot connect to latchpony: '{:s}' ".format(self.uri)
+            )
+            return _NO_SECTIONS
+
+        except breaker.CircuitOpenError, e:
+            self.log.warn("Not asking latchpony: {}".format(e))
+            return _NO_SECTIONS
+
+    def stats(self):
+        """Return the cache hit/miss/refresh/failure/stale counters."""
+        return self.cache.stats()
 
     def info():
         """Reconnect/Retry a request to latchpony service.
@@ -51,27 +125,7 @@ class LatchPonyAdapter(BaseSourceAdapter):
         def fget(self):
             """Recover the Groups / Permission data.
             """
-            from requests import ConnectionError
-
-            try:
-                # Check the service is running:
-                #self.lps.ping()
-                # self.log.debug(
-                #     "latchpony: contacting '{:s}'.".format(self.uri)
-                # )
-
-                if self.__class__.__name__ == "LatchPonyGroupAdapter":
-                    self._info = self.lps.groups_for(self.organisation)
-
-                elif self.__class__.__name__ == "LatchPonyPermissionsAdapter":
-                    self._info = self.lps.perms_for(self.organisation)
-
-            except ConnectionError:
-                self.log.exception(
-                    "Cannot connect to latchpony: '{:s}' ".format(self.uri)
-                )
-
-            return self._info
+            return self._index().info
 
         def fset(self, value):
             raise NotImplemented("Setting groups/perms directly.")
@@ -109,13 +163,12 @@ class LatchPonyGroupAdapter(LatchPonyAdapter):
 
     log = get_log("LatchPonyGroupAdapter")
 
+    def _fetch(self, organisation):
+        return self.lps.groups_for(organisation)
+
     def _find_sections(self, hint):
         userid = hint['repoze.who.userid']
-        answer = set()
-        for section in self.info.keys():
-            if userid in self.info[section]:
-                answer.add(section)
-        return answer
+        return set(self._index().sections_for(userid))
 
 
 class LatchPonyPermissionsAdapter(LatchPonyAdapter):
@@ -123,16 +176,49 @@ class LatchPonyPermissionsAdapter(LatchPonyAdapter):
 
     log = get_log("LatchPonyPermissionsAdapter")
 
+    def _fetch(self, organisation):
+        return self.lps.perms_for(organisation)
+
     def _find_sections(self, hint):
-        answer = set()
-        for section in self.info.keys():
-            if hint in self.info[section]:
-                answer.add(section)
-        return answer
+        return set(self._index().sections_for(hint))
+
+
+def _cache_config(settings, prefix):
+    """Recover the adapter cache and circuit breaker keyword arguments from
+    the settings.
+    """
+    return dict(
+        circuit_breaker=breaker.get_breaker_from_config(
+            settings, prefix, 'latchpony<%s>' % settings['%suri' % prefix],
+            errors=(RequestException,),
+        ),
+        cache_ttl=config.get_float(settings, '%scache_ttl' % prefix, 30),
+        cache_refresh_ahead=config.get_float(
+            settings, '%scache_refresh_ahead' % prefix, 5
+        ),
+        cache_stale_ttl=config.get_float(
+            settings, '%scache_stale_ttl' % prefix, 300
+        ),
+    )
 
 
 def get_groups_from_config(settings, prefix="pp.auth.latchpony."):
     """Create an instance of LatchPonyPermissionsAdapter from configuration.
+
+    The settings recognised are::
+
+        pp.auth.latchpony.organisation = myorg
+        pp.auth.latchpony.uri = http://localhost:port
+
+        # Optional caching of the data latchpony returns (seconds):
+        pp.auth.latchpony.cache_ttl = 30
+        pp.auth.latchpony.cache_refresh_ahead = 5
+        pp.auth.latchpony.cache_stale_ttl = 300
+
+        # Optional circuit breaker (see breaker.get_breaker_from_config):
+        pp.auth.latchpony.breaker_failures = 5
+        pp.auth.latchpony.breaker_reset_timeout = 30
+
     """
     log = get_log("LatchPonyGroupAdapter")
 
@@ -140,7 +226,9 @@ def get_groups_from_config(settings, prefix="pp.auth.latchpony."):
     uri = settings['%suri' % prefix]
     log.debug("organisation<%s> latchpony<%s>" % (organisation, uri))
 
-    return LatchPonyGroupAdapter(organisation, uri)
+    return LatchPonyGroupAdapter(
+        organisation, uri, **_cache_config(settings, prefix)
+    )
 
 
 def get_permissions_from_config(settings, prefix="pp.auth.latchpony."):
@@ -152,4 +240,6 @@ def get_permissions_from_config(settings, prefix="pp.auth.latchpony."):
     uri = settings['%suri' % prefix]
     log.debug("organisation<%s> latchpony<%s>" % (organisation, uri))
 
-    return LatchPonyPermissionsAdapter(organisation, uri)
+    return LatchPonyPermissionsAdapter(
+        organisation, uri, **_cache_config(settings, prefix)
+    )
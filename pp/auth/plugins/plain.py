@@ -13,13 +13,24 @@
 """
 import os
 import csv
+import mmap
+import time
 import logging
 import StringIO
+import itertools
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
+from repoze.what.adapters import BaseSourceAdapter
 from repoze.what.plugins.ini import INIGroupAdapter
 from repoze.what.plugins.ini import INIPermissionsAdapter
+from repoze.what.plugins.ini.parser import parse_INIFile
 
+from pp.auth import cache
+from pp.auth import config
+from pp.auth import metadata
 from pp.auth import pwtools
+from pp.auth import sections
 
 
 def get_log():
@@ -38,6 +49,399 @@ def register():
     }
 
 
+class PlainUser(object):
+    """A user recovered from the password CSV.
+
+    This uses __slots__ rather than a dict per user so large password files
+    take a fraction of the memory. The repeated first and last names are
+    interned and the display name is worked out when asked for.
+
+    Fields can be recovered as attributes or like a dict i.e. user['email'].
+
+    """
+    __slots__ = ('username', 'password', 'firstname', 'lastname', 'email')
+
+    FIELDS = (
+        'username', 'password', 'firstname', 'lastname', 'email', 'name'
+    )
+
+    def __init__(self, username, password, firstname, lastname, email):
+        self.username = _intern(username)
+        self.password = password
+        self.firstname = _intern(firstname)
+        self.lastname = _intern(lastname)
+        self.email = email
+
+    @property
+    def name(self):
+        """A convience for '%s %s' % (firstname, lastname)"""
+        return "%s %s" % (self.firstname, self.lastname)
+
+    def fields(self):
+        """Return the CSV fields as a tuple, in the order they are loaded."""
+        return (
+            self.username, self.password, self.firstname, self.lastname,
+            self.email
+        )
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        if field not in self.FIELDS:
+            return default
+        return getattr(self, field)
+
+    def to_dict(self):
+        """Return all the user fields, including name, as a dict."""
+        return dict(
+            username=self.username,
+            password=self.password,
+            firstname=self.firstname,
+            lastname=self.lastname,
+            email=self.email,
+            name=self.name,
+        )
+
+    def __repr__(self):
+        return "<PlainUser %r: %r>" % (self.username, self.email)
+
+
+def _intern(value):
+    """Share equal strings between users (only str can be interned)."""
+    return intern(value) if type(value) is str else value
+
+
+# Files smaller than this are always parsed in the calling process:
+PARALLEL_MIN_BYTES = 4 * 1024 * 1024
+
+
+def _parse_rows(lines):
+    """Yield a (username, password, firstname, lastname, email) tuple for
+    each non empty line of the password CSV.
+    """
+    strip = str.strip
+    for row in csv.reader(lines):
+        if not row:
+            continue
+        if len(row) < 5:
+            # Missing trailing fields are empty, as csv.DictReader does:
+            row.extend([''] * (5 - len(row)))
+        yield tuple(map(strip, row[:5]))
+
+
+def _chunk_offsets(filename, chunks):
+    """Split the file into about equal (start, end) byte ranges which begin
+    and end on line boundaries.
+    """
+    size = os.path.getsize(filename)
+    offsets = []
+    with open(filename, 'rb') as fp:
+        m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            for i in range(1, chunks):
+                end = m.find('\n', max(start, size * i // chunks))
+                if end == -1:
+                    break
+                offsets.append((start, end + 1))
+                start = end + 1
+        finally:
+            m.close()
+
+    if start < size:
+        offsets.append((start, size))
+
+    return offsets
+
+
+def _parse_chunk(args):
+    """Parse the (filename, start, end) range of the password CSV in a worker
+    process.
+
+    :returns: a list of the row tuples.
+
+    """
+    filename, start, end = args
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        lines = fp.read(end - start).splitlines(True)
+    return list(_parse_rows(lines))
+
+
+class PlainUserStore(object):
+    """The users recovered from the password CSV, indexed by username and by
+    email.
+
+    get_auth_from_config() shares one store per password file between the
+    authenticator and the mdprovider. Building the application before the
+    server forks its workers then shares the store between them too.
+
+    The users and indexes are swapped in as one by load(), so a request in
+    progress sees either the old or the new users, never a mix.
+
+    """
+    FIELDNAMES = ['username', 'password', 'firstname', 'lastname', 'email']
+
+    def __init__(self, user_details=""):
+        """
+        :param user_details: This is a string of lines read from
+            the user data CSV file.
+
+        """
+        # (users by username, users by email) replaced as one:
+        self._table = ({}, {})
+        self.load(user_details)
+
+    @property
+    def users(self):
+        return self._table[0]
+
+    @property
+    def by_email(self):
+        return self._table[1]
+
+    def load(self, user_details):
+        """Replace the loaded users with those in user_details.
+
+        Users whose row hasn't changed keep their existing PlainUser, so only
+        new and changed rows create new objects.
+
+        :param user_details: This is a string of lines read from the user
+            data CSV file, or an open file (or any iterable of lines) which
+            is read a line at a time.
+
+        :returns: a dict counting the added, changed, removed and unchanged
+            users.
+
+        """
+        if isinstance(user_details, basestring):
+            user_details = StringIO.StringIO(user_details)
+
+        return self.load_rows(_parse_rows(user_details))
+
+    def load_file(self, filename, workers=None):
+        """Replace the loaded users with those in the password CSV file.
+
+        The file is streamed rather than read into memory. If workers is
+        more than 1 and the file is large, it is split into chunks on line
+        boundaries which are parsed in that many processes. This relies on
+        no field containing a quoted new line, which is the case for the
+        password CSV.
+
+        :param filename: The password CSV to load.
+
+        :param workers: The number of processes to parse the file with.
+
+        :returns: As load() with the seconds each phase took in 'timings'.
+
+        """
+        timings = {}
+        started = time.time()
+
+        if workers > 1 and os.path.getsize(filename) >= PARALLEL_MIN_BYTES:
+            chunks = _chunk_offsets(filename, workers)
+            pool = ProcessPoolExecutor(max_workers=workers)
+            try:
+                parsed = pool.map(
+                    _parse_chunk,
+                    [(filename, start, end) for start, end in chunks]
+                )
+                # Keep the chunks in file order so the last duplicate wins:
+                parsed = list(parsed)
+            finally:
+                pool.shutdown()
+            timings['parse'] = time.time() - started
+
+            loading = time.time()
+            changes = self.load_rows(itertools.chain.from_iterable(parsed))
+            timings['load'] = time.time() - loading
+
+        else:
+            # Parsing happens as the rows are loaded:
+            with open(filename, 'rb') as fp:
+                changes = self.load(fp)
+            timings['load'] = time.time() - started
+
+        timings['total'] = time.time() - started
+        changes['timings'] = timings
+        return changes
+
+    def load_rows(self, rows):
+        """Replace the loaded users with the given rows, see load().
+
+        :param rows: An iterable of (username, password, firstname, lastname,
+            email) tuples.
+
+        """
+        current = self._table[0]
+        users = {}
+        by_email = {}
+
+        for row in rows:
+            user = current.get(row[0])
+            if user is None or user.fields() != row:
+                user = PlainUser(*row)
+
+            # No check for duplicate usernames is done! The
+            # last will over write any previous entry.
+            users[user.username] = user
+            if user.email:
+                by_email[user.email] = user
+
+        self._table = (users, by_email)
+
+        added = len(set(users) - set(current))
+        unchanged = sum(
+            1 for username, user in users.iteritems()
+            if current.get(username) is user
+        )
+        return dict(
+            added=added,
+            changed=len(users) - added - unchanged,
+            removed=len(set(current) - set(users)),
+            unchanged=unchanged,
+        )
+
+    def get(self, username, default=None):
+        """Return the PlainUser for the username or default."""
+        return self._table[0].get(username, default)
+
+    def find_by_email(self, email, default=None):
+        """Return the PlainUser with the email address or default."""
+        return self._table[1].get(email, default)
+
+    def __len__(self):
+        return len(self._table[0])
+
+    def __contains__(self, username):
+        return username in self._table[0]
+
+
+def _file_signature(filename):
+    """Return what identifies this version of the file's contents."""
+    st = os.stat(filename)
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+class FileWatcher(object):
+    """Calls check() every interval seconds from a background thread, so a
+    subclass can reload its files when they change.
+
+    Changes are noticed by polling the file's inode, modification time and
+    size. This catches files edited in place as well as replaced by a rename.
+
+    """
+    def __init__(self, name):
+        """
+        :param name: What is being watched, for the logs.
+
+        """
+        self.log = get_log()
+        self.name = name
+        self.interval = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def check(self):
+        """Reload if the files have changed.
+
+        :returns: True if they were reloaded.
+
+        """
+        raise NotImplementedError()
+
+    def watch(self, interval):
+        """Check the file for changes every interval seconds in a background
+        thread (see ensure_watching).
+        """
+        self.interval = interval
+        self.ensure_watching()
+
+    def ensure_watching(self):
+        """Start the background thread if it isn't running in this process.
+
+        Threads don't survive a fork, so this is called on each request to
+        restart the thread in the forked workers.
+
+        """
+        if self.interval is None:
+            return
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run,
+                name="%s(%s)" % (self.__class__.__name__, self.name),
+            )
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """Stop the background checking."""
+        self.interval = None
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval or 0):
+            try:
+                self.check()
+            except:
+                # Keep serving what was loaded last, try again next time:
+                self.log.exception("reloading %r failed" % self.name)
+
+
+class PlainUserFile(FileWatcher):
+    """The PlainUserStore loaded from a password file, which can be reloaded
+    when the file changes.
+    """
+    def __init__(self, filename, workers=None):
+        """
+        :param filename: The password CSV file to load.
+
+        :param workers: The number of processes to parse the file with (see
+            PlainUserStore.load_file).
+
+        """
+        FileWatcher.__init__(self, filename)
+        self.filename = filename
+        self.workers = workers
+        self._signature = _file_signature(filename)
+        self.store = PlainUserStore()
+        changes = self.store.load_file(filename, workers)
+        self.log.info("loaded %r: %r" % (filename, changes))
+
+    def check(self):
+        """Reload the users if the file has changed since it was last loaded.
+
+        :returns: True if the users were reloaded.
+
+        """
+        with self._lock:
+            signature = _file_signature(self.filename)
+            if signature == self._signature:
+                return False
+
+            changes = self.store.load_file(self.filename, self.workers)
+            self._signature = signature
+
+        self.log.info("reloaded %r: %r" % (self.filename, changes))
+        return True
+
+
+# The password files loaded by get_auth_from_config() keyed on the path:
+_files = {}
+
+
 class PlainAuthenticatorMetadataProvider(object):
     """
     This implements a combination of the repose.who IAuthenticatorPlugin
@@ -61,35 +465,39 @@ class PlainAuthenticatorMetadataProvider(object):
     """
     FIELDNAMES = ['username', 'password', 'firstname', 'lastname', 'email']
 
-    def __init__(self, user_details):
+    def __init__(
+        self, user_details, credential_cache=None, user_file=None,
+        metadata_fields=None,
+    ):
         """Load the user details recovered from a file.
 
         :param user_details: This is a string of lines read from
-            the user data CSV file.
+            the user data CSV file, or an already loaded PlainUserStore.
+
+        :param credential_cache: An optional cache.CredentialCache used to
+            skip re-verifying recently validated passwords.
+
+        :param user_file: An optional PlainUserFile the store was loaded from.
+            If it is being watched for changes, this makes sure the watching
+            thread is running in the current process.
+
+        :param metadata_fields: If given only these user fields are added to
+            the identity (see metadata.project).
 
         """
-        self.userDetails = {}
+        self.credential_cache = credential_cache
+        self.user_file = user_file
+        self.metadata_fields = metadata_fields
 
-        s = StringIO.StringIO(user_details)
-        reader = csv.DictReader(s, fieldnames=self.FIELDNAMES)
-        for row in reader:
-            # No check for duplicate usernames is done! The
-            # last will over write any previous entry.
-            username = row['username'].strip()
-            password = row['password'].strip()
-            firstname = row['firstname'].strip()
-            lastname = row['lastname'].strip()
-            email = row['email'].strip()
-            name = "%s %s" % (firstname, lastname)
-
-            self.userDetails[username] = dict(
-                username=username,
-                password=password,
-                firstname=firstname,
-                lastname=lastname,
-                email=email,
-                name=name,
-            )
+        if isinstance(user_details, PlainUserStore):
+            self.store = user_details
+        else:
+            self.store = PlainUserStore(user_details)
+
+    @property
+    def userDetails(self):
+        """The username to PlainUser mapping of the loaded users."""
+        return self.store.users
 
     def authenticate(self, environ, identity):
         """
@@ -105,17 +513,35 @@ class PlainAuthenticatorMetadataProvider(object):
         get_log().info("authenticate: %r" % identity)
         returned = None
 
+        if self.user_file is not None:
+            self.user_file.ensure_watching()
+
         login = identity['login']
         password = identity['password']
 
         # Recover the password and check the given one against it:
-        user = self.userDetails.get(login)
+        user = self.store.get(login)
         get_log().info("authenticate: found user: %r" % user)
         if user:
             #print "user '%s' hpw '%s'" % (user,user['password'])
-            if pwtools.validate_password(password, user['password']):
+            if self.credential_cache is not None:
+                is_valid = self.credential_cache.validate(
+                    login, password, user['password']
+                )
+            else:
+                is_valid = pwtools.validate_password(
+                    password, user['password']
+                )
+
+            if is_valid:
                 returned = user['username']
                 get_log().info("authenticate: validated  user: %r" % returned)
+                if pwtools.needs_rehash(user['password']):
+                    # The CSV is never written to, it will need updating:
+                    get_log().warn(
+                        "authenticate: password hash for %r uses a deprecated"
+                        " scheme or rounds." % returned
+                    )
             else:
                 get_log().info("authenticate: failed")
         else:
@@ -132,43 +558,238 @@ class PlainAuthenticatorMetadataProvider(object):
             http://docs.repoze.org/who/narr.html#writing-a-metadata-provider-plugin
 
         """
+        if self.user_file is not None:
+            self.user_file.ensure_watching()
+
         userid = identity.get('repoze.who.userid')
-        info = self.userDetails.get(userid)
+        info = self.store.get(userid)
         if info is not None:
-            identity.update(info)
+            identity.update(
+                metadata.project(info.to_dict(), self.metadata_fields)
+            )
 
 
 def get_auth_from_config(settings, prefix="pp.auth.plain."):
     """
     Return a `PlainAuthenticatorMetadataProvider` from a settings dict
+
+    The verified credential cache can be enabled with::
+
+        pp.auth.plain.credential_cache = true
+        pp.auth.plain.credential_cache_size = 10000
+        pp.auth.plain.credential_cache_ttl = 300
+
+    The password file is reloaded when it changes, checking every
+    reload_interval seconds (0, the default, loads it once only)::
+
+        pp.auth.plain.reload_interval = 5
+
+    Large password files can be parsed in several processes::
+
+        pp.auth.plain.load_workers = 4
+
+    Only the fields listed in pp.auth.metadata_fields or
+    pp.auth.plain.metadata_fields are added to the identity (see the metadata
+    module).
+
     """
     password_file = settings['%spassword_file' % prefix]
     if not os.path.isfile(password_file):
-        raise ValueError("Unable to find password file '%s'!" % password_file)
+        raise ValueError(
+            "Unable to find password file '%s'!" % password_file
+        )
+
+    credential_cache = cache.get_credential_cache_from_config(
+        settings, prefix
+    )
+
+    # Recover the User details and load it for the CSV repoze plugin to handle.
+    # The authenticator and mdprovider share the one store:
+    password_file = os.path.abspath(password_file)
+    user_file = _files.get(password_file)
+    if user_file is None:
+        workers = config.get_int(settings, '%sload_workers' % prefix)
+        user_file = PlainUserFile(password_file, workers)
+        _files[password_file] = user_file
+    else:
+        user_file.check()
+
+    reload_interval = config.get_float(
+        settings, '%sreload_interval' % prefix, 0
+    )
+    if reload_interval > 0:
+        user_file.watch(reload_interval)
+
+    return PlainAuthenticatorMetadataProvider(
+        user_file.store,
+        credential_cache=credential_cache,
+        user_file=user_file,
+        metadata_fields=metadata.fields_from_config(settings, prefix),
+    )
+
+
+class PlainAccessFiles(FileWatcher):
+    """The sections.AccessIndex built from the groups and permissions INI
+    files, which can be rebuilt when either file changes.
+    """
+    def __init__(self, groups_file, permissions_file):
+        """
+        :param groups_file: The INI file of group -> userids.
+
+        :param permissions_file: The INI file of permission -> groups.
+
+        Either file may be None if only the other's adapter is used.
+
+        """
+        FileWatcher.__init__(self, "%s, %s" % (groups_file, permissions_file))
+        self.groups_file = groups_file
+        self.permissions_file = permissions_file
+        self._signature = self._signatures()
+        self.index = self._load()
+
+    def _signatures(self):
+        return tuple(
+            _file_signature(f) if f else None
+            for f in (self.groups_file, self.permissions_file)
+        )
+
+    def _load(self):
+        index = sections.AccessIndex(
+            parse_INIFile(self.groups_file) if self.groups_file else {},
+            parse_INIFile(self.permissions_file)
+            if self.permissions_file else {},
+        )
+        self.log.info("loaded %r: users<%d> groups<%d> permissions<%d>" % (
+            self.name, len(index.groups.by_item), len(index.groups),
+            len(index.permissions),
+        ))
+        return index
+
+    def check(self):
+        """Rebuild the index if either file has changed since it was last
+        loaded.
+
+        :returns: True if the index was rebuilt.
+
+        """
+        with self._lock:
+            signature = self._signatures()
+            if signature == self._signature:
+                return False
+
+            # Swapped in whole, so look ups never see a partial rebuild:
+            self.index = self._load()
+            self._signature = signature
+
+        return True
+
+
+class PlainGroupAdapter(INIGroupAdapter):
+    """An INIGroupAdapter answering from a PlainAccessFiles index."""
+
+    def __init__(self, access_files):
+        BaseSourceAdapter.__init__(self, writable=False)
+        self.access_files = access_files
+
+    @property
+    def info(self):
+        return self.access_files.index.groups.info
+
+    def _find_sections(self, hint):
+        self.access_files.ensure_watching()
+        return self.access_files.index.groups_for(hint['repoze.who.userid'])
+
 
-    # Recover the User details and load it for the CSV repoze plugin to handle:
-    with open(os.path.abspath(password_file), 'r') as fp:
-        return (PlainAuthenticatorMetadataProvider(fp.read()))
+class PlainPermissionsAdapter(INIPermissionsAdapter):
+    """An INIPermissionsAdapter answering from a PlainAccessFiles index."""
+
+    def __init__(self, access_files):
+        BaseSourceAdapter.__init__(self, writable=False)
+        self.access_files = access_files
+
+    @property
+    def info(self):
+        return self.access_files.index.permissions.info
+
+    def _find_sections(self, hint):
+        self.access_files.ensure_watching()
+        return self.access_files.index.permissions_for_group(hint)
+
+
+# The groups/permissions files loaded by get_access_files_from_config() keyed
+# on their paths:
+_access_files = {}
+
+
+def get_access_files_from_config(
+    settings, prefix="pp.auth.plain.",
+    required=('groups_file', 'permissions_file'),
+):
+    """Return the PlainAccessFiles the group and permission adapters share.
+
+    The files are checked for changes every reload_interval seconds (0, the
+    default, loads them once only)::
+
+        pp.auth.plain.groups_file = %(here)s/auth/groups.ini
+        pp.auth.plain.permissions_file = %(here)s/auth/permissions.ini
+        pp.auth.plain.reload_interval = 5
+
+    :param required: The settings which must name an existing file. The
+        other file is left out if it isn't set or doesn't exist, so e.g. the
+        groups adapter doesn't depend on the permissions file.
+
+    """
+    paths = []
+    for key in ('groups_file', 'permissions_file'):
+        path = settings.get('%s%s' % (prefix, key))
+        if key not in required and (path is None or not os.path.isfile(path)):
+            paths.append(None)
+            continue
+        if path is None or not os.path.isfile(path):
+            raise ValueError("Unable to find %s '%s'!" % (
+                key.replace('_', ' '), path
+            ))
+        paths.append(os.path.abspath(path))
+
+    paths = tuple(paths)
+    access_files = _access_files.get(paths)
+    if access_files is None:
+        access_files = PlainAccessFiles(*paths)
+        _access_files[paths] = access_files
+    else:
+        access_files.check()
+
+    reload_interval = config.get_float(
+        settings, '%sreload_interval' % prefix, 0
+    )
+    if reload_interval > 0:
+        access_files.watch(reload_interval)
+
+    return access_files
 
 
 def get_groups_from_config(settings, prefix="pp.auth.plain."):
     """
     Return a groups `INIGroupAdapter` from a settings dict
-    """
-    groups_file = settings['%sgroups_file' % prefix]
-    if not os.path.isfile(groups_file):
-        raise ValueError("Unable to find groups file '%s'!" % groups_file)
 
-    return INIGroupAdapter(groups_file)
+    This is a PlainGroupAdapter answering from the user -> groups index
+    built from the groups and permissions files.
+
+    """
+    return PlainGroupAdapter(
+        get_access_files_from_config(settings, prefix, ('groups_file',))
+    )
 
 
 def get_permissions_from_config(settings, prefix="pp.auth.plain."):
     """
     Return a permissions `INIGroupAdapter` from a settings dict
-    """
-    permissions_file = settings['%spermissions_file' % prefix]
-    if not os.path.isfile(permissions_file):
-        raise ValueError("Unable to find permissions file '%s'!" % permissions_file)
 
-    return INIPermissionsAdapter(permissions_file)
+    This is a PlainPermissionsAdapter answering from the group -> permissions
+    index built from the groups and permissions files.
+
+    """
+    return PlainPermissionsAdapter(
+        get_access_files_from_config(settings, prefix, ('permissions_file',))
+    )
 
@@ -11,6 +11,11 @@ plain.get_permissions_from_config().
 """
 import logging
 
+from pp.auth import cache
+from pp.auth import known
+from pp.auth import config
+from pp.auth import pwtools
+from pp.auth import metadata
 from pp.auth.plugins import plain
 
 import user
@@ -23,6 +28,10 @@ def get_log(extra=None):
     return logging.getLogger(m)
 
 
+# The environ key authenticate() leaves the user's row in for add_metadata():
+ENVIRON_KEY = 'pp.auth.sql.user'
+
+
 def commondb_setup():
     """
     Returns all the commondb modules and mappers this package provides
@@ -50,10 +59,33 @@ class SQLAuthenticatorMetadataProvider(object):
     which will need to be provided elsewhere.
 
     """
-    def __init__(self):
+    def __init__(
+        self, credential_cache=None, metadata_cache=None, metadata_extra=True,
+        metadata_fields=None, known_users=None,
+    ):
         """
+        :param credential_cache: An optional cache.CredentialCache used to
+            skip re-verifying recently validated passwords.
+
+        :param metadata_cache: An optional cache.MetadataCache used to skip
+            recovering the user's details on every request.
+
+        :param metadata_extra: If False the user's extra data is not
+            recovered or added to the identity.
+
+        :param metadata_fields: If given only these user fields are
+            recovered and added to the identity (see metadata.project).
+
+        :param known_users: An optional known.KnownUsers used to reject
+            logins for usernames that don't exist without a query.
+
         """
         self.log = get_log("SQLAuthenticatorMetadataProvider")
+        self.credential_cache = credential_cache
+        self.metadata_cache = metadata_cache
+        self.metadata_extra = metadata_extra
+        self.metadata_fields = metadata_fields
+        self.known_users = known_users
 
     def authenticate(self, environ, identity):
         """
@@ -72,22 +104,74 @@ class SQLAuthenticatorMetadataProvider(object):
         login = identity['login']
         password = identity['password']
 
+        if self.known_users is not None and self.known_users.unknown(login):
+            self.log.info("authenticate: unknown user <%r>" % login)
+            self.known_users.reject(password)
+            return None
+
         self.log.info("authenticate: looking for user <%r>" % login)
-        u = user.find(username=login)
-        if u:
+        row = user.get_row(
+            login, extra=self.metadata_extra, fields=self.metadata_fields
+        )
+        if row:
             self.log.info("authenticate: validating password for <%r>" % login)
-            #print "user '%s' hpw '%s'" % (user,user['password'])
-            if u[0].validate_password(password):
-                returned = u[0].username
+            if self.validate_password(row, password):
+                returned = row.username
                 self.log.info("authenticate: validated OK <%r>" % returned)
+                # Saves add_metadata() querying for the user again:
+                environ[ENVIRON_KEY] = row
+                self.rehash(row, password)
             else:
                 self.log.info("authenticate: FAILED")
 
         else:
             self.log.info("authenticate: no mathcing user")
+            if self.known_users is not None:
+                self.known_users.not_found(login)
+                self.known_users.reject(password)
 
         return returned
 
+    def validate_password(self, row, password):
+        """Check the password against the user's stored hash.
+
+        :param row: The user.get_row() result for the user.
+
+        :returns: True for password is valid.
+
+        """
+        if self.credential_cache is not None:
+            return self.credential_cache.validate(
+                row.username, password, row.password_hash
+            )
+
+        return pwtools.validate_password(password, row.password_hash)
+
+    def rehash(self, found, password):
+        """Store a new hash of the password if the user's current one was made
+        with a deprecated scheme or rounds (see pwtools.init_from_config).
+
+        :param found: The user.get_row() the password was validated for.
+
+        :param password: The plain text password that was validated.
+
+        """
+        if not pwtools.needs_rehash(found.password_hash):
+            return
+
+        self.log.info("rehash: upgrading password hash for <%r>" % (
+            found.username
+        ))
+        try:
+            user.update(
+                username=found.username,
+                password_hash=pwtools.hash_password(password),
+            )
+
+        except:
+            # The login is still good, try again next time:
+            self.log.exception("rehash: failed for <%r>" % found.username)
+
     def add_metadata(self, environ, identity):
         """
         Add the firstname, lastname, name to the identity from
@@ -98,13 +182,68 @@ class SQLAuthenticatorMetadataProvider(object):
 
         """
         userid = identity.get('repoze.who.userid')
-        u = user.find(username=userid)
-        if u[0]:
-            identity.update(u[0].to_dict())
+        if self.metadata_cache is not None:
+            details = self.metadata_cache.get('sql', userid)
+            if details is not None:
+                identity.update(details)
+                return
+
+        # Reuse the row authenticate() recovered on login if there is one:
+        row = environ.get(ENVIRON_KEY)
+        if row is None or row.username != userid:
+            row = user.get_row(
+                userid, extra=self.metadata_extra, fields=self.metadata_fields
+            )
+
+        if row:
+            details = user.row_to_dict(
+                row, extra=self.metadata_extra, fields=self.metadata_fields
+            )
+            if self.metadata_cache is not None:
+                self.metadata_cache.set('sql', userid, details)
+            identity.update(details)
 
 
 def get_auth_from_config(settings, prefix="pp.auth.sql."):
     """
     Return a `SQLAuthenticatorMetadataProvider` from a settings dict
+
+    The verified credential cache can be enabled with::
+
+        pp.auth.sql.credential_cache = true
+        pp.auth.sql.credential_cache_size = 10000
+        pp.auth.sql.credential_cache_ttl = 300
+
+    The user details added by add_metadata are cached if the shared metadata
+    cache is enabled (see cache.get_metadata_cache_from_config). The user's
+    extra data can be left out of the metadata with::
+
+        pp.auth.sql.metadata_extra = false
+
+    Only the user fields the application needs are selected and added if
+    pp.auth.metadata_fields or pp.auth.sql.metadata_fields is set (see the
+    metadata module).
+
+    Logins for usernames that don't exist are rejected without looking the
+    user up with (see known.get_known_users_from_config for the other
+    settings)::
+
+        pp.auth.sql.known_users = true
+
+    Users added by other processes are noticed through user.version(),
+    queried at most every known_users_version_ttl seconds.
+
     """
-    return SQLAuthenticatorMetadataProvider()
+    credential_cache = cache.get_credential_cache_from_config(settings, prefix)
+    return SQLAuthenticatorMetadataProvider(
+        credential_cache=credential_cache,
+        metadata_cache=cache.get_metadata_cache_from_config(settings),
+        metadata_extra=config.get_bool(
+            settings, '%smetadata_extra' % prefix, True
+        ),
+        metadata_fields=metadata.fields_from_config(settings, prefix),
+        known_users=known.get_known_users_from_config(
+            settings, prefix, user.iter_usernames, 'sql',
+            version=user.version,
+        ),
+    )
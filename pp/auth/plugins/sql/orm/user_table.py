@@ -11,6 +11,7 @@ from sqlalchemy import Column
 
 from pp.db import guid
 from pp.db import Base
+from pp.auth import cache
 from pp.auth import pwtools
 
 
@@ -18,6 +19,22 @@ def get_log():
     return logging.getLogger('pp.auth.plugins.sql.orm.user_table')
 
 
+def load_extra(json_extra):
+    """Convert the stored json_extra string into a dict.
+
+    :returns: The dict or an empty dict if nothing is stored.
+
+    """
+    extra = None
+    if isinstance(json_extra, basestring):
+        if isinstance(json_extra, unicode):
+            json_extra = json_extra.encode("utf-8")
+        extra = json.loads(json_extra)
+    if not extra:
+        extra = {}
+    return extra
+
+
 class UserTable(Base):
     """This represents a user stored on the system.
     """
@@ -99,9 +116,12 @@ class UserTable(Base):
 
         self.extra = extra
 
-    def to_dict(self):
+    def to_dict(self, extra=True):
         """Convert into a transportable dict.
 
+        :param extra: If False the extra field is left out, saving the cost
+        of decoding it.
+
         :returns: a dict which could be json encoded.
 
         E.g::
@@ -115,32 +135,41 @@ class UserTable(Base):
             )
 
         """
-
-        return dict(
+        returned = dict(
             id=self.id,
             username=self.username,
             display_name=self.display_name,
             password_hash=self.password_hash,
             email=self.email,
             phone=self.phone,
-            extra=self.extra,
         )
+        if extra:
+            returned['extra'] = self.extra
+
+        return returned
 
     def _extra():
         doc = "Wrapper around user extra data stored as JSON string."
 
         def fget(self):
-            """Get the current contents or return and empty dict."""
-            if isinstance(self.json_extra, basestring):
-                if isinstance(self.json_extra, unicode):
-                    extra = self.json_extra.encode("utf-8")
-                else:
-                    extra = self.json_extra
-                extra = json.loads(extra)
-            if not extra:
-                extra = {}
-            #print "fget: <%s>" % extra
-            return extra
+            """Get the current contents or return and empty dict.
+
+            The decoded dict is kept until json_extra changes. Instances
+            loaded from the database skip __init__ so there may be nothing
+            cached yet.
+
+            Each read returns a new copy of the dict, so changing it doesn't
+            change later reads. The values inside are shared with the cache
+            (a deep copy costs more than decoding), so replace rather than
+            change them in place and store the result with ``extra = ...``.
+
+            """
+            json_extra = self.json_extra
+            cached = getattr(self, '_extra_cache', None)
+            if cached is None or cached[0] is not json_extra:
+                cached = (json_extra, load_extra(json_extra))
+                self._extra_cache = cached
+            return dict(cached[1])
 
         def fset(self, value):
             """Set the new dict only if a dict is given."""
@@ -156,11 +185,14 @@ class UserTable(Base):
 
     extra = property(**_extra())
 
-    def validate_password(self, plain_text):
+    def validate_password(self, plain_text, credential_cache=None):
         """Called to validate the given password.
 
         :param password: This is plain text of the user.
 
+        :param credential_cache: An optional cache.CredentialCache. If given
+        a recently verified password will not be hashed again.
+
         The password will be hashed and the result compared against
         the stored password_hash.
 
@@ -169,6 +201,11 @@ class UserTable(Base):
         :returns: True for password is valid.
 
         """
+        if credential_cache is not None:
+            return credential_cache.validate(
+                self.username, plain_text, self.password_hash
+            )
+
         return pwtools.validate_password(plain_text, self.password_hash)
 
     def __repr__(self):
@@ -220,27 +257,107 @@ def destroy():
     get_log().warn("destroy: done.")
 
 
-def dump():
+# The fields dump() produces and load() accepts:
+FIELDNAMES = (
+    'id', 'username', 'password_hash', 'display_name', 'email', 'phone',
+    'extra',
+)
+
+
+def to_row(user):
+    """Convert a dump() / to_dict() style dict into the column values to
+    insert into the user table.
+
+    A new id is generated if none is given. The extra dict is stored as JSON.
+
+    """
+    if not user.get('password_hash'):
+        raise ValueError(
+            "No password_hash provided for <%s>!" % user.get('username')
+        )
+
+    return dict(
+        id=user.get('id') or guid(),
+        username=user['username'],
+        password_hash=user['password_hash'],
+        display_name=user.get('display_name', ''),
+        email=user.get('email', ''),
+        phone=user.get('phone', ''),
+        json_extra=json.dumps(user.get('extra') or {}),
+    )
+
+
+def insert_rows(session, rows):
+    """Insert the to_row() results with a single executemany."""
+    if rows:
+        session.execute(UserTable.__table__.insert(), rows)
+
+
+def dump(batch_size=1000):
     """
     Called to dump the table to the WidgetStore intermediate format so it
     can be translated to another format or backed up.
 
+    The users are streamed from a server side cursor (where the database
+    supports it) batch_size rows at a time, so the whole table is never
+    held in memory.
+
+    :returns: A generator of dicts with the FIELDNAMES.
+
     """
-    # TODO  FinishMe
+    from pp.db import session
+
+    columns = [getattr(UserTable, f) for f in FIELDNAMES if f != 'extra']
+    columns.append(UserTable.json_extra)
+
+    s = session()
+    query = s.query(*columns).order_by(UserTable.username)
+    query = query.execution_options(stream_results=True)
+    for row in query.yield_per(batch_size):
+        user = dict(zip(FIELDNAMES[:-1], row[:-1]))
+        user['extra'] = load_extra(row[-1])
+        yield user
 
 
-def load(fieldnames, data):
+def load(fieldnames, data, no_commit=False):
     """
     Called to load the UserTable intermediate data format into the
     user table.
 
     Attempt to load all the given data in one go unless there is an
     error, in which case don't load anything and abandon the attempt.
+    The cached metadata of every user loaded is invalidated.
+
+    :params fieldnames: The fields (see FIELDNAMES) to take from each dict.
 
     :params data: This is a list of dicts which are to be loaded into
     the database user table.
 
+    :params no_commit: If True the transaction is left to the caller to
+    commit or roll back.
+
     :returns: None
 
     """
-    # TODO FinishMe
+    from pp.db import session
+
+    rows = [
+        to_row(dict((f, item[f]) for f in fieldnames if f in item))
+        for item in data
+    ]
+
+    s = session()
+    try:
+        insert_rows(s, rows)
+        if not no_commit:
+            s.commit()
+
+    except:
+        if not no_commit:
+            s.rollback()
+        raise
+
+    for row in rows:
+        cache.invalidate_metadata(row['username'])
+
+    get_log().info("load: <%d> users loaded." % len(rows))
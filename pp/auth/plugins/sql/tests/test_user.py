@@ -4,12 +4,18 @@ This tests the product table methods
 Edward Easton, Oisin Mulvihill
 """
 import unittest
+import StringIO
+
+import mock
 
 from pp.db import session, dbsetup
 from pp.db import utils
 
+from pp.auth import cache
+from pp.auth import known
 from pp.auth import pwtools
 from pp.auth.plugins.sql import user
+from pp.auth.plugins.sql.orm import user_table
 
 
 class UserTC(unittest.TestCase):
@@ -106,6 +112,249 @@ class UserTC(unittest.TestCase):
         self.assertEquals(item2.phone, user_dict['phone'])
         self.assertEquals(item2.extra, freeform_data)
 
+    def test_extra_decoded_once(self):
+        """Test the extra dict is only decoded again when json_extra changes.
+        """
+        item = user.UserTable(
+            username='bob.sprocket', password_hash='x', extra=dict(a=1)
+        )
+        with mock.patch.object(
+            user_table, 'load_extra', wraps=user_table.load_extra
+        ) as load_extra:
+            extra = item.extra
+            self.assertEquals(extra, dict(a=1))
+            self.assertEquals(item.extra, dict(a=1))
+            self.assertEquals(load_extra.call_count, 1)
+
+        # Changing what was read doesn't change the user:
+        extra['a'] = 2
+        self.assertEquals(item.extra, dict(a=1))
+        self.assertEquals(item.to_dict()['extra'], dict(a=1))
+        self.assertFalse(item.to_dict()['extra'] is item.to_dict()['extra'])
+
+        item.extra = dict(b=2)
+        self.assertEquals(item.extra, dict(b=2))
+
+        item.json_extra = '{"c": 3}'
+        self.assertEquals(item.extra, dict(c=3))
+
+        del item.extra
+        self.assertEquals(item.extra, {})
+
+        self.assertFalse('extra' in item.to_dict(extra=False))
+
+    def test_validate_password_credential_cache(self):
+        """Test the credential cache is bypassed when the password changes.
+        """
+        username = 'bob.sprocket'
+        credential_cache = cache.CredentialCache()
+
+        item1 = user.add(username=username, password='1234567890')
+        self.assertTrue(
+            item1.validate_password('1234567890', credential_cache)
+        )
+        self.assertTrue(
+            item1.validate_password('1234567890', credential_cache)
+        )
+        self.assertEquals(credential_cache.stats()['hits'], 1)
+
+        user.update(username=username, new_password='0987654321')
+        item2 = user.get(username)
+
+        self.assertFalse(
+            item2.validate_password('1234567890', credential_cache)
+        )
+        self.assertTrue(
+            item2.validate_password('0987654321', credential_cache)
+        )
+
+    def test_get_row_and_find_one(self):
+        """Test the single row look ups used on login.
+        """
+        username = 'bob.sprocket'
+        self.assertEquals(user.get_row(username), None)
+        self.assertEquals(user.find_one(username=username), None)
+
+        item1 = user.add(
+            username=username,
+            password='1234567890',
+            display_name=u'Bob Sprocket',
+            extra=dict(a=1),
+        )
+
+        row = user.get_row(username)
+        self.assertEquals(row.username, username)
+        self.assertEquals(row.password_hash, item1.password_hash)
+        self.assertEquals(user.row_to_dict(row), item1.to_dict())
+
+        self.assertEquals(user.find_one(username=username).id, item1.id)
+
+        # Only the wanted fields (and those needed to log in) are selected:
+        row = user.get_row(username, fields=frozenset(['display_name']))
+        self.assertEquals(row.password_hash, item1.password_hash)
+        self.assertFalse(hasattr(row, 'json_extra'))
+        self.assertEquals(
+            user.row_to_dict(row, fields=frozenset(['display_name'])),
+            dict(display_name=u'Bob Sprocket'),
+        )
+
+    def test_bulk_add_and_dump(self):
+        """Test bulk adding from passwd.csv and JSON lines and dumping back.
+        """
+        password_hash = pwtools.hash_password('1234567890')
+        user.add(username='bob', password_hash=password_hash)
+
+        passwd_csv = (
+            "bob, %(h)s, Bob, Sprocket, bob@example.com\n"
+            "fred, %(h)s, Fred, Sprocket, fred@example.com\n"
+            "fred, %(h)s, Fred, Again, fred@example.com\n"
+            "\n"
+            "janet, %(h)s, Janet, Sprocket, janet@example.com\n"
+        ) % dict(h=password_hash)
+        counts = user.bulk_add(
+            user.read_passwd_csv(StringIO.StringIO(passwd_csv)), batch_size=2
+        )
+        self.assertEquals(counts['added'], 2)
+        self.assertEquals(counts['skipped'], 2)
+        self.assertEquals(user.count(), 3)
+        self.assertEquals(user.get('fred').display_name, 'Fred Sprocket')
+        self.assertTrue(user.get('janet').validate_password('1234567890'))
+
+        out = StringIO.StringIO()
+        self.assertEquals(user.write_json_lines(out, batch_size=2), 3)
+        dumped = list(user.read_json_lines(StringIO.StringIO(out.getvalue())))
+        self.assertEquals(
+            [i['username'] for i in dumped], ['bob', 'fred', 'janet']
+        )
+
+        # Nothing is added when a later user is already present:
+        dumped[0]['username'] = 'alice'
+        self.assertRaises(
+            user.UserPresentError,
+            user.bulk_add, dumped, batch_size=1, skip_existing=False
+        )
+        self.assertEquals(user.count(), 3)
+        self.assertFalse(user.has('alice'))
+
+    def test_bulk_add_no_commit_and_invalidation(self):
+        """Test bulk_add() can leave the transaction to the caller and
+        invalidates the cached metadata of the users given.
+        """
+        user.add(username='bob', password='1234567890')
+        metadata_cache = cache.MetadataCache()
+        metadata_cache.set('sql', 'bob', dict(username='bob'))
+        metadata_cache.set('sql', 'fred', dict(username='fred'))
+
+        s = session()
+        with mock.patch.object(s, 'commit') as commit:
+            user.bulk_add(
+                [
+                    dict(username='bob', password_hash='xxx'),
+                    dict(username='fred', password_hash='xxx'),
+                ],
+                no_commit=True,
+            )
+            self.assertEquals(commit.call_count, 0)
+        s.commit()
+
+        self.assertTrue(user.has('fred'))
+        self.assertEquals(metadata_cache.get('sql', 'bob'), None)
+        self.assertEquals(metadata_cache.get('sql', 'fred'), None)
+
+    def test_bulk_create(self):
+        """Test bulk adding users with plain text passwords.
+        """
+        user.add(username='bob', password='1234567890')
+
+        progress = []
+        counts = user.bulk_create(
+            [
+                dict(username='bob', password='abc'),
+                dict(username='fred', password='0987654321'),
+                dict(username='janet', password=u'í12345í67890é'),
+            ],
+            workers=2,
+            batch_size=2,
+            progress=progress.append,
+        )
+
+        self.assertEquals(counts['added'], 2)
+        self.assertEquals(counts['skipped'], 1)
+        # The existing user's password is not hashed:
+        self.assertEquals(counts['hashed'], 2)
+        self.assertEquals(counts['workers'], 2)
+        self.assertTrue(counts['hashes_per_second_per_core'] > 0)
+        self.assertEquals([i['added'] for i in progress], [1, 2])
+
+        self.assertTrue(user.get('fred').validate_password('0987654321'))
+        self.assertTrue(
+            user.get('janet').validate_password(u'í12345í67890é')
+        )
+
+    def test_metadata_cache_invalidation(self):
+        """Test updating or removing a user drops their cached metadata.
+        """
+        username = 'bob.sprocket'
+        metadata_cache = cache.MetadataCache()
+
+        item1 = user.add(username=username, password='1234567890')
+        metadata_cache.set('sql', username, item1.to_dict())
+
+        user.update(username=username, display_name=u'Bob Sprocket')
+        self.assertEquals(metadata_cache.get('sql', username), None)
+
+        item2 = user.get(username)
+        metadata_cache.set('sql', username, item2.to_dict())
+
+        user.remove(item2.id)
+        self.assertEquals(metadata_cache.get('sql', username), None)
+
+    def test_known_users(self):
+        """Test the known usernames follow users being added and removed.
+        """
+        user.add(username='bob', password='1234567890')
+
+        known_users = known.KnownUsers(user.iter_usernames, 'sql')
+        known_users.rebuild()
+        self.assertFalse(known_users.unknown('bob'))
+        self.assertTrue(known_users.unknown('fred'))
+
+        known_users.not_found('fred')
+        item = user.add(username='fred', password='1234567890')
+        self.assertFalse(known_users.unknown('fred'))
+
+        user.bulk_add([dict(username='alice', password_hash='xxx')])
+        self.assertFalse(known_users.unknown('alice'))
+
+        # Removed users are looked up until the next rebuild:
+        user.remove(item.id)
+        self.assertFalse(known_users.unknown('fred'))
+        known_users.rebuild()
+        self.assertTrue(known_users.unknown('fred'))
+
+    def test_known_users_version(self):
+        """Test the version notices users added, removed or renamed.
+        """
+        item = user.add(username='bob', password='1234567890')
+        first = user.version()
+
+        user.update(username='bob', new_username='robert')
+        renamed = user.version()
+        self.assertNotEquals(renamed, first)
+
+        user.remove(item.id)
+        self.assertNotEquals(user.version(), renamed)
+
+        # Added by another process, unseen by this one's filter:
+        known_users = known.KnownUsers(
+            user.iter_usernames, 'sql', version=user.version, version_ttl=0,
+        )
+        known_users.rebuild()
+        self.assertTrue(known_users.unknown('fred'))
+        with mock.patch.object(known, 'user_added'):
+            user.add(username='fred', password='1234567890')
+        self.assertFalse(known_users.unknown('fred'))
+
     def test_unicode_fields(self):
         """Test the entry of unicode username, email, display name.
         """
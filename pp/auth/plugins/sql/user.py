@@ -14,18 +14,28 @@ The :mod:`pp.auth.user` module is the public access to the lower database
 level.
 
 """
+import csv
+import json
+import time
 import logging
+from itertools import islice
+
+from sqlalchemy import func
 
 # TODO add more imports
 #from sqlalchemy import or_
 #from sqlalchemy.sql import select
 
+from pp.auth import cache
+from pp.auth import known
 from pp.auth import pwtools
 from pp.db import session
 from pp.db.utils import generic_has, generic_get, generic_find
 from pp.db.utils import generic_update, generic_add, generic_remove
 
+from orm import user_table
 from orm.user_table import UserTable
+from orm.user_table import load_extra
 
 
 def get_log(extra=None):
@@ -42,9 +52,24 @@ get = generic_get(UserTable, 'username')
 
 find = generic_find(UserTable)
 
+# The fields UserTable.to_dict() returns and the columns they come from, see
+# get_row():
+ROW_FIELDS = (
+    ('id', UserTable.id),
+    ('username', UserTable.username),
+    ('display_name', UserTable.display_name),
+    ('password_hash', UserTable.password_hash),
+    ('email', UserTable.email),
+    ('phone', UserTable.phone),
+    ('extra', UserTable.json_extra),
+)
+
+# Always selected by get_row() as they are needed to log in:
+LOGIN_FIELDS = frozenset(('username', 'password_hash'))
+
 g_update = generic_update(UserTable)
 
-remove = generic_remove(UserTable)
+g_remove = generic_remove(UserTable)
 
 
 class UserPresentError(Exception):
@@ -78,7 +103,9 @@ def add(**user):
 
     log.debug("The username <%s> is not present. OK to add." % username)
 
-    return g_add(**user)
+    returned = g_add(**user)
+    known.user_added(username, 'sql')
+    return returned
 
 
 def update(**user):
@@ -141,12 +168,335 @@ def update(**user):
     g_update(current, **update_data)
     log.debug("<%s> updated OK." % user['username'])
 
+    # Don't let the mdproviders hand out the old details:
+    cache.invalidate_metadata(user['username'])
+    if 'username' in update_data:
+        cache.invalidate_metadata(update_data['username'])
+        known.user_added(update_data['username'], 'sql')
+        known.user_removed(user['username'], 'sql')
+
     # Return the updated user details:
     return get(user['username'])
 
 
+def remove(item):
+    """Remove a user from the system.
+
+    :param item: The user's id or a user_table.UserTable instance.
+
+    """
+    if isinstance(item, UserTable):
+        username = item.username
+    else:
+        found = session().query(UserTable).filter_by(id=item).first()
+        username = found.username if found else None
+
+    g_remove(item)
+
+    if username:
+        cache.invalidate_metadata(username)
+        known.user_removed(username, 'sql')
+
+
+def find_one(**kwargs):
+    """Return the first user matching the given fields or None.
+
+    Unlike find() this stops the database after one row (LIMIT 1). Use it
+    with a unique field (username, id) to recover a single user.
+
+    """
+    s = session()
+    return s.query(UserTable).filter_by(**kwargs).limit(1).first()
+
+
+def get_row(username, extra=True, fields=None):
+    """Recover a user's fields without building a UserTable instance.
+
+    This is the single indexed query made on login. Only the ROW_FIELDS
+    columns are selected and the extra JSON is not parsed until
+    row_to_dict() is called.
+
+    :param extra: If False the json_extra column is not selected.
+
+    :param fields: If given only the columns for these ROW_FIELDS (and the
+        LOGIN_FIELDS) are selected.
+
+    :returns: A row with the selected columns as attributes or None.
+
+    """
+    columns = [
+        column for name, column in ROW_FIELDS
+        if (fields is None or name in fields or name in LOGIN_FIELDS)
+        and (extra or name != 'extra')
+    ]
+    s = session()
+    query = s.query(*columns).filter(UserTable.username == username)
+    return query.limit(1).first()
+
+
+def row_to_dict(row, extra=True, fields=None):
+    """Convert a get_row() result into the same dict UserTable.to_dict()
+    returns.
+
+    :param extra: If False the extra field is left out, as it is if the row
+        was recovered without it.
+
+    :param fields: If given only these fields are returned.
+
+    """
+    returned = {}
+    for name, column in ROW_FIELDS:
+        if fields is not None and name not in fields:
+            continue
+        if name == 'extra':
+            if extra and hasattr(row, 'json_extra'):
+                returned['extra'] = load_extra(row.json_extra)
+        elif hasattr(row, name):
+            returned[name] = getattr(row, name)
+
+    return returned
+
+
+def read_passwd_csv(lines):
+    """Read users from the plain plugin's passwd.csv format.
+
+    Each line is: username, password_hash, firstname, lastname, email
+
+    :param lines: An open file or any iterable of lines.
+
+    :returns: A generator of dicts suitable for bulk_add().
+
+    """
+    for row in csv.reader(lines):
+        row = [i.strip() for i in row]
+        if not row or not row[0]:
+            continue
+        row += [''] * (5 - len(row))
+        username, password_hash, firstname, lastname, email = row[:5]
+        yield dict(
+            username=username,
+            password_hash=password_hash,
+            display_name=("%s %s" % (firstname, lastname)).strip(),
+            email=email,
+        )
+
+
+def read_json_lines(lines):
+    """Read users stored one JSON object per line (see write_json_lines).
+
+    :param lines: An open file or any iterable of lines.
+
+    :returns: A generator of dicts suitable for bulk_add().
+
+    """
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def write_json_lines(out, batch_size=1000):
+    """Stream every user to out, one JSON object per line.
+
+    :returns: The number of users written.
+
+    """
+    total = 0
+    for item in user_table.dump(batch_size):
+        out.write(json.dumps(item) + "\n")
+        total += 1
+    return total
+
+
+def _hash_batch(items, executor, counts):
+    """Replace the plain text 'password' in each item with a password_hash,
+    hashing them all at once in the executor's worker processes.
+    """
+    to_hash = [i for i in items if i.get('password')]
+    if not to_hash:
+        return items
+
+    started = time.time()
+    passwords = [i['password'] for i in to_hash]
+    if executor is not None:
+        hashes = pwtools.hash_many(passwords, executor)
+    else:
+        hashes = [pwtools.hash_password(p) for p in passwords]
+    counts['hash_seconds'] += time.time() - started
+    counts['hashed'] += len(hashes)
+
+    for item, password_hash in zip(to_hash, hashes):
+        item['password_hash'] = password_hash
+        del item['password']
+
+    return items
+
+
+def _throughput(counts, workers):
+    """Add the hashes/sec (overall and per core) to the bulk_add counts."""
+    seconds = counts['hash_seconds']
+    rate = counts['hashed'] / seconds if seconds else 0.0
+    counts['workers'] = workers
+    counts['hashes_per_second'] = rate
+    counts['hashes_per_second_per_core'] = rate / workers
+    return counts
+
+
+def bulk_add(
+    users, batch_size=1000, skip_existing=True, executor=None, progress=None,
+    no_commit=False,
+):
+    """Add many users in a single transaction.
+
+    The users are handled batch_size at a time. Each batch costs one query to
+    find the usernames already present and one executemany insert, rather
+    than the two queries per user add() makes. Nothing is added if an error
+    occurs.
+
+    The cached metadata of every username given (added or skipped) is
+    invalidated, see cache.invalidate_metadata().
+
+    :param users: An iterable of dicts each with a username and either a
+        password_hash (see read_passwd_csv() / read_json_lines()) or a plain
+        text password to hash.
+
+    :param batch_size: The users checked and inserted at a time.
+
+    :param skip_existing: If True users whose username is present (or
+        repeated in the users given) are skipped. Otherwise UserPresentError
+        is raised.
+
+    :param executor: The pwtools.hashing_pool() plain text passwords are
+        hashed in (see bulk_create()). By default they are hashed one at a
+        time with pwtools.hash_password().
+
+    :param progress: Called with the counts dict after each batch.
+
+    :param no_commit: If True the transaction is left to the caller to
+        commit or roll back, as generic_update(no_commit=True) does.
+
+    :returns: A dict with the 'added' and 'skipped' counts, the number of
+        passwords 'hashed' and the 'hash_seconds' this took.
+
+    """
+    log = get_log('bulk_add')
+
+    counts = dict(added=0, skipped=0, hashed=0, hash_seconds=0.0)
+    seen = set()
+    skipped = set()
+    users = iter(users)
+    s = session()
+    try:
+        while True:
+            batch = list(islice(users, batch_size))
+            if not batch:
+                break
+
+            usernames = set(i['username'] for i in batch)
+            query = s.query(UserTable.username)
+            query = query.filter(UserTable.username.in_(usernames))
+            present = set(u for (u,) in query)
+
+            new_users = []
+            for item in batch:
+                username = item['username']
+                if username in present or username in seen:
+                    if not skip_existing:
+                        raise UserPresentError(
+                            "The username <%s> is present and cannot be "
+                            "added." % username
+                        )
+                    counts['skipped'] += 1
+                    skipped.add(username)
+                    continue
+                seen.add(username)
+                new_users.append(dict(item))
+
+            # Only the users being added are worth the cost of hashing:
+            new_users = _hash_batch(new_users, executor, counts)
+            rows = [user_table.to_row(item) for item in new_users]
+
+            user_table.insert_rows(s, rows)
+            counts['added'] += len(rows)
+            log.debug("added <%(added)d> skipped <%(skipped)d>" % counts)
+            if progress:
+                progress(dict(counts))
+
+        if not no_commit:
+            s.commit()
+
+    except:
+        if not no_commit:
+            s.rollback()
+        raise
+
+    for username in seen | skipped:
+        cache.invalidate_metadata(username)
+    for username in seen:
+        known.user_added(username, 'sql')
+
+    log.info("added <%(added)d> skipped <%(skipped)d> users." % counts)
+    return counts
+
+
+def bulk_create(users, workers=None, batch_size=1000, **kwargs):
+    """Add many users with plain text passwords, see bulk_add().
+
+    The passwords of each batch are hashed in parallel across a pool of
+    worker processes before the rows are built. The pool started by
+    pwtools.init_executor() is used if there is one.
+
+    :param workers: The size of the pool started for this call. By default
+        there is a worker per CPU.
+
+    :returns: The bulk_add() counts with the 'workers' used and the hashing
+        throughput in 'hashes_per_second' and 'hashes_per_second_per_core'.
+
+    """
+    with pwtools.hashing_pool(workers) as executor:
+        counts = bulk_add(
+            users, batch_size=batch_size, executor=executor, **kwargs
+        )
+        counts = _throughput(counts, pwtools.pool_workers(executor))
+
+    get_log('bulk_create').info(
+        "hashed <%(hashed)d> passwords at <%(hashes_per_second).1f>/sec "
+        "(<%(hashes_per_second_per_core).1f>/sec per core)" % counts
+    )
+    return counts
+
+
 def count():
     """Return the number of users on the system."""
     s = session()
     query = s.query(UserTable)
     return query.count()
+
+
+def iter_usernames(batch_size=1000):
+    """Generate every username, fetching batch_size rows at a time.
+
+    This is the known.KnownUsers loader for the sql plugin.
+
+    """
+    s = session()
+    query = s.query(UserTable.username).yield_per(batch_size)
+    for (username,) in query:
+        yield username
+
+
+def version():
+    """Return a marker which changes when users are added, removed or
+    renamed: the number of users, the total length of their usernames and
+    the largest id.
+
+    This is the known.KnownUsers version for the sql plugin. A rename to a
+    username of the same length isn't spotted until the next rebuild.
+
+    """
+    s = session()
+    return tuple(s.query(
+        func.count(UserTable.username),
+        func.sum(func.length(UserTable.username)),
+        func.max(UserTable.id),
+    ).one())
@@ -5,7 +5,13 @@ Oisin Mulvihill, Ed Easton
 2009-05-20
 
 """
+import os
+import time
+import shutil
+import tempfile
+
 import mock
+from pp.auth import cache
 from pp.auth import pwtools
 from pp.auth.plugins import plain
 
@@ -54,6 +60,17 @@ def test_authenticate_invalid(mock_validate):
     identity = dict(login='admin1', password='admin1')
     assert p.authenticate({}, identity) is None
 
+@mock.patch('pp.auth.pwtools.validate_password', return_value=True)
+def test_authenticate_credential_cache(mock_validate):
+    """Repeat logins are served by the credential cache."""
+    p = plain.PlainAuthenticatorMetadataProvider(
+        user_data, credential_cache=cache.CredentialCache()
+    )
+    identity = dict(login='user1', password='user1')
+    assert p.authenticate({}, identity) == 'user1'
+    assert p.authenticate({}, identity) == 'user1'
+    assert mock_validate.call_count == 1
+
 def test_add_metadata():
     p = plain.PlainAuthenticatorMetadataProvider(user_data)
     env = {}
@@ -75,3 +92,190 @@ def test_add_metadata_repeat():
     assert identity['lastname'] == 'Wellington'
     assert identity['name'] == 'Bob Wellington'
     assert identity['email'] == 'bob@example.com'
+
+
+def test_add_metadata_fields():
+    p = plain.PlainAuthenticatorMetadataProvider(
+        user_data, metadata_fields=frozenset(['name', 'email'])
+    )
+    identity = {'repoze.who.userid': 'admin1'}
+    p.add_metadata({}, identity)
+    assert identity == {
+        'repoze.who.userid': 'admin1',
+        'name': 'Admin Istrator',
+        'email': 'admin@example.com',
+    }
+
+
+def test_user_store_indexes():
+    store = plain.PlainUserStore(user_data)
+    assert len(store) == 4  # includes the header row
+    assert store.get('user1').name == 'Janet Ganet'
+    assert store.find_by_email('bob@example.com').username == 'manager1'
+    assert store.find_by_email('nobody@example.com') is None
+    assert store.get('user1')['email'] == 'janet@example.com'
+
+
+def test_get_auth_from_config_shares_store():
+    fd, password_file = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(user_data)
+        settings = {'pp.auth.plain.password_file': password_file}
+
+        auth = plain.get_auth_from_config(settings)
+        mdprovider = plain.get_auth_from_config(settings)
+        assert auth.store is mdprovider.store
+        assert 'admin1' in auth.userDetails
+
+    finally:
+        plain._files.pop(os.path.abspath(password_file))
+        os.remove(password_file)
+
+
+def test_user_store_reload_only_changes_rows():
+    store = plain.PlainUserStore(user_data)
+    admin1 = store.get('admin1')
+    user1 = store.get('user1')
+
+    changes = store.load(
+        user_data.replace('janet@example.com', 'janet@example.net') +
+        "user2, xxx, Fred, Ganet, fred@example.com\n"
+    )
+    assert changes == dict(added=1, changed=1, removed=0, unchanged=3)
+    assert store.get('admin1') is admin1
+    assert store.get('user1') is not user1
+    assert store.find_by_email('janet@example.net').username == 'user1'
+    assert store.find_by_email('janet@example.com') is None
+
+    changes = store.load(user_data.replace(
+        "admin1, xxx, Admin, Istrator, admin@example.com\n", ""
+    ))
+    assert changes['removed'] == 2
+    assert 'admin1' not in store
+    assert 'user2' not in store
+
+
+def test_password_file_hot_reload():
+    fd, password_file = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(user_data)
+        settings = {
+            'pp.auth.plain.password_file': password_file,
+            'pp.auth.plain.reload_interval': '0.01',
+        }
+        p = plain.get_auth_from_config(settings)
+        assert p.user_file._thread.is_alive()
+
+        with open(password_file, 'a') as fp:
+            fp.write("user2, xxx, Fred, Ganet, fred@example.com\n")
+
+        # Wait for the watching thread to notice:
+        for i in range(500):
+            if 'user2' in p.store:
+                break
+            time.sleep(0.01)
+
+        identity = {'repoze.who.userid': 'user2'}
+        p.add_metadata({}, identity)
+        assert identity['name'] == 'Fred Ganet'
+
+    finally:
+        plain._files.pop(os.path.abspath(password_file)).stop()
+        os.remove(password_file)
+
+
+def test_group_and_permission_adapters():
+    tmpdir = tempfile.mkdtemp()
+    groups_file = os.path.join(tmpdir, 'groups.ini')
+    permissions_file = os.path.join(tmpdir, 'permissions.ini')
+    try:
+        with open(groups_file, 'w') as fp:
+            fp.write("[admin]\nadmin1\n\n[staff]\nadmin1\nuser1\n")
+        with open(permissions_file, 'w') as fp:
+            fp.write("[edit]\nadmin\n\n[view]\nadmin\nstaff\n")
+        settings = {
+            'pp.auth.plain.groups_file': groups_file,
+            'pp.auth.plain.permissions_file': permissions_file,
+        }
+        groups = plain.get_groups_from_config(settings)
+        permissions = plain.get_permissions_from_config(settings)
+        assert groups.access_files is permissions.access_files
+
+        credentials = {'repoze.who.userid': 'admin1'}
+        assert groups.find_sections(credentials) == set(['admin', 'staff'])
+        assert permissions.find_sections('staff') == set(['view'])
+        assert groups.info['staff'] == set(['admin1', 'user1'])
+
+        # Both adapters see the files once rebuilt:
+        with open(permissions_file, 'a') as fp:
+            fp.write("\n[delete]\nstaff\n")
+        os.utime(permissions_file, (0, 0))
+        assert groups.access_files.check()
+        assert permissions.find_sections('staff') == set(['view', 'delete'])
+
+    finally:
+        plain._access_files.pop((groups_file, permissions_file), None)
+        shutil.rmtree(tmpdir)
+
+
+def test_groups_without_permissions_file():
+    tmpdir = tempfile.mkdtemp()
+    groups_file = os.path.join(tmpdir, 'groups.ini')
+    try:
+        with open(groups_file, 'w') as fp:
+            fp.write("[admin]\nadmin1\n")
+        settings = {
+            'pp.auth.plain.groups_file': groups_file,
+            'pp.auth.plain.permissions_file': os.path.join(
+                tmpdir, 'missing.ini'
+            ),
+        }
+
+        # The groups load on their own:
+        groups = plain.get_groups_from_config(settings)
+        credentials = {'repoze.who.userid': 'admin1'}
+        assert groups.find_sections(credentials) == set(['admin'])
+
+        try:
+            plain.get_permissions_from_config(settings)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("ValueError not raised!")
+
+    finally:
+        plain._access_files.pop((groups_file, None), None)
+        shutil.rmtree(tmpdir)
+
+
+def test_user_store_load_file():
+    fd, password_file = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(user_data * 3)
+            fp.write("user2, xxx, Fred, Ganet\n")
+
+        streamed = plain.PlainUserStore()
+        changes = streamed.load_file(password_file)
+        assert changes['added'] == 5
+        assert 'total' in changes['timings']
+
+        # Force the parallel parsing of this small file:
+        with mock.patch('pp.auth.plugins.plain.PARALLEL_MIN_BYTES', 0):
+            parallel = plain.PlainUserStore()
+            changes = parallel.load_file(password_file, workers=3)
+        assert 'parse' in changes['timings']
+
+        for store in (streamed, parallel):
+            assert len(store) == 5
+            assert store.get('user2').fields() == (
+                'user2', 'xxx', 'Fred', 'Ganet', ''
+            )
+            assert store.find_by_email('bob@example.com').username == (
+                'manager1'
+            )
+
+    finally:
+        os.remove(password_file)
@@ -1,11 +1,19 @@
 """
 
 """
+import time
 import logging
 
+from requests import RequestException
 from repoze.what.adapters import BaseSourceAdapter
 from repoze.what.plugins.ini import INIGroupAdapter
 
+from pp.auth import cache
+from pp.auth import known
+from pp.auth import config
+from pp.auth import breaker
+from pp.auth import metadata
+from pp.auth import transport
 from pp.user.client import rest
 
 
@@ -39,12 +47,41 @@ class UserServiceAuthenticatorMetadataProvider(object):
     """
     """
 
-    def __init__(self, user_service_uri):
+    def __init__(
+        self, user_service_uri, session=None, metadata_cache=None,
+        metadata_fields=None, known_users=None, circuit_breaker=None,
+    ):
         """Set up the UserService REST client library with the location
         to communicate with.
+
+        :param session: The requests Session (see transport.make_session)
+            the client sends its requests through. By default this is a
+            pooled keep-alive session with timeouts and retries.
+
+        :param metadata_cache: An optional cache.MetadataCache used to skip
+            asking the user service for the user's details on every request.
+
+        :param metadata_fields: If given only these user fields are added to
+            the identity (see metadata.project).
+
+        :param known_users: An optional known.KnownUsers used to reject
+            logins for usernames that don't exist without asking the user
+            service.
+
+        :param circuit_breaker: An optional breaker.CircuitBreaker the calls
+            to the user service are made through. While it is open logins
+            fail and only cached metadata is added, without waiting on the
+            user service.
+
         """
         self.log = get_log("UserServiceAuthenticatorMetadataProvider")
+        self.metadata_cache = metadata_cache
+        self.metadata_fields = metadata_fields
+        self.known_users = known_users
+        self.circuit_breaker = circuit_breaker
         self.us = rest.UserService(user_service_uri)
+        self.session = session or transport.make_session()
+        transport.use_session(self.us, self.session)
 
     def authenticate(self, environ, identity):
         """
@@ -65,22 +102,41 @@ class UserServiceAuthenticatorMetadataProvider(object):
 
         get_log().info("authenticate: %r" % login)
         password = identity['password']
+        if self.known_users is not None and self.known_users.unknown(login):
+            get_log().info("authenticate: unknown user <%s>" % login)
+            self.known_users.reject(password)
+            return
+
         try:
             # get_log().info(
             #     "authenticate:  attempting to authenticate <%s>" % login
             # )
-            rc = self.us.api.authenticate(login, password)
+            start = time.time()
+            rc = self.call(self.us.api.authenticate, login, password)
+
+        except breaker.CircuitOpenError, e:
+            get_log().warn("authenticate: <%s> not checked: %s" % (login, e))
 
         except:
             get_log().exception("Authenticate comms error for <%s>: " % login)
 
         else:
+            if self.known_users is not None:
+                # Rejecting unknown users takes as long:
+                self.known_users.observe(time.time() - start)
             if rc:
                 # get_log().info("authenticate: <%s> authenticated OK." % login)
                 return login
             else:
                 get_log().info("authenticate: <%s> authenticate FAIL." % login)
 
+    def call(self, fn, *args):
+        """Call the user service through the circuit breaker if there is
+        one.
+        """
+        if self.circuit_breaker is None:
+            return fn(*args)
+        return self.circuit_breaker.call(fn, *args)
 
     def add_metadata(self, environ, identity):
         """
@@ -98,8 +154,19 @@ class UserServiceAuthenticatorMetadataProvider(object):
             get_log().info("No userid to get details for <%s>" % userid)
             return
 
+        if self.metadata_cache is not None:
+            result = self.metadata_cache.get('userservice', userid)
+            if result is not None:
+                identity.update(result)
+                return
+
         try:
-            result = self.us.api.get(userid)
+            result = self.call(self.us.api.get, userid)
+
+        except breaker.CircuitOpenError, e:
+            get_log().warn("add_metadata: <%s> not recovered: %s" % (
+                userid, e
+            ))
 
         except:
             get_log().exception("user recovery failured for <%s>: " % userid)
@@ -107,15 +174,84 @@ class UserServiceAuthenticatorMetadataProvider(object):
         else:
             # get_log().debug("user metadata recovered: <%s>" % result)
             if result:
+                # The user service returns every field, keep what's needed:
+                result = metadata.project(result, self.metadata_fields)
+                if self.metadata_cache is not None:
+                    self.metadata_cache.set('userservice', userid, result)
                 identity.update(result)
 
 
 def get_auth_from_config(settings, prefix="pp.auth.userservice."):
     """
     Return a `UserServiceAuthenticatorMetadataProvider` from a settings dict
+
+    The settings recognised are::
+
+        pp.auth.userservice.uri = http://localhost:port
+
+        # Optional connection pool, timeouts (seconds) and retries:
+        pp.auth.userservice.pool_size = 10
+        pp.auth.userservice.connect_timeout = 3.05
+        pp.auth.userservice.read_timeout = 10
+        pp.auth.userservice.retries = 2
+        pp.auth.userservice.retry_backoff = 0.1
+
+    The user details added by add_metadata are cached if the shared metadata
+    cache is enabled (see cache.get_metadata_cache_from_config). Only the
+    fields listed in pp.auth.metadata_fields or
+    pp.auth.userservice.metadata_fields are added (see the metadata module).
+
+    Logins for usernames that don't exist can be rejected without asking the
+    user service, given a listing of every username (one per line, or a
+    plain plugin password file). See known.get_known_users_from_config for
+    the other settings::
+
+        pp.auth.userservice.known_users = true
+        pp.auth.userservice.known_users_file = /path/to/usernames.csv
+
+        # Optional, the default. A listing not rewritten for this many
+        # seconds is out of date and nothing is rejected until it is:
+        pp.auth.userservice.known_users_file_max_age = 3600
+
+    Whatever adds users to the user service must rewrite the listing. The
+    rejections take as long as a call to the user service does on average,
+    so the response time doesn't give away which usernames exist.
+
+    The calls to the user service go through a circuit breaker, which stops
+    calling it for a while when it keeps failing to answer (see
+    breaker.get_breaker_from_config for the settings). Only connection and
+    HTTP errors count, not errors for the logins it answers.
+
     """
     user_service_uri = settings['%suri' % prefix]
-    return UserServiceAuthenticatorMetadataProvider(user_service_uri)
+    session = transport.session_from_config(settings, prefix)
+
+    known_users = None
+    known_users_file = settings.get('%sknown_users_file' % prefix)
+    if known_users_file:
+        # The user service's own check can't be timed locally:
+        known_users = known.get_known_users_from_config(
+            settings, prefix, known.usernames_from_file(known_users_file),
+            'userservice', dummy_verify=False,
+            version=known.file_version(
+                known_users_file,
+                config.get_float(
+                    settings, '%sknown_users_file_max_age' % prefix, 3600
+                ),
+            ),
+        )
+
+    return UserServiceAuthenticatorMetadataProvider(
+        user_service_uri,
+        session,
+        metadata_cache=cache.get_metadata_cache_from_config(settings),
+        metadata_fields=metadata.fields_from_config(settings, prefix),
+        known_users=known_users,
+        circuit_breaker=breaker.get_breaker_from_config(
+            settings, prefix, 'userservice<%s>' % user_service_uri,
+            errors=(RequestException,),
+        ),
+    )
 
 
 def get_groups_from_config(settings, prefix="pp.auth.userservice."):
@@ -12,6 +12,9 @@ import logging
 from repoze.what.adapters import BaseSourceAdapter
 from repoze.what.plugins.ini import INIGroupAdapter
 
+from pp.auth import cache
+from pp.auth import metadata
+
 
 def get_log(extra=None):
     m = "{}.{}".format(__name__, extra) if extra else __name__
@@ -42,12 +45,18 @@ def register():
 class USMBMetadataProvider(object):
     """User Service Mongo Backend Metadata and Authentication provider.
     """
-    def __init__(self, config):
+    def __init__(self, config, metadata_cache=None, metadata_fields=None):
         """Set up the UserService REST client library with the location
         to communicate with.
 
         :param config: The mongodb config.
 
+        :param metadata_cache: An optional cache.MetadataCache used to skip
+            recovering the user's details on every request.
+
+        :param metadata_fields: If given only these user fields are added to
+            the identity (see metadata.project).
+
         E.g::
 
             cfg = dict(
@@ -59,6 +68,8 @@ class USMBMetadataProvider(object):
 
         """
         self.log = get_log("{}.USMBMetadataProvider".format(__name__))
+        self.metadata_cache = metadata_cache
+        self.metadata_fields = metadata_fields
 
         from pp.user.model import db
 
@@ -132,6 +143,12 @@ class USMBMetadataProvider(object):
             )
             return
 
+        if self.metadata_cache is not None:
+            result = self.metadata_cache.get('usmb', userid)
+            if result is not None:
+                identity.update(result)
+                return
+
         try:
             result = user.get(userid)
 
@@ -143,18 +160,31 @@ class USMBMetadataProvider(object):
         else:
             #get_log().debug("user metadata recovered: <{!r}>".format(result))
             if result:
+                result = metadata.project(result, self.metadata_fields)
+                if self.metadata_cache is not None:
+                    self.metadata_cache.set('usmb', userid, result)
                 identity.update(result)
 
 
 def get_auth_from_config(settings, prefix="mongodb."):
     """Return a `USMBMetadataProvider` from a settings dict.
+
+    The user details added by add_metadata are cached if the shared metadata
+    cache is enabled (see cache.get_metadata_cache_from_config). Only the
+    fields listed in pp.auth.metadata_fields are added (see the metadata
+    module).
+
     """
     cfg = dict(
         dbname=settings['%sdbname' % prefix],
         port=int(settings['%sport' % prefix]),
         host=settings['%shost' % prefix],
     )
-    return USMBMetadataProvider(cfg)
+    return USMBMetadataProvider(
+        cfg,
+        metadata_cache=cache.get_metadata_cache_from_config(settings),
+        metadata_fields=metadata.fields_from_config(settings, prefix),
+    )
 
 
 def get_groups_from_config(settings, prefix="pp.auth.userservice."):
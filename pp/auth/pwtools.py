@@ -2,26 +2,61 @@
 """
 This provides password hashing and validate functions which can be
 
-This uses passlib.hash sha512_crypt to implement strong passord hashing rather
-then some home brew approach.
+This uses a passlib CryptContext to implement strong passord hashing rather
+then some home brew approach. By default this is sha512_crypt. The schemes
+and their rounds can be changed from the settings (see init_from_config()).
+Hashes made with a deprecated scheme or rounds still validate, and
+needs_rehash() reports they should be replaced on the user's next login.
+
+Hashing is CPU bound and holds the GIL while it runs. Calling init_executor()
+(or init_from_config() with pp.auth.pwtools.executor = true) moves the work
+into a pool of worker processes. The calling thread then only waits on the
+result, leaving the other threads free to serve requests.
 
 """
-from passlib.hash import sha512_crypt
+import os
+import math
+import time
+import logging
+import contextlib
+import multiprocessing
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
 
+from passlib.context import CryptContext
 
-def hash_password(plaintext_password):
-    """Securely hash the plain text password ready for storage.
+from pp.auth import config
 
-    :param plain_password: This is a user meaningful string.
 
-    """
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# The default used until init_context() is called:
+DEFAULT_SCHEMES = ['sha512_crypt']
+
+_context = CryptContext(schemes=DEFAULT_SCHEMES)
+
+# The process pool set up by init_executor(). None means hashing is done in
+# the calling thread.
+_executor = None
+_workers = None
+
+# A hash of a random password made with the current context, for
+# dummy_validate():
+_dummy_hash = None
+
+
+def _hash_password(plaintext_password):
+    """Does the work of hash_password(), in this or a worker process."""
     if isinstance(plaintext_password, unicode):
         password_8bit = plaintext_password.encode('UTF-8')
     else:
         password_8bit = plaintext_password
 
     # Use password lib strong hashing rather then home brew:
-    hashed_password = sha512_crypt.encrypt(password_8bit)
+    hashed_password = _context.hash(password_8bit)
 
     if not isinstance(hashed_password, unicode):
         hashed_password = hashed_password.decode('UTF-8')
@@ -29,6 +64,154 @@ def hash_password(plaintext_password):
     return hashed_password
 
 
+def _validate_password(plaintext_password, password_hash):
+    """Does the work of validate_password(), in this or a worker process."""
+    if isinstance(plaintext_password, unicode):
+        password_8bit = plaintext_password.encode('UTF-8')
+    else:
+        password_8bit = plaintext_password
+
+    if isinstance(password_hash, unicode):
+        password_hash = password_hash.encode('UTF-8')
+
+    return _context.verify(password_8bit, password_hash)
+
+
+def _completed(fn, *args):
+    """Run fn here and return a Future already holding the outcome."""
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception, e:
+        future.set_exception(e)
+    return future
+
+
+def _submit(fn, *args):
+    """Run fn in the process pool if there is one, otherwise here."""
+    if _executor is not None:
+        return _executor.submit(fn, *args)
+    return _completed(fn, *args)
+
+
+def _asyncio():
+    """Recover asyncio (Python 3) or its Python 2 port trollius."""
+    try:
+        import asyncio
+    except ImportError:
+        import trollius as asyncio
+    return asyncio
+
+
+def init_context(schemes=None, deprecated='auto', **options):
+    """Change the password hashing schemes and their options.
+
+    :param schemes: A list of passlib scheme names. The first is used to hash
+        new passwords. By default this is DEFAULT_SCHEMES.
+
+    :param deprecated: The schemes whose hashes need replacing on login.
+        The default 'auto' deprecates all but the first scheme.
+
+    :param options: Any other passlib CryptContext options, for example
+        sha512_crypt__default_rounds=80000 or sha512_crypt__min_rounds=80000
+        (hashes with fewer rounds then need replacing).
+
+    :returns: The new passlib CryptContext.
+
+    """
+    global _context, _dummy_hash
+
+    schemes = schemes or DEFAULT_SCHEMES
+    get_log("init_context").info("schemes<%s> options<%s>" % (
+        schemes, options
+    ))
+    _context = CryptContext(schemes=schemes, deprecated=deprecated, **options)
+    _dummy_hash = None
+
+    # Worker processes recover the context as it was when they started:
+    if _executor is not None:
+        init_executor(_workers)
+
+    return _context
+
+
+def init_executor(workers=None):
+    """Hash and validate passwords in a pool of worker processes.
+
+    Any existing pool is shut down first.
+
+    :param workers: The number of worker processes. This defaults to the
+        number of CPUs on the machine.
+
+    :returns: The new ProcessPoolExecutor.
+
+    """
+    global _executor, _workers
+
+    shutdown_executor()
+    workers = workers or multiprocessing.cpu_count()
+    get_log("init_executor").info("starting <%d> hashing workers." % workers)
+    _executor = ProcessPoolExecutor(max_workers=workers)
+    _workers = workers
+
+    return _executor
+
+
+def shutdown_executor(wait=True):
+    """Stop the worker processes, returning to hashing in the caller."""
+    global _executor
+
+    executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def init_from_config(settings, prefix="pp.auth.pwtools."):
+    """Set up the password tools from a settings dict.
+
+    The settings recognised are::
+
+        # The passlib schemes, the first is used for new hashes:
+        pp.auth.pwtools.schemes = sha512_crypt
+        pp.auth.pwtools.deprecated = auto
+
+        # Any other passlib CryptContext option, for example the rounds
+        # suggested by the pp-auth-calibrate command:
+        pp.auth.pwtools.sha512_crypt__default_rounds = 80000
+        pp.auth.pwtools.sha512_crypt__min_rounds = 80000
+
+        # Hash/validate in a process pool, sized to the number of CPUs unless
+        # workers is given:
+        pp.auth.pwtools.executor = true
+        pp.auth.pwtools.workers = 4
+
+    """
+    options = {}
+    for key, value in settings.items():
+        if key.startswith(prefix) and '__' in key:
+            options[key[len(prefix):]] = value
+
+    schemes = config.get_list(settings, '%sschemes' % prefix)
+    if schemes or options:
+        init_context(
+            schemes,
+            settings.get('%sdeprecated' % prefix, 'auto'),
+            **options
+        )
+
+    if config.get_bool(settings, '%sexecutor' % prefix):
+        init_executor(config.get_int(settings, '%sworkers' % prefix))
+
+
+def hash_password(plaintext_password):
+    """Securely hash the plain text password ready for storage.
+
+    :param plain_password: This is a user meaningful string.
+
+    """
+    return hash_password_future(plaintext_password).result()
+
+
 def validate_password(plaintext_password, password_hash):
     """Check the password against existing credentials.
 
@@ -41,12 +224,195 @@ def validate_password(plaintext_password, password_hash):
     :return: Whether the password is valid.
 
     """
-    if isinstance(plaintext_password, unicode):
-        password_8bit = plaintext_password.encode('UTF-8')
-    else:
-        password_8bit = plaintext_password
+    return validate_password_future(plaintext_password, password_hash).result()
+
+
+def dummy_validate(plaintext_password):
+    """Take as long as validate_password() would for a user who doesn't
+    exist, so the response time doesn't give away which usernames do.
+
+    :returns: False
+
+    """
+    global _dummy_hash
+
+    if _dummy_hash is None:
+        _dummy_hash = hash_password(os.urandom(16).encode('hex'))
+    validate_password(plaintext_password, _dummy_hash)
+    return False
+
 
+def needs_rehash(password_hash):
+    """Check whether a stored hash uses a deprecated scheme or rounds.
+
+    This is cheap as only the hash is parsed. If True the password should be
+    hashed again (with hash_password()) the next time the user logs in and
+    the new hash stored.
+
+    :param password_hash: The result of a stored hash_password().
+
+    :returns: False if the hash is not one we know how to handle.
+
+    """
     if isinstance(password_hash, unicode):
         password_hash = password_hash.encode('UTF-8')
 
-    return sha512_crypt.verify(password_8bit, password_hash)
+    if not _context.identify(password_hash):
+        return False
+
+    return _context.needs_update(password_hash)
+
+
+def hash_password_future(plaintext_password):
+    """Start hashing the password, see hash_password().
+
+    :returns: A concurrent.futures.Future for the hashed password.
+
+    """
+    return _submit(_hash_password, plaintext_password)
+
+
+def validate_password_future(plaintext_password, password_hash):
+    """Start checking the password, see validate_password().
+
+    :returns: A concurrent.futures.Future for whether the password is valid.
+
+    """
+    return _submit(_validate_password, plaintext_password, password_hash)
+
+
+def hash_password_async(plaintext_password, loop=None):
+    """Start hashing the password, see hash_password().
+
+    :returns: An asyncio future which can be awaited for the hashed password.
+
+    """
+    return _asyncio().wrap_future(
+        hash_password_future(plaintext_password), loop=loop
+    )
+
+
+def validate_password_async(plaintext_password, password_hash, loop=None):
+    """Start checking the password, see validate_password().
+
+    :returns: An asyncio future which can be awaited for whether the password
+        is valid.
+
+    """
+    return _asyncio().wrap_future(
+        validate_password_future(plaintext_password, password_hash),
+        loop=loop
+    )
+
+
+def validate_many(credentials):
+    """Check many passwords at once, spread over the worker processes.
+
+    :param credentials: A list of (plaintext_password, password_hash) pairs.
+
+    :returns: A list of bools, in the same order as the credentials given.
+
+    """
+    futures = [
+        validate_password_future(plaintext_password, password_hash)
+        for plaintext_password, password_hash in credentials
+    ]
+    return [future.result() for future in futures]
+
+
+@contextlib.contextmanager
+def hashing_pool(workers=None):
+    """Provide a process pool for hashing many passwords, see hash_many().
+
+    The pool started by init_executor() is used if there is one. Otherwise a
+    pool of workers (by default one per CPU) is started and shut down when
+    the with block exits.
+
+    """
+    global _workers
+
+    if _executor is not None:
+        yield _executor
+        return
+
+    workers = workers or multiprocessing.cpu_count()
+    executor = ProcessPoolExecutor(max_workers=workers)
+    previous, _workers = _workers, workers
+    try:
+        yield executor
+    finally:
+        _workers = previous
+        executor.shutdown(wait=True)
+
+
+def pool_workers(executor):
+    """Return the number of worker processes a hashing_pool() has."""
+    return _workers
+
+
+def hash_many(passwords, executor=None):
+    """Hash many passwords at once, spread over worker processes.
+
+    :param passwords: A list of plain text passwords.
+
+    :param executor: The hashing_pool() to use. If not given one is started
+        for this call.
+
+    :returns: A list of hashes, in the same order as the passwords given.
+
+    """
+    if executor is None:
+        with hashing_pool() as executor:
+            return hash_many(passwords, executor)
+
+    futures = [
+        executor.submit(_hash_password, password) for password in passwords
+    ]
+    return [future.result() for future in futures]
+
+
+def calibrate(scheme='sha512_crypt', target_ms=250.0, samples=5):
+    """Measure verify time on this machine and pick the rounds for a scheme
+    which would make a single password verification take target_ms.
+
+    :param scheme: The passlib scheme name to calibrate.
+
+    :param target_ms: The wanted milliseconds per verification.
+
+    :param samples: The number of verifications to time and average.
+
+    :returns: (rounds, measured milliseconds per verify for those rounds).
+
+    """
+    handler = CryptContext(schemes=[scheme]).handler(scheme)
+    if 'rounds' not in getattr(handler, 'setting_kwds', ()):
+        raise ValueError(
+            "The scheme <%s> has no rounds to calibrate." % scheme
+        )
+
+    def time_verify(rounds):
+        h = handler.using(rounds=rounds)
+        password_hash = h.hash("calibrate")
+        started = time.time()
+        for i in range(samples):
+            h.verify("calibrate", password_hash)
+        return (time.time() - started) * 1000.0 / samples
+
+    # Time the default and scale it. Rounds are either a linear count or a
+    # log2 cost (e.g. bcrypt):
+    rounds = handler.default_rounds
+    for attempt in range(3):
+        taken = time_verify(rounds)
+        if handler.rounds_cost == 'log2':
+            new_rounds = rounds + int(round(math.log(target_ms / taken, 2)))
+        else:
+            new_rounds = int(rounds * target_ms / taken)
+
+        new_rounds = max(
+            handler.min_rounds, min(handler.max_rounds, new_rounds)
+        )
+        if new_rounds == rounds:
+            break
+        rounds = new_rounds
+
+    return rounds, time_verify(rounds)
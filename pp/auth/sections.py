@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Indexes over the repoze.what group/permission "sections" data.
+
+Group and permission sources hold a dict of section name to the items in
+it, i.e. group -> userids or permission -> groups. Answering which sections
+an item is in by scanning every section is O(sections x items) per request.
+A SectionIndex inverts the data once, when it is loaded, so the question is
+answered with a single dict look up.
+
+"""
+
+EMPTY = frozenset()
+
+
+def invert(info):
+    """Map each item to the frozenset of the sections it appears in.
+
+    :param info: a dict of section name to an iterable of items.
+
+    """
+    by_item = {}
+    for section, items in info.iteritems():
+        for item in items:
+            by_item.setdefault(item, set()).add(section)
+
+    return dict(
+        (item, frozenset(found)) for item, found in by_item.iteritems()
+    )
+
+
+class SectionIndex(object):
+    """Read only sections data together with its inverted index."""
+
+    __slots__ = ('info', 'by_item')
+
+    def __init__(self, info):
+        """
+        :param info: a dict of section name to an iterable of items.
+
+        """
+        self.info = dict(
+            (section, frozenset(items)) for section, items in info.iteritems()
+        )
+        self.by_item = invert(self.info)
+
+    def sections_for(self, item):
+        """Return the frozenset of the sections the item is in."""
+        return self.by_item.get(item, EMPTY)
+
+    def __len__(self):
+        return len(self.info)
+
+
+class AccessIndex(object):
+    """The groups of every user and the permissions of every group, worked
+    out in advance.
+
+    Built from the group -> userids and permission -> groups sections data
+    (e.g. the plain plugin's groups.ini and permissions.ini). These are the
+    questions repoze.what asks the group and permission adapters, each of
+    which is then a single dict look up.
+
+    """
+    __slots__ = ('groups', 'permissions')
+
+    def __init__(self, groups_info, permissions_info):
+        """
+        :param groups_info: a dict of group name to userids.
+
+        :param permissions_info: a dict of permission name to group names.
+
+        """
+        self.groups = SectionIndex(groups_info)
+        self.permissions = SectionIndex(permissions_info)
+
+    def groups_for(self, userid):
+        """Return the frozenset of groups the user is in."""
+        return self.groups.sections_for(userid)
+
+    def permissions_for_group(self, group):
+        """Return the frozenset of permissions granted to the group."""
+        return self.permissions.sections_for(group)
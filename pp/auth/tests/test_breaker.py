@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the circuit breaker.
+
+"""
+import threading
+
+import mock
+
+from pp.auth import breaker
+
+
+class Clock(object):
+    now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def fails():
+    raise IOError("down")
+
+
+def expect(error, fn, *args):
+    try:
+        fn(*args)
+    except error:
+        pass
+    else:
+        raise AssertionError("%s not raised" % error.__name__)
+
+
+def test_open_half_open_close():
+    clock = Clock()
+    cb = breaker.CircuitBreaker(
+        'service', failures=2, reset_timeout=30, errors=(IOError,),
+        clock=clock,
+    )
+    works = mock.Mock(return_value='ok')
+
+    assert cb.call(works) == 'ok'
+    expect(IOError, cb.call, fails)
+    assert cb.state == breaker.CLOSED
+    expect(IOError, cb.call, fails)
+    assert cb.state == breaker.OPEN
+
+    # Fail fast without calling while open:
+    expect(breaker.CircuitOpenError, cb.call, works)
+    assert works.call_count == 1
+
+    # A failed trial opens it again:
+    clock.now += 30
+    expect(IOError, cb.call, fails)
+    assert cb.state == breaker.OPEN
+    expect(breaker.CircuitOpenError, cb.call, works)
+
+    # A good trial closes it:
+    clock.now += 30
+    assert cb.call(works) == 'ok'
+    assert cb.state == breaker.CLOSED
+
+    assert cb.stats() == dict(
+        state=breaker.CLOSED, calls=5, errors=3, rejected=2, opened=2,
+        half_opened=2, closed=1,
+    )
+
+
+def test_other_errors_ignored():
+    cb = breaker.CircuitBreaker('service', failures=1, errors=(IOError,))
+    expect(ValueError, cb.call, mock.Mock(side_effect=ValueError))
+    assert cb.state == breaker.CLOSED
+
+
+def test_other_errors_leave_trial_half_open():
+    clock = Clock()
+    cb = breaker.CircuitBreaker(
+        'service', failures=1, errors=(IOError,), clock=clock,
+    )
+    expect(IOError, cb.call, fails)
+    clock.now += 60
+
+    # The trial didn't show the service works, so it isn't closed:
+    expect(ValueError, cb.call, mock.Mock(side_effect=ValueError))
+    assert cb.state == breaker.HALF_OPEN
+
+    # The next call is another trial:
+    expect(IOError, cb.call, fails)
+    assert cb.state == breaker.OPEN
+
+
+def test_one_trial_while_half_open():
+    clock = Clock()
+    cb = breaker.CircuitBreaker('service', failures=1, clock=clock)
+    expect(IOError, cb.call, fails)
+    clock.now += 60
+
+    def trial():
+        # Another call while the trial is in progress is refused:
+        expect(breaker.CircuitOpenError, cb.call, mock.Mock())
+        return 'ok'
+
+    assert cb.call(trial) == 'ok'
+    assert cb.state == breaker.CLOSED
+
+
+def test_earlier_call_leaves_trial_in_progress():
+    clock = Clock()
+    cb = breaker.CircuitBreaker('service', failures=1, clock=clock)
+    started = threading.Event()
+    finish = threading.Event()
+
+    def slow():
+        started.set()
+        finish.wait(5)
+        return 'slow'
+
+    # A call made while closed, still running when the breaker opens:
+    earlier = threading.Thread(target=cb.call, args=(slow,))
+    earlier.start()
+    started.wait(5)
+    expect(IOError, cb.call, fails)
+    clock.now += 60
+
+    def trial():
+        # The earlier call finishing doesn't end the trial:
+        finish.set()
+        earlier.join(5)
+        expect(breaker.CircuitOpenError, cb.call, mock.Mock())
+        return 'ok'
+
+    assert cb.call(trial) == 'ok'
+    assert cb.state == breaker.CLOSED
+
+
+def test_get_breaker_from_config():
+    prefix = 'pp.auth.userservice.'
+    settings = {
+        'pp.auth.userservice.breaker_failures': '3',
+        'pp.auth.userservice.breaker_reset_timeout': '10',
+    }
+    try:
+        cb = breaker.get_breaker_from_config(settings, prefix, 'test<a>')
+        assert cb.failures == 3
+        assert cb.reset_timeout == 10
+        # Shared by name:
+        assert breaker.get_breaker_from_config(
+            settings, prefix, 'test<a>'
+        ) is cb
+
+        # Different settings for the same name are warned about:
+        settings['pp.auth.userservice.breaker_failures'] = '4'
+        with mock.patch.object(breaker, 'get_log') as get_log:
+            assert breaker.get_breaker_from_config(
+                settings, prefix, 'test<a>'
+            ) is cb
+        assert get_log.return_value.warn.call_count == 1
+        assert cb.failures == 3
+
+        settings['pp.auth.userservice.breaker'] = 'false'
+        assert breaker.get_breaker_from_config(
+            settings, prefix, 'test<b>'
+        ) is None
+
+    finally:
+        breaker._breakers.pop('test<a>', None)
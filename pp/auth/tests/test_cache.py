@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+This tests the caches used to avoid repeating expensive work.
+
+"""
+import time
+import threading
+
+import mock
+
+from pp.auth import cache
+from pp.auth import pwtools
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expiry():
+    clock = FakeClock()
+    c = cache.TTLCache(max_size=10, ttl=5, clock=clock)
+    c.set('a', 1)
+    assert c.get('a') == 1
+    assert 'a' in c
+
+    clock.now += 5
+    assert c.get('a') is None
+    assert 'a' not in c
+    assert c.stats()['hits'] == 1
+    assert c.stats()['misses'] == 1
+
+
+def test_ttl_cache_lru_eviction():
+    c = cache.TTLCache(max_size=2, ttl=60)
+    c.set('a', 1)
+    c.set('b', 2)
+    # Touch 'a' so 'b' is the least recently used:
+    assert c.get('a') == 1
+    c.set('c', 3)
+
+    assert c.get('b') is None
+    assert c.get('a') == 1
+    assert c.get('c') == 3
+    assert c.stats()['evictions'] == 1
+    assert len(c) == 2
+
+
+def test_credential_cache_skips_repeat_verification():
+    password_hash = pwtools.hash_password("11amcoke")
+    cc = cache.CredentialCache(max_size=10, ttl=60)
+
+    with mock.patch(
+        'pp.auth.pwtools.validate_password', wraps=pwtools.validate_password
+    ) as validate:
+        assert cc.validate('bob', "11amcoke", password_hash)
+        assert cc.validate('bob', "11amcoke", password_hash)
+        assert validate.call_count == 1
+
+        # A wrong password is always fully verified:
+        assert not cc.validate('bob', "not the password", password_hash)
+        assert validate.call_count == 2
+
+
+def test_credential_cache_hash_change_invalidates():
+    old_hash = pwtools.hash_password("11amcoke")
+    new_hash = pwtools.hash_password("12pmtea")
+    cc = cache.CredentialCache(max_size=10, ttl=60)
+
+    assert cc.validate('bob', "11amcoke", old_hash)
+
+    # The password was changed, the old one must no longer work:
+    assert not cc.validate('bob', "11amcoke", new_hash)
+    assert cc.validate('bob', "12pmtea", new_hash)
+
+
+def test_credential_cache_from_config():
+    settings = {}
+    assert cache.get_credential_cache_from_config(
+        settings, 'pp.auth.plain.'
+    ) is None
+
+    settings = {
+        'pp.auth.plain.credential_cache': 'true',
+        'pp.auth.plain.credential_cache_size': '20',
+        'pp.auth.plain.credential_cache_ttl': '30',
+    }
+    cc = cache.get_credential_cache_from_config(settings, 'pp.auth.plain.')
+    assert cc._cache.max_size == 20
+    assert cc._cache.ttl == 30
+
+
+class Unreachable(Exception):
+    """Stands in for a connection error."""
+
+
+def test_refreshing_cache_hit_and_refresh_ahead():
+    clock = FakeClock()
+    loads = []
+
+    def loader(key):
+        loads.append(key)
+        return "%s-%d" % (key, len(loads))
+
+    c = cache.RefreshingCache(
+        loader, ttl=10, refresh_ahead=2, stale_ttl=60, clock=clock
+    )
+    assert c.get('org') == 'org-1'
+    assert c.get('org') == 'org-1'
+
+    # Close to expiry the value is served and reloaded in the background:
+    clock.now += 9
+    assert c.get('org') == 'org-1'
+    for i in range(500):
+        if c.stats()['refreshes']:
+            break
+        time.sleep(0.01)
+    assert c.get('org') == 'org-2'
+
+    stats = c.stats()
+    assert stats['misses'] == 1
+    assert stats['refreshes'] == 1
+    assert loads == ['org', 'org']
+
+
+def test_refreshing_cache_serves_stale_on_error():
+    clock = FakeClock()
+    available = [True]
+    callers = []
+
+    def loader(key):
+        callers.append(threading.current_thread())
+        if not available[0]:
+            raise Unreachable()
+        return {'admin': ['bob']}
+
+    c = cache.RefreshingCache(
+        loader, ttl=10, refresh_ahead=0, stale_ttl=60,
+        errors=(Unreachable,), clock=clock
+    )
+    assert c.get('org') == {'admin': ['bob']}
+
+    # The expired value is served without waiting for the loader, which is
+    # called in the background:
+    available[0] = False
+    clock.now += 30
+    assert c.get('org') == {'admin': ['bob']}
+    for i in range(500):
+        if c.stats()['failures']:
+            break
+        time.sleep(0.01)
+    assert c.stats()['stale'] == 1
+    assert c.stats()['failures'] == 1
+    assert len(callers) == 2
+    assert callers[1] is not threading.current_thread()
+
+    # Too old to be used:
+    clock.now += 60
+    try:
+        c.get('org')
+    except Unreachable:
+        pass
+    else:
+        raise AssertionError("Unreachable not raised!")
+
+    # Nothing to fall back to:
+    try:
+        c.get('other org')
+    except Unreachable:
+        pass
+    else:
+        raise AssertionError("Unreachable not raised!")
+
+
+def test_refreshing_cache_shares_one_load():
+    release = threading.Event()
+    loads = []
+
+    def loader(key):
+        loads.append(key)
+        release.wait(5)
+        return "%s-%d" % (key, len(loads))
+
+    c = cache.RefreshingCache(loader, ttl=10)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(c.get('org')))
+        for i in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Let every request reach the loader before it returns:
+    for i in range(500):
+        if c.stats()['misses'] == 5:
+            break
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert loads == ['org']
+    assert results == ['org-1'] * 5
+
+
+class DictBackend(object):
+    """A stand in for a shared backend like MemcacheBackend."""
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ttl):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+def test_metadata_cache_invalidation():
+    mc = cache.MetadataCache(max_size=10, ttl=60)
+    other = cache.MetadataCache(max_size=10, ttl=60)
+
+    assert mc.get('sql', 'bob') is None
+    mc.set('sql', 'bob', dict(name='Bob'))
+    mc.set('userservice', 'bob', dict(name='Bobby'))
+    mc.set('sql', 'fred', dict(name='Fred'))
+    other.set('sql', 'bob', dict(name='Bob'))
+    assert mc.get('sql', 'bob') == dict(name='Bob')
+
+    # Every namespace of every cache forgets the user:
+    cache.invalidate_metadata('bob')
+    assert mc.get('sql', 'bob') is None
+    assert mc.get('userservice', 'bob') is None
+    assert other.get('sql', 'bob') is None
+    assert mc.get('sql', 'fred') == dict(name='Fred')
+
+
+def test_metadata_cache_shared_backend():
+    backend = DictBackend()
+    mc1 = cache.MetadataCache(ttl=60, backend=backend, local_ttl=5)
+    mc2 = cache.MetadataCache(ttl=60, backend=backend, local_ttl=5)
+    assert mc1._local.ttl == 5
+
+    # A process sees what another has cached:
+    mc1.set('sql', 'bob', dict(name='Bob'))
+    assert mc2.get('sql', 'bob') == dict(name='Bob')
+
+    mc1.invalidate('bob')
+    assert backend.data == {}
+
+    # A process which hasn't cached anything (e.g. an admin tool) still
+    # invalidates what the others have:
+    mc1.set('userservice', 'bob', dict(name='Bob'))
+    admin = cache.MetadataCache(ttl=60, backend=backend, local_ttl=5)
+    admin.invalidate('bob')
+    assert backend.data == {}
+
+
+def test_metadata_cache_leaves_out_password_hash():
+    backend = DictBackend()
+    mc = cache.MetadataCache(ttl=60, backend=backend)
+    details = dict(username='bob', password_hash='$pbkdf2$...')
+    mc.set('sql', 'bob', details)
+
+    assert mc.get('sql', 'bob') == dict(username='bob')
+    assert backend.data.values() == [dict(username='bob')]
+    # The caller's dict is left as it was:
+    assert 'password_hash' in details
+
+
+def test_metadata_cache_from_config():
+    assert cache.get_metadata_cache_from_config({}) is None
+
+    settings = {
+        'pp.auth.metadata_cache': 'true',
+        'pp.auth.metadata_cache_size': '20',
+        'pp.auth.metadata_cache_ttl': '30',
+    }
+    mc = cache.get_metadata_cache_from_config(settings)
+    assert mc.ttl == 30
+    assert mc._local.max_size == 20
+    assert mc.backend is None
+
+    # Plugins configured from the same settings share the one cache:
+    assert cache.get_metadata_cache_from_config(dict(settings)) is mc
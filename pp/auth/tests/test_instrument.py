@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the plugin call instrumentation.
+
+"""
+import mock
+from repoze.who.middleware import verify
+from repoze.who.interfaces import IAuthenticator
+from repoze.who.interfaces import IMetadataProvider
+
+from pp.auth import instrument
+from pp.auth import middleware
+
+
+def test_call_metrics():
+    metrics = instrument.CallMetrics(buckets=(0.1, 1.0))
+    metrics.observe(0.05, 'success')
+    metrics.observe(0.5, 'failure')
+    metrics.observe(5, 'error')
+
+    assert metrics.snapshot() == dict(
+        buckets=[(0.1, 1), (1.0, 2), (float('inf'), 3)],
+        sum=5.55,
+        count=3,
+        outcomes=dict(success=1, failure=1, error=1),
+    )
+
+
+def test_instrumented_plugins():
+    registry = instrument.MetricsRegistry()
+
+    authenticator = mock.Mock()
+    authenticator.authenticate.side_effect = ['bob', None, ValueError]
+    wrapped = instrument.wrap('authenticators', 'sql', authenticator, registry)
+    verify(wrapped, IAuthenticator)
+
+    assert wrapped.authenticate({}, {}) == 'bob'
+    assert wrapped.authenticate({}, {}) is None
+    try:
+        wrapped.authenticate({}, {})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("ValueError not raised")
+
+    mdprovider = mock.Mock()
+    mdprovider.add_metadata.return_value = None
+    wrapped = instrument.wrap('mdproviders', 'sql', mdprovider, registry)
+    verify(wrapped, IMetadataProvider)
+    wrapped.add_metadata({}, {})
+
+    adapter = mock.Mock()
+    adapter.find_sections.return_value = set(['admin'])
+    wrapped = instrument.wrap('groups', 'plain', adapter, registry)
+    assert wrapped.find_sections('bob') == set(['admin'])
+    # Anything else is passed through:
+    assert wrapped.info is adapter.info
+
+    snapshot = registry.snapshot()
+    assert snapshot[('authenticators', 'sql', 'authenticate')]['outcomes'] == (
+        dict(success=1, failure=1, error=1)
+    )
+    assert snapshot[('mdproviders', 'sql', 'add_metadata')]['count'] == 1
+    assert snapshot[('groups', 'plain', 'find_sections')]['outcomes'][
+        'success'
+    ] == 1
+
+    text = registry.render()
+    assert (
+        'pp_auth_plugin_calls_total{type="authenticators",plugin="sql",'
+        'method="authenticate",outcome="error"} 1'
+    ) in text
+    assert (
+        'pp_auth_plugin_call_seconds_count{type="groups",plugin="plain",'
+        'method="find_sections"} 1'
+    ) in text
+    assert 'le="+Inf"} 3' in text
+
+
+def test_build_plugins_instrumented():
+    registry = {
+        'authenticators': {'dummy': mock.Mock(return_value='auth')},
+        'mdproviders': {'dummy': mock.Mock(return_value='md')},
+        'groups': {'dummy': mock.Mock(return_value='groups')},
+        'permissions': {'dummy': mock.Mock(return_value='perms')},
+    }
+    settings = {
+        'pp.auth.authenticators': 'dummy',
+        'pp.auth.mdproviders': 'dummy',
+        'pp.auth.groups': 'dummy',
+        'pp.auth.permissions': 'dummy',
+    }
+
+    plugins = middleware.build_plugins(settings, registry)
+    assert plugins['authenticators'] == [('dummy', 'auth')]
+
+    settings['pp.auth.instrument'] = 'true'
+    plugins = middleware.build_plugins(settings, registry)
+    (name, plugin), = plugins['authenticators']
+    assert isinstance(plugin, instrument.InstrumentedAuthenticator)
+    assert plugin.plugin == 'auth'
+
+
+def test_metrics_middleware():
+    registry = instrument.MetricsRegistry()
+    registry.metrics_for('groups', 'plain', 'find_sections').observe(
+        0.01, 'success'
+    )
+    app = mock.Mock(return_value=['app'])
+    wrapped = instrument.MetricsMiddleware(app, '/metrics', registry)
+
+    assert wrapped({'PATH_INFO': '/'}, None) == ['app']
+
+    start_response = mock.Mock()
+    body, = wrapped({'PATH_INFO': '/metrics'}, start_response)
+    assert body == registry.render()
+    assert start_response.call_args[0][0] == '200 OK'
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for rejecting unknown usernames.
+
+"""
+import os
+import tempfile
+
+import mock
+
+from pp.auth import known
+
+
+def test_bloom_filter():
+    bloom = known.BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add("user%d" % i)
+    bloom.add(u"andrés")
+
+    assert all("user%d" % i in bloom for i in range(1000))
+    assert u"andrés" in bloom
+
+    false_positives = sum(
+        1 for i in range(1000, 11000) if "user%d" % i in bloom
+    )
+    assert false_positives < 300
+
+
+def test_known_users():
+    usernames = ['bob', 'fred']
+    known_users = known.KnownUsers(
+        lambda: list(usernames), 'test', dummy_verify=False
+    )
+
+    # Nothing is rejected until the filter is loaded:
+    with mock.patch.object(known_users, 'ensure_current'):
+        assert known_users.unknown('alice') is False
+
+    known_users.rebuild()
+    with mock.patch.object(known_users, 'ensure_current'):
+        assert known_users.unknown('bob') is False
+        assert known_users.unknown('alice') is True
+
+        known.user_added('alice', 'test')
+        assert known_users.unknown('alice') is False
+
+        # Another source's users aren't added:
+        known.user_added('jane', 'other')
+        assert known_users.unknown('jane') is True
+
+        known_users.not_found('bob')
+        assert known_users.unknown('bob') is True
+        known.user_added('bob', 'test')
+        assert known_users.unknown('bob') is False
+
+    stats = known_users.stats()
+    assert stats['filtered'] == 2
+    assert stats['negative'] == 1
+    assert stats['rebuilds'] == 1
+
+
+def test_known_users_version():
+    usernames = ['bob']
+    version = mock.Mock(return_value=1)
+    known_users = known.KnownUsers(
+        lambda: list(usernames), 'test', dummy_verify=False,
+        version=version, version_ttl=0,
+    )
+    known_users.rebuild()
+    known_users.not_found('fred')
+
+    with mock.patch.object(known_users, 'ensure_current') as ensure:
+        assert known_users.unknown('alice') is True
+        assert known_users.unknown('fred') is True
+
+        # Another process added alice, so nothing is rejected until the
+        # filter is reloaded:
+        usernames.append('alice')
+        version.return_value = 2
+        assert known_users.unknown('alice') is False
+        assert known_users.unknown('fred') is False
+        ensure.assert_called_with(force=True)
+        assert known_users.stats()['stale'] == 2
+
+    known_users.rebuild()
+    assert known_users.built_version == 2
+    with mock.patch.object(known_users, 'ensure_current'):
+        assert known_users.unknown('alice') is False
+        assert known_users.unknown('jane') is True
+
+        # A store which can't be trusted rejects nothing:
+        version.return_value = None
+        assert known_users.unknown('jane') is False
+
+
+def test_file_version():
+    fd, filename = tempfile.mkstemp()
+    try:
+        os.write(fd, "bob\n")
+        os.close(fd)
+        version = known.file_version(filename)
+        first = version()
+        assert first is not None
+
+        with open(filename, 'a') as fd:
+            fd.write("alice\n")
+        assert version() != first
+
+        # Out of date listings can't be trusted:
+        os.utime(filename, (1, 1))
+        assert version() is not None
+        assert known.file_version(filename, max_age=60)() is None
+
+    finally:
+        os.remove(filename)
+
+    assert version() is None
+
+
+def test_reject_dummy_verify():
+    known_users = known.KnownUsers(list, 'test')
+    with mock.patch.object(known.pwtools, 'dummy_validate') as dummy:
+        assert known_users.reject('secret') is False
+        dummy.assert_called_once_with('secret')
+
+    known_users.dummy_verify = False
+    with mock.patch.object(known.pwtools, 'dummy_validate') as dummy:
+        assert known_users.reject('secret') is False
+        assert dummy.call_count == 0
+
+    # Otherwise it takes as long as the lookups do on average:
+    known_users.observe(0.2)
+    known_users.observe(0.4)
+    assert abs(known_users.latency - 0.22) < 1e-9
+    with mock.patch.object(known.time, 'sleep') as sleep:
+        assert known_users.reject('secret') is False
+        sleep.assert_called_once_with(known_users.latency)
+
+
+def test_get_known_users_from_config():
+    fd, filename = tempfile.mkstemp()
+    try:
+        os.write(fd, "# username, ...\nbob, xxx, Bob\n\nfred\n")
+        os.close(fd)
+        loader = known.usernames_from_file(filename)
+        assert list(loader()) == ['bob', 'fred']
+
+        prefix = 'pp.auth.userservice.'
+        assert known.get_known_users_from_config(
+            {}, prefix, loader, 'userservice'
+        ) is None
+
+        known_users = known.get_known_users_from_config(
+            {
+                'pp.auth.userservice.known_users': 'true',
+                'pp.auth.userservice.known_users_negative_ttl': '5',
+            },
+            prefix, loader, 'userservice', dummy_verify=False,
+        )
+        assert known_users.negative.ttl == 5
+        assert known_users.dummy_verify is False
+        assert known_users.rebuild_interval == 300
+
+    finally:
+        os.remove(filename)
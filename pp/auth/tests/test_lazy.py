@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for lazy plugin import and construction.
+
+"""
+import mock
+from repoze.who.middleware import verify
+from repoze.who.interfaces import IAuthenticator
+from repoze.who.interfaces import IMetadataProvider
+
+from pp.auth import lazy
+from pp.auth import middleware
+from pp.auth.plugins import plain
+
+
+SETTINGS = {
+    'pp.auth.plugins': 'plain',
+    'pp.auth.authenticators': 'plain',
+    'pp.auth.mdproviders': 'plain',
+    'pp.auth.groups': 'plain',
+    'pp.auth.permissions': 'plain',
+    'pp.auth.lazy_plugins': 'true',
+}
+
+
+def test_resolve():
+    assert lazy.resolve(' pp.auth.plugins.plain') == (
+        'plain', 'pp.auth.plugins.plain'
+    )
+
+    entry_point = mock.Mock(module_name='pp.auth.plugins.plain')
+    with mock.patch.object(
+        lazy.pkg_resources, 'iter_entry_points', return_value=[entry_point]
+    ) as iter_entry_points:
+        assert lazy.resolve('plain') == ('plain', 'pp.auth.plugins.plain')
+        iter_entry_points.assert_called_once_with('pp.auth.plugins', 'plain')
+
+    # A top level module which isn't an entry point:
+    with mock.patch.object(
+        lazy.pkg_resources, 'iter_entry_points', return_value=[]
+    ):
+        assert lazy.resolve('mock') == ('mock', 'mock')
+
+    with mock.patch.object(
+        lazy.pkg_resources, 'iter_entry_points', return_value=[]
+    ):
+        try:
+            lazy.resolve('missing')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("ValueError not raised")
+
+
+def test_lazy_registry_and_plugins():
+    entry_point = mock.Mock(module_name='pp.auth.plugins.plain')
+    with mock.patch.object(
+        lazy.pkg_resources, 'iter_entry_points', return_value=[entry_point]
+    ), mock.patch.object(lazy, 'import_plugin') as import_plugin:
+        import_plugin.return_value = plain
+
+        registry = middleware.get_plugin_registry(SETTINGS)
+        assert import_plugin.call_count == 0
+        factory = registry['authenticators']['plain']
+        assert isinstance(factory, lazy.LazyFactory)
+
+        plugins = middleware.build_plugins(SETTINGS, registry)
+        assert import_plugin.call_count == 0
+
+        (name, authenticator), = plugins['authenticators']
+        (name, mdprovider), = plugins['mdproviders']
+        (name, groups), = plugins['groups']
+        verify(authenticator, IAuthenticator)
+        verify(mdprovider, IMetadataProvider)
+        assert import_plugin.call_count == 0
+
+        with mock.patch.object(
+            plain, 'get_groups_from_config'
+        ) as get_groups_from_config:
+            get_groups_from_config.return_value.find_sections.return_value = (
+                set(['admin'])
+            )
+            assert groups.find_sections('bob') == set(['admin'])
+            assert groups.find_sections('bob') == set(['admin'])
+            get_groups_from_config.assert_called_once_with(SETTINGS)
+            import_plugin.assert_called_once_with('pp.auth.plugins.plain')
+
+
+def test_lazy_factory_unknown_type():
+    factory = lazy.LazyFactory('authenticators', 'latchpony', 'x.latchpony')
+    module = mock.Mock()
+    module.register.return_value = {'authenticators': None}
+    with mock.patch.object(lazy, 'import_plugin', return_value=module):
+        try:
+            factory({})
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("ValueError not raised")
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the per request group/permission memo.
+
+"""
+import mock
+
+from pp.auth import memo
+
+
+def test_memo_adapter_once_per_request():
+    adapter = mock.Mock()
+    adapter.find_sections.return_value = set(['admin'])
+    adapter.info = {'admin': ['bob']}
+    wrapped = memo.MemoAdapter('plain', adapter)
+
+    # Outside a request every call reaches the adapter:
+    assert wrapped.find_sections('admin') == set(['admin'])
+    assert wrapped.find_sections('admin') == set(['admin'])
+    assert adapter.find_sections.call_count == 2
+
+    def app(environ, start_response):
+        credentials = {'repoze.what.userid': 'bob', 'groups': ()}
+        for i in range(3):
+            wrapped.find_sections(credentials)
+            wrapped.find_sections('admin')
+        assert environ[memo.ENVIRON_KEY]
+        return ['ok']
+
+    middleware = memo.RequestMemoMiddleware(app, [('groups.plain', wrapped)])
+    assert middleware({}, None) == ['ok']
+    assert adapter.find_sections.call_count == 4
+    assert middleware.stats() == {
+        'groups.plain': dict(avoided=4, lookups=2),
+    }
+
+    # The next request starts afresh:
+    middleware({}, None)
+    assert adapter.find_sections.call_count == 6
+    assert memo.current() is None
+
+    # Other attributes come from the adapter:
+    assert wrapped.info == {'admin': ['bob']}
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the metadata field projection helpers.
+
+"""
+from pp.auth import metadata
+
+
+def test_fields_from_config():
+    assert metadata.fields_from_config({}, 'pp.auth.sql.') is None
+
+    settings = {'pp.auth.metadata_fields': 'username, email'}
+    assert metadata.fields_from_config(settings, 'pp.auth.sql.') == set(
+        ['username', 'email']
+    )
+
+    # The plugin's own setting wins:
+    settings['pp.auth.sql.metadata_fields'] = 'display_name\nemail'
+    assert metadata.fields_from_config(settings, 'pp.auth.sql.') == set(
+        ['display_name', 'email']
+    )
+
+
+def test_project():
+    details = dict(username='bob', password_hash='x', email='b@example.com')
+    assert metadata.project(details, None) is details
+    assert metadata.project(details, frozenset(['email', 'phone'])) == dict(
+        email='b@example.com'
+    )
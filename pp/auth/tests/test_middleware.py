@@ -1,4 +1,7 @@
+import logging
+
 import mock 
+import pytest
 
 from pp.auth import middleware
 from pp.auth.plugins import plain
@@ -90,3 +93,48 @@ def test_build_plugins():
     perms1.assert_called_once_with(settings)
     perms2.assert_called_once_with(settings)
 
+
+
+def test_exclude_paths():
+    """ Test excluded paths skip the auth middleware
+    """
+    app = mock.Mock(return_value=['app'])
+    app_with_auth = mock.Mock(return_value=['auth'])
+    wrapped = middleware.ExcludePathsMiddleware(
+        app, app_with_auth, ['/static/', '/health']
+    )
+
+    for path, expected in [
+        ('/static', ['app']),
+        ('/static/css/site.css', ['app']),
+        ('/health', ['app']),
+        ('/healthz', ['auth']),
+        ('/', ['auth']),
+        ('/admin/static', ['auth']),
+    ]:
+        assert wrapped({'PATH_INFO': path}, None) == expected
+
+
+def test_exclude_paths_refuses_root():
+    """ Test excluding the root or an empty path, which would turn off
+    auth for every path, is refused
+    """
+    app = mock.Mock(return_value=['app'])
+    app_with_auth = mock.Mock(return_value=['auth'])
+
+    for paths in (['/static', '/'], [''], ['//'], [' ']):
+        with pytest.raises(ValueError):
+            middleware.ExcludePathsMiddleware(app, app_with_auth, paths)
+
+
+def test_get_log_level():
+    """ Test recovering the repoze.who log level from the settings
+    """
+    assert middleware.get_log_level({}) == logging.DEBUG
+    assert middleware.get_log_level(
+        {'pp.auth.log_level': ' warning'}
+    ) == logging.WARNING
+    assert middleware.get_log_level({'pp.auth.log_level': '40'}) == 40
+
+    with pytest.raises(ValueError):
+        middleware.get_log_level({'pp.auth.log_level': 'LOUD'})
@@ -40,3 +40,124 @@ def test_hash_then_unhash_fail_unicode_other():
     plain_password = u"manÃna123"
     hashed_pw = pwtools.hash_password(plain_password)
     assert not pwtools.validate_password("not the password", hashed_pw)
+
+
+def test_futures_without_executor():
+    plain_password = "11amcoke"
+    hashed_pw = pwtools.hash_password_future(plain_password).result()
+    future = pwtools.validate_password_future(plain_password, hashed_pw)
+    assert future.done()
+    assert future.result()
+
+
+def test_validate_many():
+    hashed_pw = pwtools.hash_password("11amcoke")
+    results = pwtools.validate_many([
+        ("11amcoke", hashed_pw),
+        ("not the password", hashed_pw),
+        (u"11amcoke", hashed_pw),
+    ])
+    assert results == [True, False, True]
+
+
+def test_hash_many():
+    passwords = ["11amcoke", u"manÃna123", "12pmtea"]
+
+    with pwtools.hashing_pool(2) as executor:
+        assert pwtools.pool_workers(executor) == 2
+        hashes = pwtools.hash_many(passwords, executor)
+
+    # The count is only held while the pool is in use:
+    assert pwtools._workers is None
+    assert len(hashes) == 3
+    assert pwtools.validate_many(zip(passwords, hashes)) == [True] * 3
+
+    # A pool is started just for the call if none is given:
+    hashes = pwtools.hash_many(passwords[:1])
+    assert pwtools.validate_password(passwords[0], hashes[0])
+
+
+def test_dummy_validate():
+    assert pwtools.dummy_validate("11amcoke") is False
+    dummy_hash = pwtools._dummy_hash
+    assert dummy_hash
+
+    # The same hash is reused until the context changes:
+    assert pwtools.dummy_validate("11amcoke") is False
+    assert pwtools._dummy_hash == dummy_hash
+    pwtools.init_context()
+    assert pwtools._dummy_hash is None
+
+
+def test_executor_from_config():
+    settings = {
+        'pp.auth.pwtools.executor': 'true',
+        'pp.auth.pwtools.workers': '2',
+    }
+    pwtools.init_from_config(settings)
+    try:
+        assert pwtools._executor is not None
+
+        plain_password = u"manÃna123"
+        hashed_pw = pwtools.hash_password(plain_password)
+        assert pwtools.validate_password(plain_password, hashed_pw)
+        assert pwtools.validate_many([
+            (plain_password, hashed_pw),
+            ("not the password", hashed_pw),
+        ]) == [True, False]
+
+    finally:
+        pwtools.shutdown_executor()
+
+    assert pwtools._executor is None
+
+
+def test_needs_rehash_after_rounds_change():
+    plain_password = "11amcoke"
+    try:
+        pwtools.init_context(sha512_crypt__default_rounds=5000)
+        old_hash = pwtools.hash_password(plain_password)
+        assert not pwtools.needs_rehash(old_hash)
+
+        pwtools.init_from_config({
+            'pp.auth.pwtools.sha512_crypt__default_rounds': '6000',
+            'pp.auth.pwtools.sha512_crypt__min_rounds': '6000',
+        })
+        # The old hash still works but should be replaced:
+        assert pwtools.validate_password(plain_password, old_hash)
+        assert pwtools.needs_rehash(old_hash)
+
+        new_hash = pwtools.hash_password(plain_password)
+        assert not pwtools.needs_rehash(new_hash)
+        assert pwtools.validate_password(plain_password, new_hash)
+
+    finally:
+        pwtools.init_context()
+
+
+def test_needs_rehash_after_scheme_change():
+    plain_password = u"manÃna123"
+    old_hash = pwtools.hash_password(plain_password)
+    try:
+        pwtools.init_from_config({
+            'pp.auth.pwtools.schemes': 'pbkdf2_sha512, sha512_crypt',
+        })
+        assert pwtools.needs_rehash(old_hash)
+        assert pwtools.validate_password(plain_password, old_hash)
+
+        new_hash = pwtools.hash_password(plain_password)
+        assert new_hash.startswith(u"$pbkdf2-sha512$")
+        assert not pwtools.needs_rehash(new_hash)
+
+    finally:
+        pwtools.init_context()
+
+
+def test_needs_rehash_unknown_hash():
+    assert not pwtools.needs_rehash("xxx")
+
+
+def test_calibrate():
+    rounds, taken = pwtools.calibrate('sha512_crypt', target_ms=5, samples=1)
+    assert rounds >= 1000
+    assert taken > 0
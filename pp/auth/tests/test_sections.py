@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+This tests the inverted sections index.
+
+"""
+from pp.auth import sections
+
+
+INFO = {
+    'admin': ['bob', 'janet'],
+    'staff': ['janet', 'fred'],
+    'empty': [],
+}
+
+
+def test_invert():
+    assert sections.invert(INFO) == {
+        'bob': frozenset(['admin']),
+        'janet': frozenset(['admin', 'staff']),
+        'fred': frozenset(['staff']),
+    }
+
+
+def test_section_index():
+    index = sections.SectionIndex(INFO)
+    assert len(index) == 3
+    assert index.info['admin'] == frozenset(['bob', 'janet'])
+    assert index.sections_for('janet') == frozenset(['admin', 'staff'])
+    assert index.sections_for('nobody') == frozenset()
+
+
+def test_access_index():
+    index = sections.AccessIndex(INFO, {
+        'edit': ['admin'],
+        'view': ['admin', 'staff'],
+    })
+    assert index.groups_for('janet') == frozenset(['admin', 'staff'])
+    assert index.groups_for('nobody') == frozenset()
+    assert index.permissions_for_group('staff') == frozenset(['view'])
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the login throttle.
+
+"""
+import StringIO
+
+import mock
+from repoze.who.middleware import verify
+from repoze.who.interfaces import IAuthenticator
+
+from pp.auth import throttle
+from pp.auth import middleware
+
+
+class Clock(object):
+    now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = Clock()
+    backend = throttle.LocalBackend(clock=clock)
+
+    assert [backend.consume('k', 0.5, 3) for i in range(4)] == [
+        True, True, True, False
+    ]
+
+    # One token back every two seconds:
+    clock.now += 2
+    assert backend.consume('k', 0.5, 3) is True
+    assert backend.consume('k', 0.5, 3) is False
+
+    # Never more than the burst:
+    clock.now += 60
+    assert [backend.consume('k', 0.5, 3) for i in range(4)] == [
+        True, True, True, False
+    ]
+
+
+def test_throttle_user_and_ip():
+    clock = Clock()
+    limiter = throttle.Throttle(
+        user_rate=0.1, user_burst=2, ip_rate=1, ip_burst=3,
+        backend=throttle.LocalBackend(clock=clock),
+    )
+
+    # Every attempt is charged to the address, failed ones to the user:
+    assert limiter.allow('bob', '10.0.0.1') is True
+    limiter.failed('bob')
+    assert limiter.allow('bob', '10.0.0.1') is True
+    limiter.failed('bob')
+    assert limiter.allow('bob', '10.0.0.2') is False
+    assert limiter.allow('fred', '10.0.0.1') is True
+    assert limiter.allow('fred', '10.0.0.1') is False
+    assert limiter.allow('fred', '10.0.0.2') is True
+
+    assert limiter.stats() == dict(
+        allowed=4, rejected_user=1, rejected_ip=1, failed=2,
+    )
+
+
+def test_client_addr():
+    limiter = throttle.Throttle(trusted_proxies=['10.0.0.1', '10.0.0.2'])
+
+    assert limiter.client_addr({'REMOTE_ADDR': '192.0.2.1'}) == '192.0.2.1'
+
+    # Only proxies are believed about the client's address:
+    assert limiter.client_addr({
+        'REMOTE_ADDR': '192.0.2.1', 'HTTP_X_FORWARDED_FOR': '192.0.2.9',
+    }) == '192.0.2.1'
+
+    # The client can put anything at the start of the header:
+    assert limiter.client_addr({
+        'REMOTE_ADDR': '10.0.0.1',
+        'HTTP_X_FORWARDED_FOR': '1.2.3.4, 192.0.2.7, 10.0.0.2',
+    }) == '192.0.2.7'
+
+    assert limiter.client_addr({'REMOTE_ADDR': '10.0.0.1'}) == '10.0.0.1'
+
+
+def test_throttled_authenticator():
+    limiter = throttle.Throttle(user_burst=1)
+    authenticator = mock.Mock()
+    authenticator.authenticate.return_value = 'bob'
+    (name, wrapped), (name2, wrapped2) = limiter.wrap(
+        [('first', authenticator), ('second', authenticator)]
+    )
+    verify(wrapped, IAuthenticator)
+
+    identity = {'login': 'bob', 'password': 'secret'}
+
+    # Successful logins don't use up the user's tokens:
+    for i in range(3):
+        environ = {'REMOTE_ADDR': '10.0.0.1'}
+        assert wrapped.authenticate(environ, identity) == 'bob'
+        limiter.settle(environ)
+    assert throttle.THROTTLED_KEY not in environ
+
+    # Both authenticators fail the attempt, which takes one token:
+    authenticator.authenticate.return_value = None
+    environ = {'REMOTE_ADDR': '10.0.0.1'}
+    assert wrapped.authenticate(environ, identity) is None
+    assert wrapped2.authenticate(environ, identity) is None
+    assert throttle.THROTTLED_KEY not in environ
+    limiter.settle(environ)
+    assert limiter.stats()['failed'] == 1
+
+    environ = {'REMOTE_ADDR': '10.0.0.1'}
+    assert wrapped.authenticate(environ, identity) is None
+    assert environ[throttle.THROTTLED_KEY] is True
+    assert authenticator.authenticate.call_count == 5
+    authenticator.authenticate.return_value = 'bob'
+
+    # Identities without a login aren't throttled:
+    assert wrapped.authenticate({}, {'repoze.who.userid': 'bob'}) == 'bob'
+
+
+def test_failure_then_success_not_charged():
+    limiter = throttle.Throttle(user_burst=3)
+    plain = mock.Mock()
+    plain.authenticate.return_value = None
+    sql = mock.Mock()
+    sql.authenticate.return_value = 'bob'
+    authenticators = limiter.wrap([('plain', plain), ('sql', sql)])
+
+    def login_app(environ, start_response):
+        # As repoze.who does, every authenticator is asked:
+        identity = {'login': 'bob', 'password': 'secret'}
+        environ['userids'] = [
+            a.authenticate(environ, identity) for n, a in authenticators
+        ]
+        return ['ok']
+
+    app = throttle.ThrottleMiddleware(login_app, limiter)
+    for i in range(10):
+        environ = {'REMOTE_ADDR': '10.0.0.%d' % i}
+        assert app(environ, None) == ['ok']
+        assert environ['userids'] == [None, 'bob']
+        assert throttle.THROTTLED_KEY not in environ
+
+    assert limiter.stats()['failed'] == 0
+    assert limiter.stats()['rejected_user'] == 0
+
+    # Once neither accepts it the username is charged:
+    sql.authenticate.return_value = None
+    for i in range(3):
+        app({'REMOTE_ADDR': '10.0.1.%d' % i}, None)
+    assert limiter.stats()['failed'] == 3
+    environ = {'REMOTE_ADDR': '10.0.2.1'}
+    app(environ, None)
+    assert environ[throttle.THROTTLED_KEY] is True
+
+
+def test_add_auth_charges_only_failed_logins():
+    first = mock.Mock(spec=['authenticate'])
+    first.authenticate.return_value = None
+    second = mock.Mock(spec=['authenticate'])
+    second.authenticate.return_value = 'bob'
+    limiter = throttle.Throttle(user_burst=2)
+    adapter = mock.Mock()
+    adapter.find_sections.return_value = set()
+
+    app = middleware.add_auth(
+        lambda environ, start_response: ['ok'],
+        'site', 'auth_cookie', 'secret', '/login', '/login_handler',
+        [('first', first), ('second', second)], [('md', mock.Mock(spec=['add_metadata']))],
+        [('groups', adapter)], [('permissions', adapter)],
+        login_throttle=limiter,
+    )
+
+    def login():
+        body = 'login=bob&password=secret'
+        environ = {
+            'PATH_INFO': '/login_handler',
+            'REQUEST_METHOD': 'POST',
+            'HTTP_HOST': 'localhost',
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'CONTENT_LENGTH': str(len(body)),
+            'REMOTE_ADDR': '10.0.0.1',
+            'wsgi.input': StringIO.StringIO(body),
+            'wsgi.url_scheme': 'http',
+            'wsgi.version': (1, 0),
+        }
+        app(environ, lambda s, h, e=None: None)
+        return environ
+
+    for i in range(5):
+        assert throttle.THROTTLED_KEY not in login()
+    assert second.authenticate.call_count == 5
+    assert limiter.stats()['failed'] == 0
+
+    second.authenticate.return_value = None
+    login()
+    login()
+    assert limiter.stats()['failed'] == 2
+    assert login()[throttle.THROTTLED_KEY] is True
+
+
+def test_get_throttle_from_config():
+    assert throttle.get_throttle_from_config({}) is None
+
+    limiter = throttle.get_throttle_from_config({
+        'pp.auth.throttle': 'true',
+        'pp.auth.throttle_user_burst': '5',
+        'pp.auth.throttle_ip_rate': '2.5',
+        'pp.auth.throttle_trusted_proxies': '10.0.0.1, 10.0.0.2',
+    })
+    assert limiter.trusted_proxies == set(['10.0.0.1', '10.0.0.2'])
+    assert limiter.user_burst == 5
+    assert limiter.user_rate == 0.1
+    assert limiter.ip_rate == 2.5
+    assert isinstance(limiter.backend, throttle.LocalBackend)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the signed token identifier.
+
+"""
+import os
+import shutil
+import tempfile
+
+import mock
+from repoze.who.plugins.auth_tkt import AuthTktCookiePlugin
+
+from pp.auth import tokens
+from pp.auth import middleware
+from pp.auth.plugins import plain
+
+
+SECRET = '07cafeee-ef19-4a1c-aab2-61fefbad85f4'
+
+ENVIRON = {'HTTP_HOST': 'localhost'}
+
+
+def make_plugin(**kwargs):
+    fallback = AuthTktCookiePlugin(SECRET, 'auth_cookie')
+    return tokens.TokenIdentifierPlugin(
+        SECRET, fallback, cookie_name='auth_cookie_token', **kwargs
+    )
+
+
+def token_from(headers, cookie_name='auth_cookie_token'):
+    for name, value in headers:
+        if name == 'Set-Cookie' and value.startswith(cookie_name + '='):
+            return value.split(';')[0].split('=', 1)[1]
+
+
+def test_remember_and_identify():
+    plugin = make_plugin(fields=frozenset(['name', 'email', 'password']))
+    identity = {
+        'repoze.who.userid': 'bob',
+        'name': 'Bob Sprocket',
+        'email': 'bob@example.com',
+        'password': 'secret',
+        'groups': ('admin',),
+        'permissions': ('view',),
+    }
+
+    token = token_from(plugin.remember(ENVIRON, identity))
+    assert token
+
+    found = plugin.identify({'HTTP_COOKIE': 'auth_cookie_token=%s' % token})
+    assert found['repoze.who.userid'] == 'bob'
+    assert found['name'] == 'Bob Sprocket'
+    assert 'password' not in found
+    assert found[tokens.TOKEN_KEY]['groups'] == ['admin']
+
+    # No new token while the current one is good:
+    assert token_from(plugin.remember(ENVIRON, found)) is None
+
+    # The token cookie is dropped on logout:
+    assert token_from(plugin.forget(ENVIRON, found)) == 'INVALID'
+
+
+def test_default_fields():
+    plugin = make_plugin()
+    token = token_from(plugin.remember(ENVIRON, {
+        'repoze.who.userid': 'bob',
+        'id': '1a2b',
+        'display_name': 'Bob Sprocket',
+        'email': 'bob@example.com',
+        'extra': {'salary': 1},
+    }))
+
+    found = plugin.identify({'HTTP_COOKIE': 'auth_cookie_token=%s' % token})
+    assert found['display_name'] == 'Bob Sprocket'
+    assert 'id' not in found
+    assert 'email' not in found
+    assert 'extra' not in found
+
+
+def test_invalid_token_falls_back():
+    plugin = make_plugin()
+    plugin.fallback = mock.Mock()
+    plugin.fallback.identify.return_value = {'repoze.who.userid': 'bob'}
+
+    identity = plugin.identify({'HTTP_COOKIE': 'auth_cookie_token=xxx'})
+    assert identity == {'repoze.who.userid': 'bob'}
+
+    expired = make_plugin(timeout=-1)
+    token = token_from(expired.remember(ENVIRON, {'repoze.who.userid': 'bob'}))
+    assert plugin.parse_token(token) is None
+
+
+def test_token_options_from_config():
+    settings = {
+        'pp.auth.cookie_name': 'auth_cookie',
+        'pp.auth.cookie_secret': SECRET,
+    }
+    assert tokens.token_options_from_config(settings) is None
+
+    settings['pp.auth.identifier'] = 'token'
+    settings['pp.auth.metadata_fields'] = 'email'
+    assert tokens.token_options_from_config(settings) == dict(
+        secret=SECRET,
+        cookie_name='auth_cookie_token',
+        timeout=300,
+        fields=frozenset(['email']),
+    )
+
+
+def test_token_skips_metadata_and_groups():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = {
+            'passwd.csv': "admin1, xxx, Admin, Istrator, admin@example.com\n",
+            'groups.ini': "[admin]\nadmin1\n",
+            'permissions.ini': "[view]\nadmin\n",
+        }
+        for name, content in files.items():
+            with open(os.path.join(tmpdir, name), 'w') as fd:
+                fd.write(content)
+
+        settings = {
+            'pp.auth.cookie_name': 'auth_cookie',
+            'pp.auth.cookie_secret': SECRET,
+            'pp.auth.identifier': 'token',
+            'pp.auth.plugins': 'pp.auth.plugins.plain',
+            'pp.auth.authenticators': 'plain',
+            'pp.auth.mdproviders': 'plain',
+            'pp.auth.groups': 'plain',
+            'pp.auth.permissions': 'plain',
+            'pp.auth.plain.password_file': os.path.join(tmpdir, 'passwd.csv'),
+            'pp.auth.plain.groups_file': os.path.join(tmpdir, 'groups.ini'),
+            'pp.auth.plain.permissions_file': os.path.join(
+                tmpdir, 'permissions.ini'
+            ),
+        }
+
+        seen = []
+
+        def app(environ, start_response):
+            seen.append(dict(environ['repoze.who.identity']))
+            start_response('200 OK', [])
+            return ['ok']
+
+        wrapped = middleware.add_auth_from_config(app, settings)
+
+        def request(cookie):
+            responses = []
+            environ = {
+                'PATH_INFO': '/',
+                'REQUEST_METHOD': 'GET',
+                'HTTP_HOST': 'localhost',
+                'HTTP_COOKIE': cookie,
+                'wsgi.version': (1, 0),
+            }
+            wrapped(environ, lambda s, h, e=None: responses.append(h))
+            return responses[0]
+
+        # Log in with the auth_tkt cookie and get a token back:
+        fallback = AuthTktCookiePlugin(SECRET, 'auth_cookie')
+        headers = fallback.remember(ENVIRON, {'repoze.who.userid': 'admin1'})
+        auth_tkt = headers[0][1].split(';')[0]
+
+        with mock.patch.object(
+            plain.PlainAuthenticatorMetadataProvider, 'add_metadata',
+            autospec=True,
+        ) as add_metadata:
+            def fill(self, environ, identity):
+                identity['name'] = 'Admin Istrator'
+            add_metadata.side_effect = fill
+
+            token = token_from(request(auth_tkt))
+            assert token
+            assert add_metadata.call_count == 1
+            assert seen[-1]['groups'] == ('admin',)
+
+            # Now the identity comes from the token alone:
+            request('%s; auth_cookie_token=%s' % (auth_tkt, token))
+            assert add_metadata.call_count == 1
+            assert seen[-1]['repoze.who.userid'] == 'admin1'
+            assert seen[-1]['name'] == 'Admin Istrator'
+            assert seen[-1]['groups'] == ('admin',)
+            assert seen[-1]['permissions'] == ('view',)
+
+    finally:
+        plain._files.pop(os.path.join(tmpdir, 'passwd.csv'), None)
+        plain._access_files.clear()
+        shutil.rmtree(tmpdir)
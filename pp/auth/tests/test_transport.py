@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+This tests the pooled HTTP transport for the remote plugins.
+
+"""
+import mock
+from requests.adapters import HTTPAdapter
+
+from pp.auth import transport
+
+
+def test_session_from_config():
+    settings = {
+        'pp.auth.userservice.pool_size': '4',
+        'pp.auth.userservice.connect_timeout': '1',
+        'pp.auth.userservice.read_timeout': '2.5',
+        'pp.auth.userservice.retries': '3',
+        'pp.auth.userservice.retry_backoff': '0.5',
+    }
+    session = transport.session_from_config(
+        settings, 'pp.auth.userservice.'
+    )
+    adapter = session.get_adapter('http://localhost/')
+    assert isinstance(adapter, transport.TimeoutHTTPAdapter)
+    assert session.get_adapter('https://localhost/') is adapter
+    assert adapter.timeout == (1.0, 2.5)
+    assert adapter._pool_maxsize == 4
+    assert adapter.max_retries.total == 3
+    assert adapter.max_retries.backoff_factor == 0.5
+
+
+def test_default_timeout_applied():
+    adapter = transport.TimeoutHTTPAdapter(timeout=(1, 2))
+    with mock.patch.object(HTTPAdapter, 'send') as send:
+        adapter.send('request')
+        send.assert_called_once_with('request', timeout=(1, 2))
+
+        send.reset_mock()
+        adapter.send('request', timeout=5)
+        send.assert_called_once_with('request', timeout=5)
+
+
+def test_use_session():
+    session = transport.make_session()
+
+    class Client(object):
+        session = None
+
+    client = Client()
+    assert transport.use_session(client, session)
+    assert client.session is session
+
+    assert not transport.use_session(object(), session)
+
+
+def test_use_session_api():
+    session = transport.make_session()
+
+    class API(object):
+        session = None
+
+    class Client(object):
+        session = None
+
+        def __init__(self):
+            self.api = API()
+
+    # The requests are made by the client's api:
+    client = Client()
+    assert transport.use_session(client, session)
+    assert client.api.session is session
+
+    # An api keeping no session can't use the pool:
+    client.api = object()
+    assert not transport.use_session(client, session)
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+Limit the rate of login attempts per username and per client address.
+
+Every login attempt costs a password hash verification or a call to a
+remote service. The Throttle keeps a token bucket for each username and
+each client address. Every attempt takes a token from the address's
+bucket, and a failed attempt takes one from the username's. An attempt is
+refused, before any authenticator sees it, when either bucket is empty.
+Buckets refill at a steady rate up to their burst size.
+
+Anyone knowing a username can still use up its bucket with bad passwords,
+locking its owner out until it refills (user_burst / user_rate seconds
+after the attempts stop, 100s by default). The address bucket limits how
+fast one client can do so; raise user_rate where this matters more than
+slowing password guessing.
+
+add_auth() wraps each authenticator in a ThrottledAuthenticator, and the
+auth middleware in a ThrottleMiddleware, when it is enabled in the
+settings::
+
+    pp.auth.throttle = true
+
+    # Optional, these are the defaults. Rates are attempts per second:
+    pp.auth.throttle_user_rate = 0.1
+    pp.auth.throttle_user_burst = 10
+    pp.auth.throttle_ip_rate = 1
+    pp.auth.throttle_ip_burst = 50
+    pp.auth.throttle_max_size = 100000
+
+    # Optional sharing between processes:
+    pp.auth.throttle_memcache = 127.0.0.1:11211
+
+    # Optional: the reverse proxies / load balancers in front of the app.
+    # Requests from these are throttled on the client address they give
+    # in X-Forwarded-For instead of REMOTE_ADDR:
+    pp.auth.throttle_trusted_proxies = 10.0.0.1, 10.0.0.2
+
+A refused attempt fails authentication as a bad password would, and sets
+THROTTLED_KEY in the environ so the login page can say why.
+
+repoze.who asks every authenticator about a login, so one failing it
+doesn't mean the login failed. The ThrottledAuthenticators record each
+login's outcome in the environ and the ThrottleMiddleware charges the
+username once the request has been handled, only if no authenticator
+accepted it.
+
+"""
+import math
+import time
+import logging
+import threading
+
+from zope.interface import implements
+from repoze.who.interfaces import IAuthenticator
+
+from pp.auth import cache
+from pp.auth import config
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# Set to True in the environ when the request's login attempt was refused:
+THROTTLED_KEY = 'pp.auth.throttled'
+
+# The environ key recording the request's decision, so a login tried by
+# several authenticators only takes one token:
+ENVIRON_KEY = 'pp.auth.throttle'
+
+# The environ key recording each login tried this request, mapped to True
+# once an authenticator accepts it:
+OUTCOME_KEY = 'pp.auth.throttle.outcome'
+
+
+class LocalBackend(object):
+    """Keep the token buckets in this process."""
+
+    def __init__(self, max_size=100000, clock=time.time):
+        """
+        :param max_size: The most buckets held. A bucket is dropped once it
+            would have refilled, so this only limits very large bursts of
+            distinct usernames/addresses.
+
+        :param clock: Returns the current time in seconds (for testing).
+
+        """
+        self.clock = clock
+        self._buckets = cache.TTLCache(max_size, clock=clock)
+        self._lock = threading.Lock()
+
+    def _tokens(self, key, rate, burst, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return float(burst)
+        tokens, updated = bucket
+        return min(burst, tokens + (now - updated) * rate)
+
+    def available(self, key, rate, burst):
+        """Return True if the key's bucket has a token, without taking it.
+        """
+        with self._lock:
+            return self._tokens(key, rate, burst, self.clock()) >= 1
+
+    def consume(self, key, rate, burst):
+        """Take a token from the key's bucket.
+
+        :returns: True if there was a token to take.
+
+        """
+        with self._lock:
+            now = self.clock()
+            tokens = self._tokens(key, rate, burst, now)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            # Once refilled the bucket is the same as a new one:
+            self._buckets.set(key, (tokens, now), (burst - tokens) / rate)
+            return allowed
+
+
+class MemcacheThrottleBackend(cache.MemcacheBackend):
+    """Share the buckets between processes via memcached.
+
+    memcached can't update a bucket atomically so this approximates one
+    with a counter per burst / rate seconds window: at most burst attempts
+    are allowed in each window. Attempts are allowed if memcached can't be
+    reached.
+
+    """
+    def __init__(self, servers, prefix='pp.auth.throttle.', clock=time.time):
+        cache.MemcacheBackend.__init__(self, servers, prefix)
+        self.clock = clock
+
+    def _window_key(self, key, rate, burst):
+        window = burst / float(rate)
+        return self._key((key, int(self.clock() // window))), window
+
+    def available(self, key, rate, burst):
+        window_key, window = self._window_key(key, rate, burst)
+        count = self.client.get(window_key)
+        return count is None or int(count) < burst
+
+    def consume(self, key, rate, burst):
+        window_key, window = self._window_key(key, rate, burst)
+
+        count = self.client.incr(window_key)
+        if count is None:
+            self.client.add(window_key, 0, time=int(math.ceil(window * 2)))
+            count = self.client.incr(window_key)
+
+        return count is None or count <= burst
+
+
+class Throttle(object):
+    """Decide whether to allow a login attempt, counting the decisions."""
+
+    def __init__(
+        self, user_rate=0.1, user_burst=10, ip_rate=1, ip_burst=50,
+        backend=None, trusted_proxies=(),
+    ):
+        """
+        :param user_rate: The attempts per second allowed for a username.
+
+        :param user_burst: The attempts a username can make at once.
+
+        :param ip_rate: The attempts per second allowed from an address.
+
+        :param ip_burst: The attempts an address can make at once.
+
+        :param backend: Where the buckets are kept, LocalBackend() by
+            default.
+
+        :param trusted_proxies: The addresses of the reverse proxies in
+            front of the application, see client_addr().
+
+        """
+        self.log = get_log("Throttle")
+        self.user_rate = float(user_rate)
+        self.user_burst = user_burst
+        self.ip_rate = float(ip_rate)
+        self.ip_burst = ip_burst
+        self.backend = LocalBackend() if backend is None else backend
+        self.trusted_proxies = frozenset(trusted_proxies)
+        self._lock = threading.Lock()
+        self._counts = dict(
+            allowed=0, rejected_user=0, rejected_ip=0, failed=0,
+        )
+
+    def _count(self, counter):
+        with self._lock:
+            self._counts[counter] += 1
+
+    def client_addr(self, environ):
+        """Return the address of the client making the request.
+
+        This is REMOTE_ADDR unless the request came through one of the
+        trusted_proxies. Then it is the last address in X-Forwarded-For not
+        itself a trusted proxy, as the addresses before it could be forged
+        by the client.
+
+        """
+        addr = environ.get('REMOTE_ADDR')
+        if addr not in self.trusted_proxies:
+            return addr
+
+        forwarded = environ.get('HTTP_X_FORWARDED_FOR', '').split(',')
+        for hop in reversed([i.strip() for i in forwarded if i.strip()]):
+            addr = hop
+            if hop not in self.trusted_proxies:
+                break
+        return addr
+
+    def allow(self, username, remote_addr=None):
+        """Take a token for the login attempt from the address's bucket and
+        check the username's has one.
+
+        :returns: True if the attempt may go ahead.
+
+        """
+        if remote_addr and not self.backend.consume(
+            ('ip', remote_addr), self.ip_rate, self.ip_burst
+        ):
+            self._count('rejected_ip')
+            self.log.warn("allow: too many attempts from <%s>" % remote_addr)
+            return False
+
+        if not self.backend.available(
+            ('user', username), self.user_rate, self.user_burst
+        ):
+            self._count('rejected_user')
+            self.log.warn("allow: too many attempts for <%s>" % username)
+            return False
+
+        self._count('allowed')
+        return True
+
+    def failed(self, username):
+        """Take a token from the username's bucket for a failed attempt."""
+        self._count('failed')
+        self.backend.consume(
+            ('user', username), self.user_rate, self.user_burst
+        )
+
+    def check(self, environ, identity):
+        """Decide on the request's login attempt once, however many
+        authenticators ask.
+        """
+        login = identity.get('login')
+        decisions = environ.setdefault(ENVIRON_KEY, {})
+        if login not in decisions:
+            decisions[login] = self.allow(login, self.client_addr(environ))
+            if not decisions[login]:
+                environ[THROTTLED_KEY] = True
+        return decisions[login]
+
+    def record(self, environ, identity, accepted):
+        """Record an authenticator's answer to the request's login."""
+        login = identity.get('login')
+        outcomes = environ.setdefault(OUTCOME_KEY, {})
+        outcomes[login] = outcomes.get(login, False) or accepted
+
+    def settle(self, environ):
+        """Charge each login no authenticator accepted to its username,
+        once the request's authentication is over.
+        """
+        for login, accepted in environ.pop(OUTCOME_KEY, {}).items():
+            if not accepted:
+                self.failed(login)
+
+    def wrap(self, authenticators):
+        """Wrap a list of (plugin_id, authenticator) in
+        ThrottledAuthenticators.
+
+        Failed logins are only charged when settle() is called after the
+        request's authentication, e.g. by a ThrottleMiddleware.
+
+        """
+        return [
+            (name, ThrottledAuthenticator(authenticator, self))
+            for name, authenticator in authenticators
+        ]
+
+    def stats(self):
+        """Return the allowed, rejected and failed attempt counts."""
+        with self._lock:
+            return dict(self._counts)
+
+
+class ThrottledAuthenticator(object):
+    """Refuse login attempts the Throttle doesn't allow before they reach
+    the authenticator.
+    """
+    implements(IAuthenticator)
+
+    def __init__(self, authenticator, throttle):
+        self.authenticator = authenticator
+        self.throttle = throttle
+
+    def __getattr__(self, name):
+        return getattr(self.authenticator, name)
+
+    # IAuthenticator
+    def authenticate(self, environ, identity):
+        if 'login' not in identity:
+            return self.authenticator.authenticate(environ, identity)
+
+        if not self.throttle.check(environ, identity):
+            return None
+
+        userid = self.authenticator.authenticate(environ, identity)
+        self.throttle.record(environ, identity, userid is not None)
+        return userid
+
+
+class ThrottleMiddleware(object):
+    """Charge the failed logins once the auth middleware it wraps has
+    handled the request, see Throttle.settle().
+    """
+    def __init__(self, app, throttle):
+        self.app = app
+        self.throttle = throttle
+
+    def __call__(self, environ, start_response):
+        try:
+            return self.app(environ, start_response)
+        finally:
+            self.throttle.settle(environ)
+
+
+def get_throttle_from_config(settings, prefix="pp.auth."):
+    """Return a Throttle if enabled in the settings, or None."""
+    if not config.get_bool(settings, '%sthrottle' % prefix):
+        return None
+
+    servers = config.get_list(settings, '%sthrottle_memcache' % prefix)
+    if servers:
+        backend = MemcacheThrottleBackend(servers, '%sthrottle.' % prefix)
+    else:
+        backend = LocalBackend(config.get_int(
+            settings, '%sthrottle_max_size' % prefix, 100000
+        ))
+
+    throttle = Throttle(
+        user_rate=config.get_float(
+            settings, '%sthrottle_user_rate' % prefix, 0.1
+        ),
+        user_burst=config.get_int(
+            settings, '%sthrottle_user_burst' % prefix, 10
+        ),
+        ip_rate=config.get_float(settings, '%sthrottle_ip_rate' % prefix, 1),
+        ip_burst=config.get_int(settings, '%sthrottle_ip_burst' % prefix, 50),
+        backend=backend,
+        trusted_proxies=config.get_list(
+            settings, '%sthrottle_trusted_proxies' % prefix
+        ),
+    )
+    get_log("get_throttle_from_config").info(
+        "login throttle enabled: user<%s/s burst %s> ip<%s/s burst %s> "
+        "memcache<%s> trusted_proxies<%s>" % (
+            throttle.user_rate, throttle.user_burst, throttle.ip_rate,
+            throttle.ip_burst, servers, sorted(throttle.trusted_proxies),
+        )
+    )
+    return throttle
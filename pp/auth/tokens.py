@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+A repoze.who identifier which keeps the user's metadata, groups and
+permissions in a signed, expiring token cookie.
+
+While the token is valid the identity is recovered from it alone: the
+mdproviders and the group/permission adapters are skipped. Once it expires
+(or if it is missing or tampered with) the normal auth_tkt cookie is used,
+the user's details are looked up as usual and a new token is issued.
+
+Enable it from the add_auth_from_config() settings::
+
+    pp.auth.identifier = token
+
+    # Optional, these are the defaults:
+    pp.auth.token_secret = <pp.auth.cookie_secret>
+    pp.auth.token_cookie_name = <pp.auth.cookie_name>_token
+    pp.auth.token_timeout = 300
+
+    # The metadata kept in the token (pp.auth.metadata_fields, or else
+    # DEFAULT_FIELDS by default):
+    pp.auth.token_fields = username, display_name, email
+
+The token is signed but not encrypted, so the user can read everything in
+it: keep token_fields to what the user may see.
+
+A token isn't revoked. For up to token_timeout seconds after a user is
+removed, their password is changed or their groups and permissions are,
+a token issued before still identifies them with the groups and
+permissions it holds. Keep token_timeout short.
+
+"""
+import json
+import logging
+
+import tokenlib
+from paste.request import get_cookies
+from zope.interface import implements
+from repoze.who.interfaces import IIdentifier
+from repoze.who.interfaces import IMetadataProvider
+from repoze.what.middleware import AuthorizationMetadata
+
+from pp.auth import config
+from pp.auth import metadata
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# The identity key holding the token's data when it was identified by one:
+TOKEN_KEY = 'pp.auth.token'
+
+# Browsers won't store cookies much larger than this:
+MAX_TOKEN_SIZE = 4000
+
+# The metadata kept in a token when no fields are given:
+DEFAULT_FIELDS = frozenset((
+    'username', 'name', 'display_name', 'firstname', 'lastname',
+))
+
+# Identity entries that are never put into a token:
+EXCLUDED = frozenset((
+    'login', 'password', 'password_hash', 'identifier', 'tokens', 'userdata',
+    'timestamp', 'max_age', 'groups', 'permissions', TOKEN_KEY,
+))
+
+
+class TokenIdentifierPlugin(object):
+    """Identify users from a signed token cookie, falling back to another
+    identifier (the auth_tkt cookie) when there is no valid token.
+
+    This is registered in place of the fallback, so the form plugin's
+    remember and forget reach both cookies.
+
+    """
+    implements(IIdentifier)
+
+    def __init__(
+        self, secret, fallback, cookie_name='auth_token', timeout=300,
+        fields=None,
+    ):
+        """
+        :param secret: The secret tokens are signed with.
+
+        :param fallback: The identifier used when there is no valid token.
+
+        :param cookie_name: The cookie the token is stored in.
+
+        :param timeout: The seconds a token is valid for, which is also how
+            long a removed user or a change to their groups or permissions
+            can go unnoticed.
+
+        :param fields: The identity metadata to keep in the token,
+            DEFAULT_FIELDS if None. Only the JSON encodable entries (except
+            EXCLUDED) are kept.
+
+        """
+        self.log = get_log("TokenIdentifierPlugin")
+        self.manager = tokenlib.TokenManager(secret=secret, timeout=timeout)
+        self.fallback = fallback
+        self.cookie_name = cookie_name
+        self.timeout = timeout
+        self.fields = DEFAULT_FIELDS if fields is None else fields
+
+    def make_token(self, identity):
+        """Return a token holding the identity's userid, metadata, groups
+        and permissions.
+        """
+        details = {}
+        for key, value in metadata.project(identity, self.fields).items():
+            if key in EXCLUDED or key.startswith('repoze.'):
+                continue
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            details[key] = value
+
+        return self.manager.make_token(dict(
+            userid=identity['repoze.who.userid'],
+            metadata=details,
+            groups=list(identity.get('groups', ())),
+            permissions=list(identity.get('permissions', ())),
+        ))
+
+    def parse_token(self, token):
+        """Return the data in the token or None if it is not valid."""
+        try:
+            return self.manager.parse_token(token)
+        except ValueError, e:
+            self.log.debug("parse_token: ignoring token: %s" % e)
+
+    def _cookie(self, value, max_age):
+        return ('Set-Cookie', '%s=%s; Path=/; Max-Age=%d; HttpOnly' % (
+            self.cookie_name, value, max_age
+        ))
+
+    # IIdentifier
+    def identify(self, environ):
+        cookie = get_cookies(environ).get(self.cookie_name)
+        data = self.parse_token(cookie.value) if cookie else None
+        if data is None:
+            return self.fallback.identify(environ)
+
+        identity = dict(data['metadata'])
+        identity['repoze.who.userid'] = data['userid']
+        identity[TOKEN_KEY] = data
+        return identity
+
+    # IIdentifier
+    def remember(self, environ, identity):
+        headers = self.fallback.remember(environ, identity) or []
+        if TOKEN_KEY in identity or 'repoze.who.userid' not in identity:
+            # The token is still good:
+            return headers
+
+        token = self.make_token(identity)
+        if len(token) > MAX_TOKEN_SIZE:
+            self.log.warn(
+                "remember: token for <%s> is too large (%d bytes), list "
+                "fewer token_fields." % (
+                    identity['repoze.who.userid'], len(token)
+                )
+            )
+            return headers
+
+        return headers + [self._cookie(token, self.timeout)]
+
+    # IIdentifier
+    def forget(self, environ, identity):
+        headers = self.fallback.forget(environ, identity) or []
+        return headers + [self._cookie('INVALID', 0)]
+
+
+class TokenSkippingMetadataProvider(object):
+    """Wrap an mdprovider so it is skipped for identities from a token."""
+    implements(IMetadataProvider)
+
+    def __init__(self, mdprovider):
+        self.mdprovider = mdprovider
+
+    # IMetadataProvider
+    def add_metadata(self, environ, identity):
+        if TOKEN_KEY not in identity:
+            self.mdprovider.add_metadata(environ, identity)
+
+
+class TokenAuthorizationMetadata(AuthorizationMetadata):
+    """The repoze.what groups and permissions mdprovider, taking them from
+    the token rather than the adapters when there is one.
+    """
+    def _find_groups(self, identity):
+        data = identity.get(TOKEN_KEY)
+        if data is not None:
+            return tuple(data['groups']), tuple(data['permissions'])
+        return AuthorizationMetadata._find_groups(self, identity)
+
+
+def install(middleware):
+    """Replace the repoze.what mdprovider setup_auth() added to the
+    middleware with a TokenAuthorizationMetadata.
+    """
+    authorization = middleware.name_registry['authorization_md']
+    replacement = TokenAuthorizationMetadata(
+        authorization.group_adapters, authorization.permission_adapters
+    )
+    providers = middleware.registry[IMetadataProvider]
+    providers[providers.index(authorization)] = replacement
+    middleware.name_registry['authorization_md'] = replacement
+    return middleware
+
+
+def token_options_from_config(settings, prefix="pp.auth."):
+    """Recover the TokenIdentifierPlugin options from the settings.
+
+    :returns: None if pp.auth.identifier isn't 'token'.
+
+    """
+    identifier = settings.get('%sidentifier' % prefix, 'cookie').strip()
+    if identifier != 'token':
+        return None
+
+    cookie_name = settings['%scookie_name' % prefix]
+    return dict(
+        secret=settings.get(
+            '%stoken_secret' % prefix, settings['%scookie_secret' % prefix]
+        ),
+        cookie_name=settings.get(
+            '%stoken_cookie_name' % prefix, '%s_token' % cookie_name
+        ),
+        timeout=config.get_int(settings, '%stoken_timeout' % prefix, 300),
+        fields=(
+            frozenset(config.get_list(settings, '%stoken_fields' % prefix))
+            or metadata.fields_from_config(settings, prefix)
+        ),
+    )
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP transport for the plugins which talk to remote services.
+
+make_session() returns a requests Session which keeps connections alive in
+a bounded pool, applies connect/read timeouts to every request and retries
+failed connections with an exponential backoff.
+
+"""
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from pp.auth import config
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# Retry when the service is restarting or behind a struggling proxy:
+RETRY_STATUSES = (502, 503, 504)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """An HTTPAdapter which applies a default timeout to every request that
+    doesn't give one, so no call can hang forever.
+    """
+    def __init__(self, timeout=None, *args, **kwargs):
+        """
+        :param timeout: (connect timeout, read timeout) in seconds.
+
+        Other arguments are passed on to HTTPAdapter.
+
+        """
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def make_session(
+    pool_size=10, connect_timeout=3.05, read_timeout=10, retries=2,
+    retry_backoff=0.1
+):
+    """Return a requests Session with a keep-alive connection pool.
+
+    :param pool_size: The connections kept open per host.
+
+    :param connect_timeout: Seconds to wait for a connection.
+
+    :param read_timeout: Seconds to wait for the response.
+
+    :param retries: How many times to retry a failed request. Connection
+        errors are retried for any request. Read errors and 502/503/504
+        responses are only retried for idempotent requests (e.g. GET).
+
+    :param retry_backoff: Seconds to sleep before the second retry, doubling
+        for each retry after that.
+
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=retry_backoff,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    adapter = TimeoutHTTPAdapter(
+        timeout=(connect_timeout, read_timeout),
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def session_from_config(settings, prefix):
+    """Return make_session() configured from the settings.
+
+    The settings recognised are (for prefix 'pp.auth.userservice.')::
+
+        pp.auth.userservice.pool_size = 10
+        pp.auth.userservice.connect_timeout = 3.05
+        pp.auth.userservice.read_timeout = 10
+        pp.auth.userservice.retries = 2
+        pp.auth.userservice.retry_backoff = 0.1
+
+    """
+    return make_session(
+        pool_size=config.get_int(settings, '%spool_size' % prefix, 10),
+        connect_timeout=config.get_float(
+            settings, '%sconnect_timeout' % prefix, 3.05
+        ),
+        read_timeout=config.get_float(
+            settings, '%sread_timeout' % prefix, 10
+        ),
+        retries=config.get_int(settings, '%sretries' % prefix, 2),
+        retry_backoff=config.get_float(
+            settings, '%sretry_backoff' % prefix, 0.1
+        ),
+    )
+
+
+def use_session(client, session):
+    """Make a REST client send its requests through the given session.
+
+    The client must keep the requests Session it uses as its 'session'
+    attribute. Clients like pp.user's make their requests through an 'api'
+    object, whose session is replaced as well.
+
+    :returns: True if the session was installed, False if the client has no
+        session to replace (it then keeps making its own connections).
+
+    """
+    api = getattr(client, 'api', None)
+    target = client if api is None else api
+    if not hasattr(target, 'session'):
+        get_log("use_session").warn(
+            "%r has no session, connection pooling not used." % target
+        )
+        return False
+
+    target.session = session
+    if target is not client and hasattr(client, 'session'):
+        client.session = session
+    return True
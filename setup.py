@@ -16,9 +16,11 @@ ShortDescription = Summary
 
 needed = [
     "mock",
-    "passlib",
+    "futures",
+    "passlib>=1.7",
     "pyparsing==1.5.7",
     "pp-db",
+    "requests",
     "tokenlib",
     "repoze.who==1.0.19",
     "repoze.what==1.0.9",
@@ -43,6 +45,16 @@ PackageData = {
 }
 
 EntryPoints = """
+[console_scripts]
+pp-auth-calibrate = pp.auth.calibrate:main
+pp-auth-bench = pp.auth.bench.wsgi:main
+
+[pp.auth.plugins]
+plain = pp.auth.plugins.plain
+sql = pp.auth.plugins.sql
+latchpony = pp.auth.plugins.latchpony
+userservice = pp.auth.plugins.userservice
+userservice_mongobackend = pp.auth.plugins.userservice_mongobackend
 """
 
 setup(